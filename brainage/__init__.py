@@ -1,11 +1,27 @@
 from .calculate_features import calculate_voxelwise_features, calculate_parcelwise_features
+from .calculate_features import calculate_multi_voxelwise_features
+from .calculate_features import ExtractionPlan, AtlasPlan, binarize_3d
+from .extraction_operator import ExtractionOperator
+from .feature_cache import FeatureCache, file_key
+from .feature_writer import MemmapFeatureWriter
 from .create_splits import stratified_splits
-from .xgboost_adapted import XGBoostAdapted
+from .xgboost_adapted import XGBoostAdapted, thread_budget
 from .zscore import ZScoreSubwise, ZScore
+from .gram_pca import GramPCA
+from .kernel_ridge import KernelRidge, clear_kernel_caches
+from .gaussian_process import GaussianProcessRegressor
+from .glmnet_mix import ElasticNetMix, mix_scores, with_predict_alpha
+from .checkpoint import set_checkpoint_dir, checkpoint_dir, load_or_run, checkpointed_fit
+from .checkpoint import RandomForestRegressor, RVR, ElasticNet
+from .preprocessing_cache import set_preprocessing_cache, preprocessing_cache_dir
+from .preprocessing_cache import CachedVarianceThreshold, CachedStandardScaler, CachedPCA, CachedGramPCA
 from .create_splits import repeated_stratified_splits
 from .read_data import read_data_cross_site
-from .read_data import read_data
-from .define_models import define_models
+from .read_data import read_data, load_features
+from .define_models import define_models, get_step, glmnet_model
+from .workflow import Task, build_workflow, workflow_graph, outdated_tasks, run_workflow
+from .compact_model import CompactModel, export_compact, compact_models, save_compact, load_compact
+from .model_store import save_model_store, load_model_store, is_model_store, prune_model_store
 from sklearn.linear_model import LinearRegression
 from .performance_metric import performance_metric
 
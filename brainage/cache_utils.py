@@ -0,0 +1,88 @@
+import os
+import pickle
+import hashlib
+import contextlib
+from collections import OrderedDict
+import numpy as np
+
+
+@contextlib.contextmanager
+def atomic_open(filename, mode='wb'):
+    """Open a temporary file next to filename and move it into place once written
+
+    Readers (other processes, a rerun after preemption) see the old or the
+    complete new file, never a partially written one. The temporary file
+    is removed if writing fails.
+
+    Args:
+        filename (str): final path of the file
+        mode (str): open mode of the temporary file ('wb' or 'w')
+    """
+    tmp_file = f"{filename}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, mode) as f:
+            yield f
+        os.replace(tmp_file, filename)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def dump_pickle(obj, filename):
+    """Pickle obj to filename atomically (see atomic_open)"""
+    with atomic_open(filename) as f:
+        pickle.dump(obj, f, protocol=4)
+
+
+def array_key(*arrays, prefix=''):
+    """Hash of a prefix string and the shape, dtype and content of the arrays
+
+    Args:
+        arrays (array-like): arrays identifying the data (e.g. the rows of a fold)
+        prefix (str): parameters hashed before the arrays
+
+    Returns:
+        key (str): hex digest
+    """
+    key = hashlib.sha1(prefix.encode())
+    for data in arrays:
+        data = np.ascontiguousarray(data)
+        key.update(f"{data.shape}{data.dtype.str}".encode())
+        key.update(data.data)
+    return key.hexdigest()
+
+
+def fit_key(estimator, X, y=None):
+    """Hash of the estimator class and parameters and of the data (and target) it is fitted on"""
+    prefix = type(estimator).__name__ + repr(sorted(estimator.get_params().items()))
+    if hasattr(X, 'columns'):
+        prefix += repr(list(X.columns))
+    return array_key(*([X] if y is None else [X, y]), prefix=prefix)
+
+
+class ContentCache(OrderedDict):
+    """In-process LRU of results computed from the data of a fold, looked up by content
+
+    GridSearchCV clones the estimator for every grid point and loops over
+    the folds for every one of them, so results that only depend on the
+    fold (base kernels, split DMatrix) are kept in a module level cache
+    keyed by the content of the fold's arrays (see array_key), not by
+    estimator. The `max_size` most recently used results are kept.
+
+    Args:
+        max_size (int): number of results kept
+    """
+
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+
+    def get_or_compute(self, key, compute):
+        """The result stored under key, compute() stored under key if there is none"""
+        if key in self:
+            self.move_to_end(key)
+            return self[key]
+        self[key] = value = compute()
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+        return value
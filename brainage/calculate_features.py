@@ -1,10 +1,19 @@
 import os.path
+import hashlib
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import nilearn
 from nilearn import image
 import numpy as np
 import pandas as pd
 import nibabel as nib
 import nibabel.processing as npr
+from scipy import ndimage
+from .extraction_operator import ExtractionOperator, _smoothing_sigmas
+from .feature_cache import FeatureCache, file_key
+from .feature_writer import MemmapFeatureWriter
+from .cache_utils import atomic_open
 
 def subsample_img(img, f):
     """Reduce resample_to_img features of a 3D array by a given factor f."""
@@ -21,7 +30,313 @@ def binarize_3d(img, threshold):
         np.where(img.get_fdata() > threshold, 1, 0), img.affine, img.header
     )
 
-def calculate_voxelwise_features(phenotype_file, mask_file, smooth_fwhm, resample_size):
+def _geometry_key(img):
+    """Hashable key describing the voxel grid (shape + affine) of an image."""
+    return (tuple(img.shape[:3]), img.affine.tobytes())
+
+def _smoothing_radius(affine, smooth_fwhm, truncate=4.0):
+    """Gaussian kernel radius (voxels) per axis of nilearn.image.smooth_img"""
+    return np.array([int(truncate * sigma + 0.5) if sigma > 0 else 0
+                     for sigma in _smoothing_sigmas(affine, smooth_fwhm)])
+
+def _read_block(img, slices):
+    """Read the sub-block `slices` of an image through its array proxy
+
+    Uncompressed, unscaled files are memory-mapped so only the pages of the
+    block are touched, otherwise nibabel reads just the block from the file.
+    The result is the same as slicing np.asanyarray(img.dataobj).
+    """
+    dataobj = img.dataobj
+    if (nib.is_proxy(dataobj) and getattr(dataobj, "slope", None) == 1 and getattr(dataobj, "inter", None) == 0
+            and isinstance(dataobj.file_like, str) and not dataobj.file_like.endswith((".gz", ".bz2", ".zst"))):
+        return np.array(np.asanyarray(dataobj)[slices])  # memmap (nib.load default mmap=True)
+    return np.asanyarray(dataobj[slices])
+
+def crop_img(img, slices, dtype=None):
+    """Sub-block of an image with the affine shifted to the block origin
+
+    With dtype, data wider than dtype (float64, scaled or int64 files) is
+    cast to it when read, so smoothing and resampling run in dtype. Narrower
+    data is kept, nilearn smooths integers in float32.
+    """
+    offset = np.array([s.start for s in slices])
+    affine = img.affine.copy()
+    affine[:3, 3] = img.affine[:3, :3].dot(offset) + img.affine[:3, 3]
+    block = _read_block(img, slices)
+    if dtype is not None and block.dtype.itemsize > np.dtype(dtype).itemsize:
+        block = block.astype(dtype)
+    return nib.Nifti1Image(block, affine)
+
+
+class ExtractionPlan:
+    """Voxelwise feature extraction setup that is built once per run
+
+    The GM mask is loaded, resampled to `resample_size` and binarized a single
+    time and kept as flat (C-order) voxel indices on the target grid. The
+    mapping from a subject grid onto the masked target voxels is computed once
+    per input geometry (affine + shape) and reused for all subjects sharing it.
+    Subjects that already sit on the target grid are not resampled at all.
+
+    With crop=True only the bounding box of the input voxels the masked target
+    voxels interpolate from, plus the smoothing kernel radius, is read from
+    disk and smoothed. Voxels further away do not reach the masked voxels, so
+    the features are identical to processing the full volume.
+
+    Args:
+        mask_file (nii): The GM mask file to be used to extract features
+        smooth_fwhm (int): Smooth images by applying a Gaussian filter by given FWHM (mm)
+        resample_size (int): Resample image to given voxel size
+        dtype (dtype): Floating point type of the extracted features, and of
+            the cropped image data they are smoothed and resampled from
+        crop (bool): Read and process only the mask bounding box of subject images
+    """
+
+    def __init__(self, mask_file, smooth_fwhm, resample_size, dtype=np.float64, crop=True):
+        self.mask_file = mask_file
+        self.smooth_fwhm = smooth_fwhm
+        self.resample_size = resample_size
+        self.dtype = np.dtype(dtype)
+        self.crop = crop
+
+        mask_img = nib.load(mask_file)
+        # trying to match Gaser
+        mask_img_rs = npr.resample_to_output(
+            mask_img, [resample_size] * len(mask_img.shape), order=1
+        )
+        mask_rs = binarize_3d(mask_img_rs, 0.5).get_fdata().astype(bool)
+
+        self.target_affine = mask_img_rs.affine
+        self.target_shape = mask_rs.shape
+        self.mask_indices = np.flatnonzero(mask_rs)
+        self._mask_ijk = np.unravel_index(self.mask_indices, self.target_shape)
+
+        mask_hash = hashlib.sha1()  # identifies the resampled mask (target grid + voxels)
+        mask_hash.update(np.ascontiguousarray(self.target_affine, dtype=np.float64).tobytes())
+        mask_hash.update(np.asarray(self.target_shape, dtype=np.int64).tobytes())
+        mask_hash.update(np.asarray(self.mask_indices, dtype=np.int64).tobytes())
+        self.mask_hash = mask_hash.hexdigest()
+        self._coordinates = {}  # input voxel coordinates per geometry key
+        self._bounding_boxes = {}  # input voxel bounding box per geometry key
+
+    @property
+    def n_features(self):
+        return self.mask_indices.size
+
+    def coordinates(self, img):
+        """Voxel coordinates in `img` of the masked target voxels
+
+        Returns None if `img` already sits on the target grid.
+        """
+        key = _geometry_key(img)
+        if key not in self._coordinates:
+            if (img.shape[:3] == self.target_shape
+                    and np.array_equal(img.affine, self.target_affine)):
+                coords = None
+            else:
+                # same voxel mapping as nilearn.image.resample_to_img
+                transform = np.linalg.inv(img.affine).dot(self.target_affine)
+                ijk = np.array(self._mask_ijk, dtype=np.float64)
+                coords = transform[:3, :3].dot(ijk) + transform[:3, 3:]
+            self._coordinates[key] = coords
+        return self._coordinates[key]
+
+    def bounding_box(self, img):
+        """First and last input voxel (per axis) the masked target voxels interpolate from
+
+        Coordinates outside `img` are zero whatever the data and do not
+        count. Returns None if no masked voxel falls inside `img`.
+        """
+        key = _geometry_key(img)
+        if key not in self._bounding_boxes:
+            coords = self.coordinates(img)
+            shape = np.array(img.shape[:3])
+            if coords is None:
+                coords = np.array(self._mask_ijk)
+            inside = np.all((coords >= 0) & (coords <= shape[:, None] - 1), axis=0)
+            if not inside.any():
+                box = None
+            else:
+                lower = np.floor(coords[:, inside].min(axis=1)).astype(int)
+                upper = np.minimum(np.floor(coords[:, inside].max(axis=1)).astype(int) + 1, shape - 1)
+                box = (lower, upper)
+            self._bounding_boxes[key] = box
+        return self._bounding_boxes[key]
+
+    def extract(self, sub_img):
+        """Smooth, resample and mask one subject image
+
+        Args:
+            sub_img (Nifti1Image): subject image
+
+        Returns:
+            sub_data_rs (ndarray): 1D array of the masked voxel values
+        """
+        if not self.crop:
+            return self.resample(image.smooth_img(sub_img, self.smooth_fwhm))
+        slices = crop_slices(sub_img, [self], _smoothing_radius(sub_img.affine, self.smooth_fwhm))
+        return self.resample(image.smooth_img(crop_img(sub_img, slices, self.dtype), self.smooth_fwhm),
+                             sub_img, slices)
+
+    def resample(self, sub_img, full_img=None, slices=None):
+        """Resample and mask an already smoothed subject image
+
+        Args:
+            sub_img (Nifti1Image): smoothed subject image
+            full_img (Nifti1Image, optional): image sub_img was cropped from (see crop_img)
+            slices (tuple, optional): slices sub_img was cropped with
+
+        Returns:
+            sub_data_rs (ndarray): 1D array of the masked voxel values
+        """
+        sub_data = np.asanyarray(sub_img.dataobj)
+
+        if full_img is None:
+            coords = self.coordinates(sub_img)
+            offset = np.zeros((3, 1), dtype=int)
+        else:  # voxel coordinates of the full image shifted to the crop (exact)
+            coords = self.coordinates(full_img)
+            offset = np.array([[s.start] for s in slices])
+        if coords is None:
+            sub_data_rs = sub_data[tuple(np.array(self._mask_ijk) - offset)]
+        else:
+            # linear interpolation evaluated on the masked voxels only
+            sub_data_rs = ndimage.map_coordinates(
+                sub_data, coords - offset, output=sub_data.dtype, order=1, mode="constant", cval=0
+            )
+        return sub_data_rs.astype(self.dtype, copy=False)
+
+
+def crop_slices(img, plans, margin):
+    """Slices of the union of the plans bounding boxes in img, widened by margin voxels
+
+    Args:
+        img (Nifti1Image): subject image
+        plans (list): ExtractionPlan objects the crop is used for
+        margin (ndarray): number of voxels added per axis (smoothing kernel radius)
+
+    Returns:
+        slices (tuple): one slice per axis, clipped to the image
+    """
+    shape = np.array(img.shape[:3])
+    boxes = [box for box in (plan.bounding_box(img) for plan in plans) if box is not None]
+    if not boxes:  # no masked voxel inside the image, the features are all zero
+        return (slice(0, 1),) * 3
+    lower = np.maximum(np.min([box[0] for box in boxes], axis=0) - margin, 0)
+    upper = np.minimum(np.max([box[1] for box in boxes], axis=0) + margin, shape - 1)
+    return tuple(slice(int(start), int(stop) + 1) for start, stop in zip(lower, upper))
+
+
+_worker = {}  # per process state set up by _init_worker
+
+
+def _init_worker(func, *args):
+    """Keep the subject function and its shared inputs (plan, atlas) in the worker"""
+    _worker["func"] = func
+    _worker["args"] = args
+
+
+def _call_worker(sub_file):
+    return _worker["func"](sub_file, nib.load(sub_file), *_worker["args"])
+
+
+def load_img(sub_file):
+    """Load a subject image with its data read (and decompressed) into memory"""
+    sub_img = nib.load(sub_file)
+    sub_data = np.asanyarray(sub_img.dataobj)
+    if isinstance(sub_data, np.memmap):  # uncompressed files are mapped, read them now
+        sub_data = np.array(sub_data)
+    return nib.Nifti1Image(sub_data, sub_img.affine, sub_img.header)
+
+
+def prefetch_images(sub_files, depth=2, max_bytes=None, n_threads=1):
+    """Yield the subject images in order while the next ones load in the background
+
+    Up to `depth` images ahead are read and decompressed (see load_img) on
+    background threads, so the I/O of the next subjects overlaps the smoothing
+    and resampling of the current one. With max_bytes the prefetched images
+    are limited to about that much memory (estimated from the largest image
+    so far); one image is always prefetched, and only one until the size of
+    the first is known.
+
+    Args:
+        sub_files (list): paths to subject images
+        depth (int): number of images loaded ahead, 0 loads lazily with nib.load
+        max_bytes (int, optional): memory cap of the prefetched images
+        n_threads (int): number of loading threads
+
+    Returns:
+        sub_imgs (generator): subject images (Nifti1Image) in sub_files order
+    """
+    if not depth:
+        for sub_file in sub_files:
+            yield nib.load(sub_file)
+        return
+
+    pending = deque()
+    img_bytes = None  # largest image so far, unknown before the first is loaded
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        sub_files = iter(sub_files)
+        while True:
+            while len(pending) < depth and (not pending or max_bytes is None or (
+                    img_bytes is not None and (len(pending) + 1) * img_bytes <= max_bytes)):
+                sub_file = next(sub_files, None)
+                if sub_file is None:
+                    break
+                pending.append(executor.submit(load_img, sub_file))
+            if not pending:
+                return
+            sub_img = pending.popleft().result()
+            img_bytes = max(img_bytes or 0, sub_img.dataobj.nbytes)
+            yield sub_img
+
+
+def _map_subjects(func, sub_files, n_jobs, *args, prefetch=0, prefetch_max_bytes=None):
+    """Apply func(sub_file, sub_img, *args) to each subject file and yield the results in order
+
+    With n_jobs > 1 (or -1 for all cpus) the subjects are spread over a process
+    pool, args are sent to every worker once and not once per subject.
+    Otherwise the next `prefetch` images are loaded on a background thread
+    (see prefetch_images).
+    """
+    if n_jobs is None or n_jobs == 1:
+        sub_imgs = prefetch_images(sub_files, prefetch, prefetch_max_bytes)
+        for sub_file, sub_img in zip(sub_files, sub_imgs):
+            yield func(sub_file, sub_img, *args)
+        return
+
+    n_jobs = os.cpu_count() if n_jobs < 0 else n_jobs
+    chunksize = max(1, len(sub_files) // (4 * n_jobs))
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(func,) + args) as executor:
+        yield from executor.map(_call_worker, sub_files, chunksize=chunksize)
+
+
+def _existing_files(phenotype):
+    """Subject files from the first column of the phenotype which exist on disk"""
+    return [sub_file for sub_file in phenotype.iloc[:, 0] if os.path.exists(sub_file)]
+
+
+class _ArrayFeatureWriter:
+    """In memory counterpart of MemmapFeatureWriter"""
+
+    def __init__(self, n_subjects, n_features, dtype):
+        self.data = np.empty((n_subjects, n_features), dtype=dtype)
+        self.n_done = 0
+
+    def write(self, row):
+        self.data[self.n_done] = row
+        self.n_done += 1
+
+
+def _voxelwise_subject(sub_file, sub_img, plan):
+    print(f"\n-----Processing subject {sub_file}------")
+    print("sub affine original \n", sub_img.affine, sub_img.shape)
+    return plan.extract(sub_img)  # smooth, resample and extract voxels using the binarized mask
+
+
+def calculate_voxelwise_features(phenotype_file, mask_file, smooth_fwhm, resample_size, plan=None, n_jobs=1,
+                                 method="nilearn", operator_cache_dir=None, batch_size=32, dtype=np.float64,
+                                 cache_dir=None, hash_content=True, output_file=None, prefetch=0,
+                                 prefetch_max_bytes=None):
     """Calculate voxelwise features for the subjects
 
     Args:
@@ -29,9 +344,29 @@ def calculate_voxelwise_features(phenotype_file, mask_file, smooth_fwhm, resampl
         mask_file (nii): The GM mask file to be used to extract features
         smooth_fwhm (int): Smooth images by applying a Gaussian filter by given FWHM (mm)
         resample_size (int): Resample image to given voxel size
+        plan (ExtractionPlan, optional): A prebuilt extraction plan, if given
+            mask_file, smooth_fwhm, resample_size and dtype are taken from it
+        n_jobs (int): Number of processes to spread the subjects over (-1 for all cpus),
+            used by the nilearn method
+        method (str): "nilearn" smooths and resamples every subject image,
+            "operator" applies a precompiled sparse ExtractionOperator to
+            batches of subjects
+        operator_cache_dir (str, optional): Directory to cache the sparse operators
+        batch_size (int): Number of subjects per sparse product (operator method)
+        dtype (dtype): Floating point type of the features (np.float32 halves memory and disk use)
+        cache_dir (str, optional): Directory of a per subject FeatureCache, only
+            new or changed subjects are extracted and the rest is read from it
+        hash_content (bool): Identify subject files by content hash (True) or by
+            path, size and modification time (False)
+        output_file (str, optional): .npy file the features are streamed into
+            (see MemmapFeatureWriter), an interrupted run resumes from it
+        prefetch (int): Number of subject images loaded ahead on a background thread
+            (see prefetch_images), used with n_jobs=1 and by the operator method
+        prefetch_max_bytes (int, optional): Memory cap of the prefetched images
 
     Returns:
-        data_resampled (dataframe): pandas dataframe of features (N subjects by M features)
+        data_resampled (dataframe): pandas dataframe of features (N subjects by M features),
+            backed by the memmap of output_file if given
     """    
 
     phenotype = pd.read_csv(phenotype_file, header=None)
@@ -50,63 +385,57 @@ def calculate_voxelwise_features(phenotype_file, mask_file, smooth_fwhm, resampl
 
 #    phenotype = phenotype.iloc[0:15]
 
-    data_resampled = np.array([])  # array to save resampled features from subjects mri
-    count = 0
-    for index, row in phenotype.iterrows():  # iterate over each row
-        sub_file = row.values[0]
-
-        if os.path.exists(sub_file):
-            print(f"\n-----Processing subject number {count}------")
-            sub_img = nib.load(sub_file)  # load subject image
-            mask_img = nib.load(mask_file)  # load mask image
-            print("Subject and mask image loaded")
-            print("sub affine original \n", sub_img.affine, sub_img.shape)
-            print("mask affine original \n", mask_img.affine, mask_img.shape)
-
-            print("Perform smoothing")
-            sub_img = image.smooth_img(
-                sub_img, smooth_fwhm
-            )  # smooth the image with 4 mm FWHM
-
-            print("Perform resampling")
-            # trying to match Gaser
-            mask_img_rs = npr.resample_to_output(
-                mask_img, [resample_size] * len(mask_img.shape), order=1
-            )  # resample mask
-            print(
-                "mask affine after resampling\n",
-                mask_img_rs.affine,
-                mask_img_rs.shape,
-            )
-
-            sub_img_rs = image.resample_to_img(
-                sub_img, mask_img_rs, interpolation="linear"
-            )  # resample subject
-            print(
-                "sub affine after resampling\n",
-                sub_img_rs.affine,
-                sub_img_rs.shape,
-            )
-
-            binary_mask_img_rs = binarize_3d(mask_img_rs, 0.5)  # binarize the mask
-            mask_rs = binary_mask_img_rs.get_fdata().astype(bool)
-
-            sub_data_rs = sub_img_rs.get_fdata()[
-                mask_rs
-            ]  # extract voxel using the binarized mask
-            sub_data_rs = sub_data_rs.reshape(1, -1)
-
-            if data_resampled.size == 0:
-                data_resampled = sub_data_rs
-            else:
-                data_resampled = np.concatenate((data_resampled, sub_data_rs), axis=0)
-            count = count + 1
-            print(data_resampled.shape)
+    if plan is None:
+        plan = ExtractionPlan(mask_file, smooth_fwhm, resample_size, dtype=dtype)  # mask is resampled only once
+    print("mask affine after resampling\n", plan.target_affine, plan.target_shape)
+    print("Number of voxels in the mask:", plan.n_features)
+
+    sub_files = _existing_files(phenotype)
+    if output_file is not None:  # stream into a memmap, resume a previous run
+        params = f"S{plan.smooth_fwhm}_R{plan.resample_size}.{method}.{plan.mask_hash}"
+        writer = MemmapFeatureWriter(output_file, sub_files, plan.n_features, plan.dtype, params=params)
+    else:
+        writer = _ArrayFeatureWriter(len(sub_files), plan.n_features, plan.dtype)
+    remaining = sub_files[writer.n_done:]
+
+    todo_files = remaining
+    if cache_dir is not None:
+        cache = FeatureCache(cache_dir, plan, method=method)
+        keys = [file_key(sub_file, hash_content) for sub_file in remaining]
+        cached = [cache.has(key) for key in keys]
+        todo_files = [sub_file for sub_file, is_cached in zip(remaining, cached) if not is_cached]
+        print(f"Feature cache {cache.directory}: {len(remaining) - len(todo_files)} subjects cached, "
+              f"{len(todo_files)} to extract")
+
+    if method == "nilearn":
+        print(f"Processing {len(todo_files)} subjects with n_jobs={n_jobs}")
+        results = _map_subjects(_voxelwise_subject, todo_files, n_jobs, plan,
+                                prefetch=prefetch, prefetch_max_bytes=prefetch_max_bytes)
+    elif method == "operator":
+        print(f"Processing {len(todo_files)} subjects in batches of {batch_size}")
+        operator = ExtractionOperator(plan, cache_dir=operator_cache_dir)
+        sub_imgs = prefetch_images(todo_files, prefetch, prefetch_max_bytes)
+        results = (operator.extract(list(itertools.islice(sub_imgs, batch_size)))
+                   for _ in range(0, len(todo_files), batch_size))
+    else:
+        raise ValueError(f"Unknown extraction method {method}, use 'nilearn' or 'operator'")
+    rows = (row for sub_data_rs in results for row in sub_data_rs.reshape(-1, plan.n_features))
+
+    for idx in range(len(remaining)):  # rows are written in subject order
+        if cache_dir is not None and cached[idx]:
+            sub_data_rs = cache.get(keys[idx])
+        else:
+            sub_data_rs = next(rows)
+            if cache_dir is not None:
+                cache.save(keys[idx], sub_data_rs)
+        writer.write(sub_data_rs)
+        print(f"{writer.n_done} of {len(sub_files)} subjects done")
+    data_resampled = writer.data if output_file is None else np.load(output_file, mmap_mode='r')
 
     print("\n *** Feature extraction done ***")
 
     # renaming the columns and convering to dataframe
-    data_resampled = pd.DataFrame(data_resampled)
+    data_resampled = pd.DataFrame(data_resampled, copy=False)
     data_resampled.rename(columns=lambda X: "f_" + str(X), inplace=True)
     print('Feature names:', data_resampled.columns)
 
@@ -115,17 +444,297 @@ def calculate_voxelwise_features(phenotype_file, mask_file, smooth_fwhm, resampl
     return data_resampled
 
 
+def _smoothing_cascade(smooth_fwhms, cascade=True):
+    """Smoothing steps as (fwhm, fwhm applied to the previous step) in increasing fwhm
+
+    Gaussian kernels add in quadrature, so with cascade=True a wider kernel is
+    applied on top of the previous (narrower) result with
+    sqrt(fwhm**2 - previous_fwhm**2). With cascade=False every fwhm is applied
+    to the original image (the previous step is then 0).
+    """
+    steps = []
+    previous = 0
+    for fwhm in sorted(set(smooth_fwhms)):
+        steps.append((fwhm, np.sqrt(fwhm ** 2 - previous ** 2) if cascade else fwhm))
+        previous = fwhm if cascade else 0
+    return steps
+
+
+def _multi_voxelwise_subject(sub_file, sub_img, plans, cascade):
+    print(f"\n-----Processing subject {sub_file}------")
+    # the subject image is read once for all configurations
+    print("sub affine original \n", sub_img.affine, sub_img.shape)
+
+    steps = _smoothing_cascade([fwhm for fwhm, _ in plans], cascade)
+    full_img, slices = None, None
+    if all(plan.crop for plan in plans.values()):
+        # a cascade step smooths the previous result, so the margins add up
+        radii = [_smoothing_radius(sub_img.affine, step_fwhm) for _, step_fwhm in steps]
+        margin = np.sum(radii, axis=0) if cascade else np.max(radii, axis=0)
+        slices = crop_slices(sub_img, list(plans.values()), margin)
+        dtype = next(iter(plans.values())).dtype  # the plans of a run share the dtype
+        full_img, sub_img = sub_img, crop_img(sub_img, slices, dtype)
+
+    features = {}
+    smoothed_img = sub_img
+    for smooth_fwhm, step_fwhm in steps:
+        smoothed_img = image.smooth_img(smoothed_img if cascade else sub_img, step_fwhm)
+        for (fwhm, resample_size), plan in plans.items():
+            if fwhm == smooth_fwhm:
+                features[(fwhm, resample_size)] = plan.resample(smoothed_img, full_img, slices)
+    return features
+
+
+def _operator_subjects(operators, sub_files, batch_size, prefetch, prefetch_max_bytes):
+    """Features per configuration of every subject, extracted in batches by the sparse operators"""
+    sub_imgs = prefetch_images(sub_files, prefetch, prefetch_max_bytes)
+    for _ in range(0, len(sub_files), batch_size):
+        batch = list(itertools.islice(sub_imgs, batch_size))
+        data = {config: operator.extract(batch) for config, operator in operators.items()}
+        for idx in range(len(batch)):
+            yield {config: config_data[idx] for config, config_data in data.items()}
+
+
+def calculate_multi_voxelwise_features(phenotype_file, mask_file, configs, cascade_smoothing=True, n_jobs=1,
+                                       dtype=np.float64, cache_dir=None, hash_content=True, output_files=None,
+                                       prefetch=0, prefetch_max_bytes=None, method="nilearn",
+                                       operator_cache_dir=None, batch_size=32):
+    """Calculate voxelwise features for several smoothing/resampling configurations
+
+    Every subject image is read once and all (smooth_fwhm, resample_size)
+    configurations are computed from it. With cascade_smoothing a larger FWHM
+    is derived from the next smaller one (e.g. S8 from S4); this matches
+    smoothing the original image up to the kernel truncation (differences
+    are below 1e-4 of the image maximum).
+
+    Args:
+        phenotype_file (csv or txt): A csv or text file with path to subject images
+        mask_file (nii): The GM mask file to be used to extract features
+        configs (list): List of (smooth_fwhm, resample_size) pairs
+        cascade_smoothing (bool): Derive larger smoothing kernels from smaller ones
+        n_jobs (int): Number of processes to spread the subjects over (-1 for all cpus)
+        dtype (dtype): Floating point type of the features
+        cache_dir (str, optional): Directory of the per subject FeatureCache, subjects
+            cached for all configurations are not read again
+        hash_content (bool): Identify subject files by content hash (True) or by
+            path, size and modification time (False)
+        output_files (dict, optional): .npy file per (smooth_fwhm, resample_size) pair
+            the features are streamed into, an interrupted run resumes from them
+        prefetch (int): Number of subject images loaded ahead on a background thread
+            (see prefetch_images), used with n_jobs=1 and by the operator method
+        prefetch_max_bytes (int, optional): Memory cap of the prefetched images
+        method (str): "nilearn" smooths and resamples every subject image,
+            "operator" applies one precompiled sparse ExtractionOperator per
+            configuration to batches of subjects (cascade_smoothing and n_jobs
+            are not used)
+        operator_cache_dir (str, optional): Directory to cache the sparse operators
+        batch_size (int): Number of subjects per sparse product (operator method)
+
+    Returns:
+        data_resampled (dict): pandas dataframe of features (N subjects by M features)
+            for every (smooth_fwhm, resample_size) pair
+    """
+    phenotype = pd.read_csv(phenotype_file, header=None)
+    print(phenotype.shape)
+    print(phenotype.head())
+
+    plans = {}
+    for smooth_fwhm, resample_size in configs:
+        plans[(smooth_fwhm, resample_size)] = ExtractionPlan(mask_file, smooth_fwhm, resample_size, dtype=dtype)
+        print(f"S{smooth_fwhm}_R{resample_size}: number of voxels in the mask:", plans[(smooth_fwhm, resample_size)].n_features)
+
+    sub_files = _existing_files(phenotype)
+    if method == "nilearn" and cascade_smoothing:
+        method = "nilearn.cascade"
+    elif method not in ("nilearn", "operator"):
+        raise ValueError(f"Unknown extraction method {method}, use 'nilearn' or 'operator'")
+    writers = {}
+    for config, plan in plans.items():
+        if output_files is not None:  # stream into memmaps, resume a previous run
+            params = f"S{plan.smooth_fwhm}_R{plan.resample_size}.{method}.{plan.mask_hash}"
+            writers[config] = MemmapFeatureWriter(output_files[config], sub_files, plan.n_features, plan.dtype,
+                                                  params=params)
+        else:
+            writers[config] = _ArrayFeatureWriter(len(sub_files), plan.n_features, plan.dtype)
+    n_done = min(writer.n_done for writer in writers.values())
+    for writer in writers.values():
+        writer.n_done = n_done  # continue all configurations from the same subject
+    remaining = sub_files[n_done:]
+
+    todo_files = remaining
+    if cache_dir is not None:
+        caches = {config: FeatureCache(cache_dir, plan, method=method) for config, plan in plans.items()}
+        keys = [file_key(sub_file, hash_content) for sub_file in remaining]
+        cached = [all(cache.has(key) for cache in caches.values()) for key in keys]
+        todo_files = [sub_file for sub_file, is_cached in zip(remaining, cached) if not is_cached]
+        print(f"Feature cache: {len(remaining) - len(todo_files)} subjects cached, {len(todo_files)} to extract")
+
+    if method == "operator":
+        print(f"Processing {len(todo_files)} subjects in batches of {batch_size}")
+        operators = {config: ExtractionOperator(plan, cache_dir=operator_cache_dir) for config, plan in plans.items()}
+        results = _operator_subjects(operators, todo_files, batch_size, prefetch, prefetch_max_bytes)
+    else:
+        print(f"Processing {len(todo_files)} subjects with n_jobs={n_jobs}")
+        results = _map_subjects(_multi_voxelwise_subject, todo_files, n_jobs, plans, cascade_smoothing,
+                                prefetch=prefetch, prefetch_max_bytes=prefetch_max_bytes)
+    for idx in range(len(remaining)):  # rows are written in subject order
+        if cache_dir is not None and cached[idx]:
+            features = {config: cache.get(keys[idx]) for config, cache in caches.items()}
+        else:
+            features = next(results)
+            if cache_dir is not None:
+                for config, sub_data_rs in features.items():
+                    caches[config].save(keys[idx], sub_data_rs)
+        for config, sub_data_rs in features.items():
+            writers[config].write(sub_data_rs)
+        print(f"{n_done + idx + 1} of {len(sub_files)} subjects done")
+
+    print("\n *** Feature extraction done ***")
+
+    data_resampled = {}
+    for config, writer in writers.items():
+        data = writer.data if output_files is None else np.load(output_files[config], mmap_mode='r')
+        data_resampled[config] = pd.DataFrame(data, copy=False).rename(columns=lambda X: "f_" + str(X))
+        print(f"The size of the feature space S{config[0]}_R{config[1]} is {data_resampled[config].shape}")
+
+    return data_resampled
 
-def calculate_parcelwise_features(phenotype_file, mask_dir, num_parcels):
+
+class AtlasPlan:
+    """Parcelwise feature extraction setup for one atlas
+
+    The voxels of every parcel are found once per atlas geometry instead of
+    scanning the whole atlas once per parcel and subject: a stable sort of the
+    voxels by label makes each parcel a contiguous slice, in the same order
+    as np.where(atlas == label). Parcel means are then taken over these
+    slices, so the features are identical to the per parcel loop.
+
+    The atlas is resampled once per subject geometry (affine + shape). With
+    cache_dir the resampled atlases are also kept on disk as .npy files named
+    after the atlas content hash and the target geometry, and reused across
+    runs.
+
+    Args:
+        mask_dir (nii): The atlas file (parcel labels 1 to num_parcels)
+        num_parcels (int): Number of parcels
+        cache_dir (str, optional): Directory to keep resampled atlases across runs
+    """
+
+    def __init__(self, mask_dir, num_parcels, cache_dir=None):
+        self.mask_dir = mask_dir
+        self.mask_img = nib.load(mask_dir)  # lazy, loaded once per run (or per worker)
+        self.num_parcels = int(num_parcels)
+        self.cache_dir = cache_dir
+        self._atlas_hash = None
+        self._atlas_imgs = {}  # resampled atlas per geometry key
+        self._label_indices = {}  # (voxel order, sorted labels, parcel bounds) per geometry key
+
+    def _cache_file(self, sub_img):
+        if self._atlas_hash is None:
+            self._atlas_hash = file_key(self.mask_dir)
+        key = hashlib.sha1(self._atlas_hash.encode())
+        key.update(np.ascontiguousarray(sub_img.affine, dtype=np.float64).tobytes())
+        key.update(np.asarray(sub_img.shape[:3], dtype=np.int64).tobytes())
+        return os.path.join(self.cache_dir, f"atlas_{self.num_parcels}.{key.hexdigest()}.npy")
+
+    def atlas_img(self, sub_img):
+        """Atlas on the grid of sub_img"""
+        if np.array_equal(sub_img.affine, self.mask_img.affine):
+            print("Subject and mask have same affine")
+            return self.mask_img
+
+        key = _geometry_key(sub_img)
+        if key not in self._atlas_imgs:
+            cache_file = self._cache_file(sub_img) if self.cache_dir is not None else None
+            if cache_file is not None and os.path.isfile(cache_file):
+                print("Resampled atlas loaded from", cache_file)
+                atlas_img = nib.Nifti1Image(np.load(cache_file), sub_img.affine)
+            else:
+                atlas_img = nilearn.image.resample_to_img(self.mask_img, sub_img, interpolation='linear')
+                if cache_file is not None:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    with atomic_open(cache_file) as f:
+                        np.save(f, np.asanyarray(atlas_img.dataobj))
+            self._atlas_imgs[key] = atlas_img
+        return self._atlas_imgs[key]
+
+    def label_index(self, sub_img):
+        """Voxels sorted by label, their labels (0 outside the parcels) and the parcel bounds in that order"""
+        key = _geometry_key(sub_img)
+        if key not in self._label_indices:
+            atlas = self.atlas_img(sub_img).get_fdata().reshape(-1)
+            # only voxels exactly equal to a label belong to its parcel
+            is_label = (atlas == np.floor(atlas)) & (atlas >= 1) & (atlas <= self.num_parcels)
+            labels = np.where(is_label, atlas, 0).astype(np.intp)
+            order = np.argsort(labels, kind='stable')
+            bounds = np.cumsum(np.bincount(labels, minlength=self.num_parcels + 1))
+            self._label_indices[key] = (order, labels[order], bounds)
+        return self._label_indices[key]
+
+    def extract(self, sub_img, dtype=np.float64, sub_data=None):
+        """Mean of the non-zero voxels of every parcel of one subject (0 if there are none)
+
+        Args:
+            sub_img (Nifti1Image): subject image
+            dtype (dtype): Floating point type of the image data and features
+            sub_data (ndarray, optional): flat image data with zeros replaced by NaN
+                (see _parcel_data), shared when several atlases are extracted
+
+        Returns:
+            sub_data_parcels (ndarray): 1D array of num_parcels features
+        """
+        order, labels, bounds = self.label_index(sub_img)
+        if sub_data is None:
+            sub_data = _parcel_data(sub_img, dtype)
+        sub_data = sub_data[order]
+
+        sub_data_parcels = np.zeros(self.num_parcels, dtype=sub_data.dtype)
+        num_valid = np.bincount(labels[~np.isnan(sub_data)], minlength=self.num_parcels + 1)
+        for num in np.flatnonzero(num_valid[1:]) + 1:
+            # mean the data of the parcel voxels to get GM volume
+            sub_data_parcels[num - 1] = np.nanmean(sub_data[bounds[num - 1]:bounds[num]])
+        return sub_data_parcels
+
+
+def _parcel_data(sub_img, dtype):
+    """Flat (C-order) subject data with zeros replaced by NaN"""
+    sub_data = sub_img.get_fdata(dtype=dtype).reshape(-1)
+    sub_data[sub_data == 0] = np.nan  # replace zeros with Nan
+    return sub_data
+
+
+def _parcelwise_subject(sub_file, sub_img, atlases, dtype):
+    print(f'\nProcessing subject {sub_file}')
+    sub_data = _parcel_data(sub_img, dtype)  # read once for all atlases
+    sub_data_parcels = []
+    for atlas in atlases:
+        print(sub_file, sub_img.affine, atlas.mask_img.affine)
+        sub_data_parcels.append(atlas.extract(sub_img, dtype, sub_data))
+    return sub_data_parcels
+
+
+def calculate_parcelwise_features(phenotype_file, mask_dir, num_parcels, n_jobs=1, dtype=np.float64, prefetch=0,
+                                  prefetch_max_bytes=None, atlas_cache_dir=None):
     """Calculate parcelwise features for the subjects
 
+    Several atlases can be given as lists of files and parcel numbers, every
+    subject image is then read once for all of them.
+
     Args:
         phenotype_file (csv or text): A csv or text file with path to subject images
-        mask_dir (_type_): The GM mask file to be used to extract features
-        num_parcels (_type_): Number of parcels
+        mask_dir (str or list): The atlas file(s) to be used to extract features
+        num_parcels (int or list): Number of parcels (of every atlas)
+        n_jobs (int): Number of processes to spread the subjects over (-1 for all cpus)
+        dtype (dtype): Floating point type of the subject images and features
+        prefetch (int): Number of subject images loaded ahead on a background thread
+            (see prefetch_images), used with n_jobs=1
+        prefetch_max_bytes (int, optional): Memory cap of the prefetched images
+        atlas_cache_dir (str, optional): Directory to keep the atlases resampled to
+            subject geometries across runs
     
     Returns:
-        data_parcels (dataframe): pandas dataframe of features (N subjects by M parcels)
+        data_parcels (dataframe): pandas dataframe of features (N subjects by M parcels),
+            a dict of them keyed by num_parcels if lists were given
     """    
 
     phenotype = pd.read_csv(phenotype_file, header=None)
@@ -143,46 +752,34 @@ def calculate_parcelwise_features(phenotype_file, mask_dir, num_parcels):
     print(phenotype.head())
 #    phenotype = phenotype.iloc[0:15]
 
-    data_parcels = [] #np.array([])  # array to save resampled features from subjects mri
-    count = 0
-
-    for index, row in phenotype.iterrows(): # iterate over each row
-        sub_file = row.values[0]
-
-        if os.path.exists(sub_file):
-            print(f'\nProcessing subject number {count}')
-            sub_img = nib.load(sub_file)  # load subject image
-            mask_img = nib.load(mask_dir)  # load mask image
-            print ('Subject and mask image loaded')
-            print(sub_file, sub_img.affine, mask_img.affine)
-
-            sub_data = sub_img.get_fdata()
-            sub_data[sub_data == 0] = np.nan # replace zeros with Nan
-            sub_data_parcels = []
-
-            if not np.array_equal(sub_img.affine, mask_img.affine):
-                mask_img = nilearn.image.resample_to_img(mask_img, sub_img, interpolation='linear')
-            else:
-                print("Subject and mask have same affine")
-
-            for num in range(1, int(num_parcels) + 1):
-                itemindex = np.where(mask_img.get_fdata() == num)  # get indices from the mask for a parcel
-                sub_mat = sub_data[itemindex]
-
-                if np.all(np.isnan(sub_mat)):
-                    sub_agg = 0
-                else:
-                    sub_agg = np.nanmean(sub_mat) # mean the data from the indices to get GM volume
-                sub_data_parcels.append(sub_agg)
-
-            data_parcels.append(sub_data_parcels)
-            print(len(data_parcels))
-            count = count + 1
+    multi_atlas = isinstance(mask_dir, (list, tuple))
+    mask_dirs = list(mask_dir) if multi_atlas else [mask_dir]
+    nums_parcels = list(num_parcels) if multi_atlas else [num_parcels]
+    if len(mask_dirs) != len(nums_parcels):
+        raise ValueError("Give the number of parcels of every atlas")
+    # parcels are indexed once per run (or per worker)
+    atlases = [AtlasPlan(atlas_file, num, cache_dir=atlas_cache_dir) for atlas_file, num in zip(mask_dirs, nums_parcels)]
+    print('Mask image loaded')
+
+    sub_files = _existing_files(phenotype)
+    print(f'Processing {len(sub_files)} subjects with n_jobs={n_jobs}')
+
+    data_parcels = [[] for _ in atlases]  # features from subjects mri per atlas
+    results = _map_subjects(_parcelwise_subject, sub_files, n_jobs, atlases, np.dtype(dtype),
+                            prefetch=prefetch, prefetch_max_bytes=prefetch_max_bytes)
+    for sub_data_parcels in results:
+        for atlas_parcels, sub_atlas_parcels in zip(data_parcels, sub_data_parcels):
+            atlas_parcels.append(sub_atlas_parcels)
+        print(len(data_parcels[0]))
 
     print('\n *** Feature extraction done ***')
-    data_parcels = pd.DataFrame(data_parcels)
-    data_parcels.rename(columns=lambda X :'f_' + str(X), inplace=True)
-    print(data_parcels.columns)
-
-    print('final dataframe shape', data_parcels.shape)
-    return data_parcels
+    for idx, atlas_parcels in enumerate(data_parcels):
+        atlas_parcels = pd.DataFrame(np.array(atlas_parcels, dtype=dtype).reshape(len(atlas_parcels), -1))
+        atlas_parcels.rename(columns=lambda X :'f_' + str(X), inplace=True)
+        print(atlas_parcels.columns)
+        print('final dataframe shape', atlas_parcels.shape)
+        data_parcels[idx] = atlas_parcels
+
+    if multi_atlas:
+        return dict(zip(nums_parcels, data_parcels))
+    return data_parcels[0]
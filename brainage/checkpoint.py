@@ -0,0 +1,103 @@
+import os
+import pickle
+import functools
+from sklearn import ensemble
+import skrvm
+import glmnet
+from .cache_utils import dump_pickle, fit_key
+
+CHECKPOINT_DIR_ENV = 'BRAINAGE_CHECKPOINT_DIR'
+
+
+def set_checkpoint_dir(checkpoint_dir):
+    """Enable fold and fit checkpoints for this process and its workers
+
+    As with set_preprocessing_cache, the directory is passed through an
+    environment variable so that process pools see it as well. Set it
+    before the pools are started.
+
+    Args:
+        checkpoint_dir (str): directory of the checkpoints, None disables them
+    """
+    if checkpoint_dir is None:
+        os.environ.pop(CHECKPOINT_DIR_ENV, None)
+    else:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        os.environ[CHECKPOINT_DIR_ENV] = os.path.abspath(checkpoint_dir)
+
+
+def checkpoint_dir():
+    """Directory of the checkpoints, None if they are disabled"""
+    return os.environ.get(CHECKPOINT_DIR_ENV)
+
+
+def load_or_run(checkpoint_name, func, *args, **kwargs):
+    """func(*args, **kwargs), loaded from the checkpoint directory if an earlier run stored it
+
+    Args:
+        checkpoint_name (str): file name of the result in the checkpoint
+            directory, unique for the unit of work and its inputs (not
+            used while checkpoints are disabled)
+        func (callable): computes the result
+
+    Returns:
+        result: the stored or the computed result (stored if checkpoints are enabled)
+    """
+    cache_dir = checkpoint_dir()
+    if cache_dir is None:
+        return func(*args, **kwargs)
+
+    checkpoint_file = os.path.join(cache_dir, checkpoint_name)
+    if os.path.isfile(checkpoint_file):
+        with open(checkpoint_file, 'rb') as f:
+            return pickle.load(f)
+    result = func(*args, **kwargs)
+    dump_pickle(result, checkpoint_file)
+    return result
+
+
+def checkpointed_fit(fit):
+    """Decorator storing the fitted state of an estimator in the checkpoint directory
+
+    The fitted state is stored under a key of the class, its parameters,
+    the training data and the target (see cache_utils.fit_key), so every fit
+    of a cross-validation (inner folds, grid points, the final refit) is a
+    checkpoint of its own. A rerun of a preempted job loads the fits that
+    finished instead of computing them again. Without a checkpoint
+    directory fit is called as is.
+    """
+    @functools.wraps(fit)
+    def checkpointed(self, X, y, *args, **kwargs):
+        cache_dir = checkpoint_dir()
+        if cache_dir is None:
+            return fit(self, X, y, *args, **kwargs)
+
+        checkpoint_file = os.path.join(cache_dir, f"{type(self).__name__}.{fit_key(self, X, y)}.pkl")
+        if os.path.isfile(checkpoint_file):
+            with open(checkpoint_file, 'rb') as f:
+                self.__dict__.update(pickle.load(f))
+            return self
+
+        fit(self, X, y, *args, **kwargs)
+        dump_pickle(self.__dict__, checkpoint_file)
+        return self
+    return checkpointed
+
+
+# the external models with checkpointed fits, keeping their class names (and so their julearn step names)
+class RandomForestRegressor(ensemble.RandomForestRegressor):
+    @checkpointed_fit
+    def fit(self, X, y, sample_weight=None):
+        return super().fit(X, y, sample_weight=sample_weight)
+
+
+class RVR(skrvm.RVR):
+    @checkpointed_fit
+    def fit(self, X, y):
+        return super().fit(X, y)
+
+
+class ElasticNet(glmnet.ElasticNet):
+    @checkpointed_fit
+    def fit(self, X, y, sample_weight=None, relative_penalties=None, groups=None):
+        return super().fit(X, y, sample_weight=sample_weight, relative_penalties=relative_penalties, groups=groups)
@@ -0,0 +1,313 @@
+import copy
+import pickle
+import warnings
+import numpy as np
+import pandas as pd
+import glmnet
+import skrvm
+from sklearn import ensemble, gaussian_process, linear_model
+from sklearn.decomposition import PCA
+from sklearn.feature_selection import VarianceThreshold
+from sklearn.kernel_ridge import KernelRidge
+from sklearn.metrics.pairwise import pairwise_kernels
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from .gram_pca import GramPCA
+from .zscore import ZScore
+from .glmnet_mix import ElasticNetMix
+from .xgboost_adapted import XGBoostAdapted
+
+_LINEAR_MODELS = (glmnet.ElasticNet, linear_model.LinearRegression, linear_model.Ridge, linear_model.ElasticNet)
+
+
+class CompactModel:
+    """Predict-only model from the state an exported pipeline needs to predict
+
+    The state is a dict of plain numpy arrays and numbers (see
+    export_compact): the input columns, the preprocessing steps in order
+    and the model. Everything is computed in float64, matrices stored as
+    float32 are converted when used.
+
+    Args:
+        state (dict): state returned by export_compact(...).state
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def transform(self, X):
+        """Preprocessed X (the input of the model)
+
+        Args:
+            X (DataFrame or ndarray): m x p data, the columns of the training
+                data are selected from a DataFrame
+
+        Returns:
+            X (ndarray): m x k preprocessed data
+        """
+        feature_names = self.state['feature_names']
+        if feature_names is not None and hasattr(X, 'columns'):
+            X = X[feature_names]
+        X = np.asarray(X, dtype=np.float64)
+        for step in self.state['steps']:
+            X = _TRANSFORMS[step['kind']](step, X)
+        return X
+
+    def predict(self, X):
+        """Predictions of the exported pipeline
+
+        Args:
+            X (DataFrame or ndarray): m x p data
+
+        Returns:
+            y_pred (ndarray): m predictions
+        """
+        model = self.state['model']
+        return np.ravel(_PREDICTS[model['kind']](model, self.transform(X)))
+
+    def __repr__(self):
+        kinds = [step['kind'] for step in self.state['steps']] + [self.state['model']['kind']]
+        return f"CompactModel({' -> '.join(kinds)})"
+
+
+def _matrix(X):
+    return np.asarray(X, dtype=np.float64)
+
+
+def _transform_estimator(step, X):
+    return step['estimator'].transform(X)
+
+
+def _transform_pca(step, X):
+    X = (X - step['mean']) @ _matrix(step['components']).T
+    if step['whiten'] is not None:
+        X /= step['whiten']
+    return X
+
+
+_TRANSFORMS = {'select': lambda step, X: X[:, step['index']],
+               'scale': lambda step, X: (X - step['mean']) / step['scale'],
+               'pca': _transform_pca,
+               'estimator': _transform_estimator}
+
+
+def _predict_forest(model, X):
+    # sklearn compares float32 features to the float64 thresholds
+    X = X.astype(np.float32)
+    rows = np.arange(X.shape[0])
+    nodes = np.repeat(model['roots'][:, np.newaxis], X.shape[0], axis=1)
+    left, right = model['children_left'], model['children_right']
+    while True:
+        inner = left[nodes] != -1
+        if not inner.any():
+            break
+        go_left = X[rows, model['feature'][nodes]] <= model['threshold'][nodes]
+        nodes = np.where(inner, np.where(go_left, left[nodes], right[nodes]), nodes)
+    return model['value'][nodes].mean(axis=0)
+
+
+def _predict_xgboost(model, X):
+    import xgboost
+    booster = xgboost.Booster()
+    booster.load_model(bytearray(model['booster'].tobytes()))
+    return booster.predict(xgboost.DMatrix(X), iteration_range=(0, int(model['n_iterations'])))
+
+
+def _predict_gpr(model, X):
+    K = model['kernel'](X, _matrix(model['X']))
+    return (K @ model['alpha']) * model['y_std'] + model['y_mean']
+
+
+def _predict_kernel(model, X):
+    K = pairwise_kernels(X, _matrix(model['X']), metric=model['kernel'], gamma=model['gamma'],
+                         degree=model['degree'], coef0=model['coef0'], filter_params=True)
+    return K @ model['dual_coef'] + model['intercept']
+
+
+_PREDICTS = {'linear': lambda model, X: X @ model['coef'] + model['intercept'],
+             'kernel': _predict_kernel,
+             'gpr': _predict_gpr,
+             'forest': _predict_forest,
+             'xgboost': _predict_xgboost,
+             'estimator': lambda model, X: model['estimator'].predict(X)}
+
+
+def _export_step(step, dtype):
+    if isinstance(step, VarianceThreshold):
+        return {'kind': 'select', 'index': step.get_support(indices=True)}
+    if isinstance(step, StandardScaler):
+        n_features = step.n_features_in_
+        mean = np.zeros(n_features) if step.mean_ is None else step.mean_
+        scale = np.ones(n_features) if step.scale_ is None else step.scale_
+        return {'kind': 'scale', 'mean': _matrix(mean), 'scale': _matrix(scale)}
+    if isinstance(step, ZScore) and step.axis == 0:
+        return {'kind': 'scale', 'mean': _matrix(step.mean_), 'scale': _matrix(step.std_)}
+    if isinstance(step, (PCA, GramPCA)):
+        whiten = np.sqrt(step.explained_variance_) if getattr(step, 'whiten', False) else None
+        return {'kind': 'pca', 'mean': _matrix(step.mean_), 'components': step.components_.astype(dtype),
+                'whiten': whiten}
+    return {'kind': 'estimator', 'estimator': step}
+
+
+def _kernel_model(X_fit, dual_coef, kernel, gamma, degree, coef0, intercept, dtype):
+    """Kernel expansion, folded into a linear model for linear and degree 1 polynomial kernels"""
+    X_fit, dual_coef = _matrix(X_fit), _matrix(dual_coef)
+    if kernel in ('poly', 'polynomial'):
+        kernel = 'polynomial'
+        gamma = 1.0 / X_fit.shape[1] if gamma is None else gamma
+    if kernel == 'linear' or (kernel == 'polynomial' and degree == 1):
+        scale, offset = (1.0, 0.0) if kernel == 'linear' else (gamma, coef0)
+        return {'kind': 'linear', 'coef': scale * (X_fit.T @ dual_coef),
+                'intercept': offset * dual_coef.sum() + intercept}
+    return {'kind': 'kernel', 'X': X_fit.astype(dtype), 'dual_coef': dual_coef, 'kernel': kernel,
+            'gamma': gamma, 'degree': degree, 'coef0': coef0, 'intercept': intercept}
+
+
+def _export_model(model, dtype):
+    if isinstance(model, ElasticNetMix):
+        index = 0 if model.predict_alpha is None else list(model.alphas).index(model.predict_alpha)
+        model = model.estimators_[index]
+
+    if isinstance(model, _LINEAR_MODELS):
+        return {'kind': 'linear', 'coef': _matrix(model.coef_).ravel(),
+                'intercept': float(np.ravel(model.intercept_)[0])}
+    if isinstance(model, KernelRidge) and not callable(model.kernel):
+        return _kernel_model(model.X_fit_, model.dual_coef_, model.kernel, model.gamma, model.degree,
+                             model.coef0, 0.0, dtype)
+    if isinstance(model, skrvm.RVR) and not callable(model.kernel):
+        # skrvm appends a column of ones for the bias, coef1 is the gamma of the kernel
+        n_relevance = len(model.relevance_)
+        bias = model.m_[n_relevance] if model.bias_used else 0.0
+        return _kernel_model(model.relevance_, model.m_[:n_relevance], model.kernel, model.coef1,
+                             model.degree, model.coef0, bias, dtype)
+    if isinstance(model, gaussian_process.GaussianProcessRegressor):
+        return {'kind': 'gpr', 'X': model.X_train_.astype(dtype), 'alpha': _matrix(model.alpha_).ravel(),
+                'kernel': model.kernel_, 'y_mean': _matrix(model._y_train_mean),
+                'y_std': _matrix(model._y_train_std)}
+    if isinstance(model, ensemble.RandomForestRegressor):
+        trees = [estimator.tree_ for estimator in model.estimators_]
+        offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+
+        def children(tree, offset, side):
+            index = getattr(tree, side)
+            return np.where(index == -1, -1, index + offset)
+
+        return {'kind': 'forest', 'roots': offsets[:-1].astype(np.int64),
+                'children_left': np.concatenate([children(tree, offset, 'children_left')
+                                                 for tree, offset in zip(trees, offsets)]),
+                'children_right': np.concatenate([children(tree, offset, 'children_right')
+                                                  for tree, offset in zip(trees, offsets)]),
+                # leaves have feature -2, any column does as their comparison is not used
+                'feature': np.concatenate([np.maximum(tree.feature, 0) for tree in trees]),
+                'threshold': np.concatenate([tree.threshold for tree in trees]),
+                'value': np.concatenate([tree.value[:, 0, 0] for tree in trees])}
+    if isinstance(model, XGBoostAdapted):
+        if hasattr(model, 'booster_'):
+            booster, n_iterations = model.booster_, model.best_iteration_
+        else:  # fitted before the booster was kept directly
+            booster = model._xgbregressor.get_booster()
+            n_iterations = getattr(model._xgbregressor, 'best_iteration', None)
+        n_iterations = booster.num_boosted_rounds() if n_iterations is None else n_iterations + 1
+        return {'kind': 'xgboost', 'booster': np.frombuffer(booster.save_raw(), dtype=np.uint8),
+                'n_iterations': n_iterations}
+    return {'kind': 'estimator', 'estimator': model}
+
+
+def _pipeline_steps(model):
+    """(input column names, fitted preprocessing steps, fitted model) of a julearn or sklearn pipeline"""
+    if hasattr(model, 'dataframe_pipeline'):  # julearn's ExtendedDataFramePipeline
+        if model.confounds or model.y_transformer is not None:
+            raise ValueError('Pipelines with confound removal or target transformers cannot be exported')
+        steps = [step for _, step in model.dataframe_pipeline.steps]
+        # julearn wraps the preprocessing steps, the wrapped transformer is fitted in place
+        steps = [step.transformer if type(step).__name__ == 'DataFrameWrapTransformer' else step
+                 for step in steps]
+        feature_names = list(model.col_name_mapper_)
+    elif isinstance(model, Pipeline):
+        steps = [step for _, step in model.steps if step not in (None, 'passthrough')]
+        feature_names = getattr(model, 'feature_names_in_', None)
+    else:
+        steps = [model]
+        feature_names = getattr(model, 'feature_names_in_', None)
+    feature_names = None if feature_names is None else list(feature_names)
+    return feature_names, steps[:-1], steps[-1]
+
+
+def export_compact(model, X=None, dtype=np.float32, atol=1e-2):
+    """Predict-only CompactModel of a fitted (julearn or sklearn) pipeline
+
+    Only what prediction needs is kept: the indices kept by
+    VarianceThreshold, the z-scoring mean and scale, the PCA mean and
+    components, and of the model its coefficients (linear and degree 1
+    polynomial kernels of KernelRidge and RVR are folded into them), kernel
+    expansion (polynomial kernels, GPR: training data, dual coefficients,
+    fitted kernel) or trees (random forest node arrays, xgboost booster).
+    Other steps are kept as they are. Optimizer state, training targets
+    and Cholesky factors are dropped.
+
+    The large matrices (PCA components, the training data of kernel
+    models) are stored as dtype only if that is checked to be safe: X is
+    given and the predictions on X stay within atol of the pipeline's.
+    Otherwise they are kept in float64.
+
+    Args:
+        model: fitted julearn ExtendedDataFramePipeline, sklearn Pipeline or
+            estimator (without confound removal)
+        X (DataFrame or ndarray, optional): data to check the predictions on
+        dtype (dtype): dtype of the large matrices if safe
+        atol (float): tolerance of the check (years)
+
+    Returns:
+        compact (CompactModel): the predict-only model
+    """
+    feature_names, steps, estimator = _pipeline_steps(model)
+
+    def export(dtype):
+        return CompactModel({'feature_names': feature_names, 'steps': [_export_step(s, dtype) for s in steps],
+                             'model': _export_model(estimator, dtype)})
+
+    if X is None or np.dtype(dtype) == np.float64:
+        return export(np.float64)
+    compact = export(dtype)
+    difference = np.max(np.abs(compact.predict(X) - np.ravel(model.predict(X))))
+    if difference <= atol:
+        return compact
+    warnings.warn(f'{dtype} predictions differ by {difference:.3g} (> {atol}), keeping float64')
+    return export(np.float64)
+
+
+def compact_models(models, X=None, dtype=np.float32, atol=1e-2):
+    """Replace the pipelines in saved models or scores with CompactModels
+
+    Walks the dicts of the .models files ({fold: {model name: pipeline}})
+    and the 'estimator' column of .scores DataFrames, see export_compact
+    for the arguments.
+
+    Returns:
+        compact: the same structure with CompactModels
+    """
+    if isinstance(models, CompactModel):
+        return models
+    if isinstance(models, dict):
+        return {key: compact_models(value, X, dtype, atol) for key, value in models.items()}
+    if isinstance(models, pd.DataFrame):
+        if 'estimator' not in models.columns:
+            return models
+        models = models.copy()
+        models['estimator'] = [export_compact(model, X, dtype, atol) for model in models['estimator']]
+        return models
+    if hasattr(models, 'predict'):
+        return export_compact(models, X, dtype, atol)
+    return copy.deepcopy(models)
+
+
+def save_compact(models, filename):
+    """Save CompactModels (or a structure of them, see compact_models)"""
+    with open(filename, 'wb') as f:
+        pickle.dump(models, f, protocol=4)
+
+
+def load_compact(filename):
+    """Load CompactModels saved by save_compact"""
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
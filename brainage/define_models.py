@@ -2,9 +2,8 @@ import xgboost as xgb
 from skrvm import RVR
 from glmnet import ElasticNet
 import sklearn.gaussian_process as gp
-from sklearn.kernel_ridge import KernelRidge
 from sklearn.decomposition import PCA
-from brainage import XGBoostAdapted
+from brainage import XGBoostAdapted, KernelRidge, GaussianProcessRegressor
 from sklearn.feature_selection import VarianceThreshold
     
 def define_models():
@@ -12,6 +11,7 @@ def define_models():
     rvr_linear = RVR()
     rvr_poly = RVR()
     kernel_ridge = KernelRidge()
+    gauss = GaussianProcessRegressor()
     lasso = ElasticNet(alpha=1, standardize=False)
     elasticnet = ElasticNet(alpha=0.5, standardize=False)
     ridge = ElasticNet(alpha=0, standardize=False)
@@ -19,7 +19,7 @@ def define_models():
     pca = PCA(n_components=None)  # max as many components as sample size
 
 
-    model_list = [ridge, 'rf', rvr_linear, kernel_ridge, 'gauss', lasso, elasticnet, rvr_poly, xgb]
+    model_list = [ridge, 'rf', rvr_linear, kernel_ridge, gauss, lasso, elasticnet, rvr_poly, xgb]
     model_para_list = [
                     {'variancethreshold__threshold': var_threshold, 'elasticnet__random_state': rand_seed},
 
@@ -35,8 +35,9 @@ def define_models():
                     'kernelridge__kernel': 'polynomial', 'kernelridge__degree': [1, 2], 'cv': 5},
 
                     {'variancethreshold__threshold': var_threshold,
-                    'gauss__kernel': gp.kernels.RBF(10.0, (1e-7, 10e7)), 'gauss__n_restarts_optimizer': 100,
-                    'gauss__normalize_y': True, 'gauss__random_state': rand_seed},
+                    'gaussianprocessregressor__kernel': gp.kernels.RBF(10.0, (1e-7, 10e7)),
+                    'gaussianprocessregressor__n_restarts_optimizer': 100,
+                    'gaussianprocessregressor__normalize_y': True, 'gaussianprocessregressor__random_state': rand_seed},
 
                     {'variancethreshold__threshold': var_threshold, 'elasticnet__random_state': rand_seed},
 
@@ -51,3 +52,30 @@ def define_models():
                     'xgboostadapted__random_seed': rand_seed, 'cv': 5}]  # 'search_params':{'n_jobs': 5}]
                     
     return model_list, model_para_list
+
+
+def get_step(model, *names):
+    """Step of a saved (julearn) pipeline under the first of names it has
+
+    The gauss and rf steps are named after the parallel and checkpointed
+    classes (gaussianprocessregressor, randomforestregressor); models saved
+    before keep the old names (gauss, rf). Pass the new name first.
+    """
+    for name in names[:-1]:
+        try:
+            return model[name]
+        except KeyError:
+            pass
+    return model[names[-1]]
+
+
+def glmnet_model(model):
+    """glmnet ElasticNet of a saved ridge, lasso or elasticnet pipeline
+
+    The glmnet model saves the three as ElasticNetMix pipelines predicting
+    with their mixing value, the elasticnet model as ElasticNet pipelines.
+    """
+    model = get_step(model, 'elasticnet', 'elasticnetmix')
+    if hasattr(model, 'estimators_'):
+        model = model.estimators_[list(model.alphas).index(model.predict_alpha)]
+    return model
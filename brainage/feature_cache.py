@@ -0,0 +1,71 @@
+import os
+import hashlib
+import numpy as np
+from .cache_utils import atomic_open
+
+
+def file_key(sub_file, hash_content=True):
+    """Key identifying the content of a subject image file
+
+    Args:
+        sub_file (str): path to the subject image
+        hash_content (bool): hash the file content (True) or only its path,
+            size and modification time (False, no read needed)
+
+    Returns:
+        key (str): hex digest
+    """
+    key = hashlib.sha1()
+    if hash_content:
+        with open(sub_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                key.update(block)
+    else:
+        stat = os.stat(sub_file)
+        key.update(f"{os.path.abspath(sub_file)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return key.hexdigest()
+
+
+class FeatureCache:
+    """Per subject voxelwise feature cache on disk
+
+    Features of one subject are stored as a .npy file named after the subject
+    file key (see file_key) in a directory specific to the extraction
+    parameters (smoothing, resampling, dtype, method) and the resampled mask.
+    New or changed subject files get a new key, so only those are extracted
+    again and a cohort matrix can be assembled from the cache.
+
+    Args:
+        cache_dir (str): root directory of the cache
+        plan (ExtractionPlan): plan the features are extracted with
+        method (str): extraction method ("nilearn" or "operator")
+    """
+
+    def __init__(self, cache_dir, plan, method="nilearn"):
+        params = f"S{plan.smooth_fwhm}_R{plan.resample_size}.{plan.dtype.name}.{method}.{plan.mask_hash}"
+        params_hash = hashlib.sha1(params.encode()).hexdigest()[:16]
+        self.directory = os.path.join(cache_dir, f"S{plan.smooth_fwhm}_R{plan.resample_size}.{params_hash}")
+        self.n_features = plan.n_features
+        self.dtype = plan.dtype
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def has(self, key):
+        return os.path.isfile(self._path(key))
+
+    def save(self, key, features):
+        with atomic_open(self._path(key)) as f:
+            np.save(f, np.asarray(features, dtype=self.dtype))
+
+    def get(self, key):
+        """Features of one cached subject"""
+        return np.load(self._path(key))
+
+    def load(self, keys):
+        """Cohort matrix (N subjects by M features) of the cached subjects in keys"""
+        data = np.empty((len(keys), self.n_features), dtype=self.dtype)
+        for row, key in enumerate(keys):
+            data[row] = self.get(key)
+        return data
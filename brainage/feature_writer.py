@@ -0,0 +1,67 @@
+import os
+import json
+import hashlib
+import numpy as np
+from .cache_utils import atomic_open
+
+
+class MemmapFeatureWriter:
+    """Stream subject features into a preallocated .npy file with resume support
+
+    The output (N subjects by M features) is created once as a memory-mapped
+    .npy file and rows are written as subjects finish, so the whole matrix
+    never has to be held in memory. After every row the memmap is flushed and
+    a progress sidecar (`output_file + '.progress.json'`) records the number of
+    finished subjects. A rerun with the same subjects and parameters (e.g. a
+    preempted HTCondor job) resumes after the last finished subject.
+
+    Args:
+        output_file (str): .npy file to write
+        sub_files (list): subject files, one row each in this order
+        n_features (int): number of features per subject
+        dtype (dtype): floating point type of the features
+        params (str): description of the extraction parameters, a change
+            restarts the extraction
+    """
+
+    def __init__(self, output_file, sub_files, n_features, dtype, params=""):
+        self.output_file = output_file
+        self.progress_file = output_file + '.progress.json'
+        shape = (len(sub_files), n_features)
+        self.run = {
+            'shape': list(shape),
+            'dtype': np.dtype(dtype).name,
+            'params': params,
+            'subjects': hashlib.sha1('\n'.join(sub_files).encode()).hexdigest(),
+        }
+
+        self.n_done = 0
+        progress = self._read_progress()
+        if progress is not None and progress['run'] == self.run and os.path.isfile(output_file):
+            self.data = np.lib.format.open_memmap(output_file, mode='r+')
+            self.n_done = progress['n_done']
+            print(f"Resuming {output_file} after {self.n_done} of {shape[0]} subjects")
+        else:
+            self.data = np.lib.format.open_memmap(output_file, mode='w+', dtype=dtype, shape=shape)
+            self._write_progress()
+
+    def _read_progress(self):
+        if not os.path.isfile(self.progress_file):
+            return None
+        with open(self.progress_file) as f:
+            return json.load(f)
+
+    def _write_progress(self):
+        with atomic_open(self.progress_file, 'w') as f:
+            json.dump({'run': self.run, 'n_done': self.n_done}, f)
+
+    @property
+    def complete(self):
+        return self.n_done == self.data.shape[0]
+
+    def write(self, row):
+        """Write the features of the next subject and checkpoint"""
+        self.data[self.n_done] = row
+        self.data.flush()
+        self.n_done += 1
+        self._write_progress()
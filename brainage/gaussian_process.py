@@ -0,0 +1,192 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.linalg import cholesky, cho_solve
+from scipy.spatial.distance import pdist, squareform
+from sklearn import gaussian_process
+from sklearn.gaussian_process.kernels import RBF
+from sklearn.utils import check_random_state
+from .checkpoint import checkpointed_fit
+
+
+class _KnownOptimum(Exception):
+    """Raised by the objective when a restart reaches an optimum found before"""
+
+    def __init__(self, optimum):
+        super().__init__()
+        self.optimum = optimum
+
+
+class GaussianProcessRegressor(gaussian_process.GaussianProcessRegressor):
+    """sklearn's GaussianProcessRegressor with parallel, deduplicated and early stopped restarts
+
+    sklearn runs the optimizer from the kernel's theta and then from
+    n_restarts_optimizer log-uniform random thetas one after another. Here
+    the same starting points (drawn in the same order from random_state)
+    are optimized in batches of restart_batch_size on n_jobs threads (the
+    likelihood is dominated by LAPACK calls that release the GIL).
+
+    With theta_tol, a restart whose optimizer gets within theta_tol (in log
+    space, the scale of theta) of an optimum found in an earlier batch stops
+    and returns that optimum. With n_iter_no_change, no further batches are
+    started once that many restarts in a row (in restart order) did not
+    improve the log-marginal likelihood by more than 1e-6. Both only look at
+    the results of finished batches, so the fit only depends on
+    random_state and restart_batch_size, not on n_jobs or timing. Without
+    them the fit finds the same optimum as sklearn's.
+
+    The class keeps the name GaussianProcessRegressor so julearn names its
+    step 'gaussianprocessregressor'.
+
+    For an isotropic RBF kernel (the gauss workflow) the squared distances
+    between training samples are computed once per fit, and the
+    log-marginal likelihood and its gradient of every optimizer step are
+    computed from them with the same formulas as sklearn, which otherwise
+    recomputes the distances over all features for every step. They are
+    dropped at the end of fit, so the fitted model does not keep them.
+
+    Args:
+        n_jobs (int): threads optimizing restarts concurrently (-1 for one
+            per restart of a batch)
+        restart_batch_size (int): restarts run between two checks for known
+            optima and early termination
+        n_iter_no_change (int, optional): stop after this many restarts
+            without improvement, None runs all restarts
+        theta_tol (float, optional): distance in theta below which an
+            optimum counts as already found, None disables deduplication
+        see sklearn.gaussian_process.GaussianProcessRegressor for the others
+    """
+
+    def __init__(self, kernel=None, *, alpha=1e-10, optimizer="fmin_l_bfgs_b", n_restarts_optimizer=0,
+                 normalize_y=False, copy_X_train=True, random_state=None, n_jobs=1, restart_batch_size=8,
+                 n_iter_no_change=None, theta_tol=None):
+        super().__init__(kernel=kernel, alpha=alpha, optimizer=optimizer, n_restarts_optimizer=n_restarts_optimizer,
+                         normalize_y=normalize_y, copy_X_train=copy_X_train, random_state=random_state)
+        self.n_jobs = n_jobs
+        self.restart_batch_size = restart_batch_size
+        self.n_iter_no_change = n_iter_no_change
+        self.theta_tol = theta_tol
+
+    def _squared_distances(self):
+        """n x n squared distances of the training data if the kernel is an isotropic RBF, None otherwise"""
+        kernel = self.kernel_
+        if not isinstance(kernel, RBF) or kernel.anisotropic or kernel.hyperparameter_length_scale.fixed:
+            return None
+        return squareform(pdist(self.X_train_, metric="sqeuclidean"))
+
+    def log_marginal_likelihood(self, theta=None, eval_gradient=False, clone_kernel=True):
+        """sklearn's log-marginal likelihood, from the squared distances while fit optimizes an isotropic RBF"""
+        sq_dists = getattr(self, "_sq_dists", None)
+        if theta is None or sq_dists is None:
+            return super().log_marginal_likelihood(theta, eval_gradient=eval_gradient, clone_kernel=clone_kernel)
+
+        K = sq_dists * (-0.5 / np.exp(2 * theta[0]))
+        np.exp(K, out=K)
+        if eval_gradient:
+            # derivative by log(length_scale): K * d**2 / length_scale**2
+            K_gradient = K * sq_dists
+            K_gradient *= np.exp(-2 * theta[0])
+        K[np.diag_indices_from(K)] += self.alpha
+        try:
+            L = cholesky(K, lower=True, check_finite=False)
+        except np.linalg.LinAlgError:
+            return (-np.inf, np.zeros_like(theta)) if eval_gradient else -np.inf
+
+        y_train = self.y_train_ if self.y_train_.ndim == 2 else self.y_train_[:, np.newaxis]
+        alpha = cho_solve((L, True), y_train, check_finite=False)
+        log_likelihood = -0.5 * np.einsum("ik,ik->", y_train, alpha)
+        log_likelihood -= y_train.shape[1] * (np.log(np.diag(L)).sum() + K.shape[0] / 2 * np.log(2 * np.pi))
+        if not eval_gradient:
+            return log_likelihood
+
+        # 0.5 * trace((alpha alpha^T - K^-1) K_gradient) summed over the outputs, K_gradient is symmetric
+        K_inv = cho_solve((L, True), np.eye(K.shape[0]), check_finite=False)
+        gradient = 0.5 * (np.einsum("ik,ik->", K_gradient @ alpha, alpha)
+                          - y_train.shape[1] * np.sum(K_inv * K_gradient))
+        return log_likelihood, np.array([gradient])
+
+    def _objective(self, theta, eval_gradient=True):
+        # negative log-marginal likelihood, on a clone of the kernel so restarts can run on threads
+        if eval_gradient:
+            lml, grad = self.log_marginal_likelihood(theta, eval_gradient=True)
+            return -lml, -grad
+        return -self.log_marginal_likelihood(theta)
+
+    def _optimize(self, theta_initial, bounds, known_optima):
+        """(theta, negative log-marginal likelihood) of one optimizer run"""
+        def obj_func(theta, eval_gradient=True):
+            for optimum in known_optima:
+                if np.max(np.abs(theta - optimum[0])) < self.theta_tol:
+                    raise _KnownOptimum(optimum)
+            return self._objective(theta, eval_gradient)
+
+        try:
+            return self._constrained_optimization(obj_func if known_optima else self._objective, theta_initial,
+                                                  bounds)
+        except _KnownOptimum as known:
+            return known.optimum
+
+    def _run_restarts(self, bounds):
+        """Optima of the optimizer runs from the kernel's theta and the random restarts, in restart order"""
+        rng = check_random_state(self.random_state)
+        thetas = [self.kernel_.theta] + [rng.uniform(bounds[:, 0], bounds[:, 1])
+                                         for _ in range(self.n_restarts_optimizer)]
+        n_workers = self.restart_batch_size if self.n_jobs == -1 else min(self.n_jobs, self.restart_batch_size)
+        optima, n_no_change, best = [], 0, np.inf
+        with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+            for start in range(0, len(thetas), self.restart_batch_size):
+                # optima of earlier batches only, so the result does not depend on thread timing
+                known = [] if self.theta_tol is None else list(optima)
+                batch = thetas[start:start + self.restart_batch_size]
+                optima.extend(executor.map(lambda theta: self._optimize(theta, bounds, known), batch))
+                for _, value in optima[start:]:
+                    if value < best - 1e-6:
+                        n_no_change = 0
+                    else:
+                        n_no_change += 1
+                    best = min(best, value)
+                if self.n_iter_no_change is not None and n_no_change >= self.n_iter_no_change:
+                    break
+        return optima
+
+    @checkpointed_fit
+    def fit(self, X, y):
+        """Fit the Gaussian process, optimizing the kernel hyperparameters as sklearn
+
+        Args:
+            X (ndarray): n x p data
+            y (ndarray): n targets
+
+        Returns:
+            self
+        """
+        # set up the training data and the kernel without optimizing
+        optimizer = self.optimizer
+        self.optimizer = None
+        try:
+            super().fit(X, y)
+        finally:
+            self.optimizer = optimizer
+        if optimizer is None or self.kernel_.n_dims == 0:
+            return self
+
+        bounds = self.kernel_.bounds
+        if self.n_restarts_optimizer > 0 and not np.isfinite(bounds).all():
+            raise ValueError("Multiple optimizer restarts (n_restarts_optimizer>0) requires that all bounds are "
+                             "finite.")
+        self._sq_dists = self._squared_distances()
+        try:
+            optima = self._run_restarts(bounds)
+        finally:
+            self._sq_dists = None
+        self.n_restarts_run_ = len(optima) - 1
+        theta = optima[np.argmin([value for _, value in optima])][0]
+
+        # refit with the best theta to set the Cholesky factor and dual coefficients as sklearn
+        kernel = self.kernel
+        self.kernel, self.optimizer = self.kernel_.clone_with_theta(theta), None
+        try:
+            super().fit(X, y)
+        finally:
+            self.kernel, self.optimizer = kernel, optimizer
+        self.kernel_._check_bounds_params()
+        return self
@@ -0,0 +1,118 @@
+import copy
+import numpy as np
+import pandas as pd
+from glmnet import ElasticNet
+from sklearn.base import BaseEstimator, RegressorMixin, clone
+from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from .checkpoint import checkpointed_fit
+
+
+class ElasticNetMix(BaseEstimator, RegressorMixin):
+    """glmnet ElasticNets with several mixing values fit in one pass on the same data
+
+    ridge, lasso and elasticnet are glmnet ElasticNets with alpha 0, 1 and
+    0.5 on the same preprocessed features. Fitting them as one estimator
+    runs the preprocessing steps of a pipeline (variancethreshold, zscore,
+    PCA) once for all of them, and every mixing value runs glmnet's internal
+    CV on the same splits (same random_state) over the same design. The
+    python glmnet interface does not take warm starts, so every mixing value
+    still computes its own lambda path.
+
+    predict uses the model of predict_alpha; set it on the fitted estimator
+    (see with_predict_alpha) to predict with another mixing value without
+    refitting.
+
+    Args:
+        alphas (list): glmnet mixing values (0 ridge, 1 lasso)
+        predict_alpha (float, optional): mixing value used by predict, the
+            first of alphas if None
+        estimator (glmnet.ElasticNet, optional): template for the other glmnet
+            parameters, ElasticNet(standardize=False) if None
+        random_state (int, optional): seed of glmnet's internal CV splits
+        n_jobs (int): jobs of glmnet's internal CV
+    """
+
+    def __init__(self, alphas=(0, 1, 0.5), predict_alpha=None, estimator=None, random_state=None, n_jobs=1):
+        self.alphas = alphas
+        self.predict_alpha = predict_alpha
+        self.estimator = estimator
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+
+    @checkpointed_fit
+    def fit(self, X, y):
+        """Fit one glmnet ElasticNet per mixing value
+
+        Args:
+            X (ndarray or DataFrame): n x p data
+            y (ndarray or Series): n targets
+
+        Returns:
+            self
+        """
+        template = ElasticNet(standardize=False) if self.estimator is None else self.estimator
+        X, y = np.asarray(X), np.asarray(y)
+        self.estimators_ = [clone(template).set_params(alpha=alpha, random_state=self.random_state,
+                                                       n_jobs=self.n_jobs).fit(X, y)
+                            for alpha in self.alphas]
+        return self
+
+    def predict(self, X):
+        """Predict with the model of predict_alpha
+
+        Args:
+            X (ndarray or DataFrame): m x p data
+
+        Returns:
+            y_pred (ndarray): m predictions
+        """
+        alphas = list(self.alphas)
+        index = 0 if self.predict_alpha is None else alphas.index(self.predict_alpha)
+        return self.estimators_[index].predict(np.asarray(X))
+
+
+def with_predict_alpha(model, alpha, step='elasticnetmix'):
+    """Copy of a fitted (julearn) pipeline ending in ElasticNetMix that predicts with mixing value alpha"""
+    model = copy.deepcopy(model)
+    model[step].predict_alpha = alpha
+    return model
+
+
+def mix_scores(scores, cv, data, X, y, return_estimator=False, step='elasticnetmix'):
+    """Cross-validation scores of every mixing value of a cross-validated ElasticNetMix pipeline
+
+    julearn scores the pipeline with predict_alpha only. The fold
+    estimators (return_estimator='all') are scored here for every mixing
+    value on their test split, with the columns the read_results scripts
+    read. The other columns of the julearn scores (fit_time, repeat, fold)
+    are kept, and with return_estimator the fold estimators predicting with
+    the mixing value.
+
+    Args:
+        scores (DataFrame): julearn scores with an 'estimator' column
+        cv (list): (train, test) positional indices of the folds, in order
+        data (DataFrame): data the cross-validation ran on
+        X (list): feature columns
+        y (str): target column
+        return_estimator (bool): keep an 'estimator' column
+
+    Returns:
+        mixed_scores (dict): mixing value -> scores DataFrame
+    """
+    alphas = scores['estimator'].iloc[0][step].alphas
+    keep = [column for column in scores.columns if column != 'estimator' and not column.startswith('test_')]
+    mixed_scores = {}
+    for alpha in alphas:
+        rows = []
+        for estimator, (_, test) in zip(scores['estimator'], cv):
+            y_true = data[y].iloc[test]
+            estimator = with_predict_alpha(estimator, alpha, step)
+            y_pred = estimator.predict(data[X].iloc[test])
+            rows.append({'test_neg_mean_absolute_error': -mean_absolute_error(y_true, y_pred),
+                         'test_neg_mean_squared_error': -mean_squared_error(y_true, y_pred),
+                         'test_r2': r2_score(y_true, y_pred)})
+            if return_estimator:
+                rows[-1]['estimator'] = estimator
+        mixed = pd.DataFrame(rows, index=scores.index)
+        mixed_scores[alpha] = pd.concat([scores[keep], mixed], axis=1)
+    return mixed_scores
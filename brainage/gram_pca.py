@@ -0,0 +1,104 @@
+import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.utils import check_array
+from sklearn.utils.extmath import randomized_svd
+
+
+class GramPCA(BaseEstimator, TransformerMixin):
+    """PCA for many more features than samples through the n x n Gram matrix
+
+    With the centered data Xc (n samples, p features) and the eigen
+    decomposition Xc Xc^T = U diag(s**2) U^T, the principal axes are
+    Xc^T U / s. This costs O(n**2 p) instead of the O(n p min(n, p)) SVD
+    of sklearn's PCA with much smaller constants and memory (no n x p
+    factor), which pays off for voxelwise features (p >> n). Signs follow
+    the PCA of the pinned scikit-learn 1.0.2 (svd_flip on U: the largest
+    absolute score of every component on the training data is positive),
+    so projections match its PCA. Later scikit-learn versions flip on the
+    loadings instead, there projections match up to sign.
+
+    Directions with a zero singular value (the centered data has rank at
+    most n - 1) are not defined by the data; their components are set to
+    zero, where sklearn returns an arbitrary orthogonal direction.
+
+    Args:
+        n_components (int, float or None): number of components to keep, a
+            float in (0, 1) keeps the components explaining that fraction of
+            the variance, None keeps min(n_samples, n_features)
+        svd_solver (str): "gram" (Gram matrix eigendecomposition), "full"
+            (SVD of the data), "randomized" (randomized eigendecomposition of
+            the Gram matrix, needs an int n_components) or "auto" ("gram" if
+            n_features > n_samples, "full" otherwise)
+        n_oversamples (int): additional random vectors of the randomized solver
+        n_iter (int): power iterations of the randomized solver
+        random_state (int, optional): seed of the randomized solver
+    """
+
+    def __init__(self, n_components=None, svd_solver="auto", n_oversamples=10, n_iter=4, random_state=None):
+        self.n_components = n_components
+        self.svd_solver = svd_solver
+        self.n_oversamples = n_oversamples
+        self.n_iter = n_iter
+        self.random_state = random_state
+
+    def _solver(self, n_samples, n_features):
+        if self.svd_solver == "auto":
+            return "gram" if n_features > n_samples else "full"
+        if self.svd_solver not in ("gram", "full", "randomized"):
+            raise ValueError(f"Unknown svd_solver {self.svd_solver}, use 'auto', 'gram', 'full' or 'randomized'")
+        if self.svd_solver == "randomized" and not isinstance(self.n_components, (int, np.integer)):
+            raise ValueError("The randomized solver needs an int n_components")
+        return self.svd_solver
+
+    def fit(self, X, y=None):
+        X = check_array(X, dtype=[np.float64, np.float32])
+        n_samples, n_features = X.shape
+        self.n_features_in_ = n_features
+        self.mean_ = X.mean(axis=0)
+        Xc = X - self.mean_
+
+        solver = self._solver(n_samples, n_features)
+        if solver == "full":
+            U, S, Vt = np.linalg.svd(Xc, full_matrices=False)
+        else:
+            gram = Xc @ Xc.T
+            if solver == "randomized":
+                U, eigvals, _ = randomized_svd(gram, self.n_components, n_oversamples=self.n_oversamples,
+                                               n_iter=self.n_iter, random_state=self.random_state)
+            else:
+                eigvals, U = np.linalg.eigh(gram)
+                eigvals, U = eigvals[::-1], U[:, ::-1]  # decreasing order
+            S = np.sqrt(np.clip(eigvals, 0, None))
+            # singular values below the rounding level of the Gram matrix carry no direction
+            nonzero = S > np.sqrt(max(n_samples, n_features) * np.finfo(X.dtype).eps) * S[0]
+            Vt = np.zeros((S.size, n_features), dtype=X.dtype)
+            Vt[nonzero] = (Xc.T @ U[:, nonzero] / S[nonzero]).T
+            S[~nonzero] = 0
+
+        # sign convention of sklearn 1.0.2's PCA (svd_flip(U, Vt)): largest absolute entry of every U column positive
+        signs = np.sign(U[np.argmax(np.abs(U), axis=0), np.arange(U.shape[1])])
+        signs[signs == 0] = 1
+        Vt *= signs[:, None]
+
+        explained_variance = S ** 2 / (n_samples - 1)
+        total_variance = np.sum(Xc ** 2, dtype=np.float64) / (n_samples - 1)
+        explained_variance_ratio = explained_variance / total_variance
+
+        n_components = self.n_components
+        if n_components is None:
+            n_components = min(n_samples, n_features)
+        elif 0 < n_components < 1:  # fraction of the variance, as in sklearn
+            ratio_cumsum = np.cumsum(explained_variance_ratio)
+            n_components = int(np.searchsorted(ratio_cumsum, n_components, side="right") + 1)
+        n_components = min(int(n_components), S.size)
+
+        self.n_components_ = n_components
+        self.components_ = Vt[:n_components]
+        self.singular_values_ = S[:n_components].astype(X.dtype, copy=False)
+        self.explained_variance_ = explained_variance[:n_components].astype(X.dtype, copy=False)
+        self.explained_variance_ratio_ = explained_variance_ratio[:n_components].astype(X.dtype, copy=False)
+        return self
+
+    def transform(self, X):
+        X = check_array(X, dtype=[np.float64, np.float32])
+        return (X - self.mean_) @ self.components_.T
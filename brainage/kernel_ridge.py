@@ -0,0 +1,129 @@
+import numpy as np
+from scipy import linalg
+from sklearn import kernel_ridge
+from sklearn.metrics.pairwise import check_pairwise_arrays
+from sklearn.utils import check_X_y
+from .cache_utils import ContentCache, array_key
+
+# X @ Y.T by the content of X and Y: the train and validation kernel of every fold of one 5-fold search. GridSearchCV
+# runs all folds for every grid point, so fewer would not be reused; the refit evicts the oldest
+_linear_kernels = ContentCache(max_size=10)
+# eigendecompositions of training kernels by X and kernel parameters: 5 folds x 2 degrees of one search
+_kernel_eighs = ContentCache(max_size=10)
+
+
+def clear_kernel_caches():
+    """Drop the kernels and eigendecompositions kept for a grid search (n x n matrices), e.g. once it is done"""
+    _linear_kernels.clear()
+    _kernel_eighs.clear()
+
+
+def _compute_linear_kernel(X, Y):
+    K = X @ Y.T  # as sklearn's linear and polynomial kernels
+    K.flags.writeable = False
+    return K
+
+
+def linear_kernel(X, Y, Y_key=None):
+    """X @ Y.T, reused for the same X and Y within a process (see ContentCache)
+
+    Args:
+        X (ndarray): n x p data
+        Y (ndarray): m x p data
+        Y_key (str, optional): array_key(Y) if known, Y is not hashed again
+
+    Returns:
+        K (ndarray): n x m kernel, read only (copy before modifying)
+    """
+    key = array_key(X, Y) if Y_key is None else array_key(X, prefix=Y_key)
+    return _linear_kernels.get_or_compute(key, lambda: _compute_linear_kernel(X, Y))
+
+
+def _transform_kernel(K, kernel, degree, gamma, coef0, n_features):
+    """Linear or polynomial kernel from X @ Y.T, with the same operations as sklearn"""
+    if kernel == "linear":
+        return K
+    gamma = 1.0 / n_features if gamma is None else gamma
+    K = K * gamma
+    K += coef0
+    K **= degree
+    return K
+
+
+def kernel_eigh(X, kernel="polynomial", degree=3, gamma=None, coef0=1, X_key=None):
+    """Eigendecomposition s, V of the training kernel of X, reused within a process (see ContentCache)
+
+    (K + alpha I)^-1 y = V diag(1 / (s + alpha)) V^T y for every alpha, so
+    all alphas of a grid search on a fold share one decomposition.
+
+    Args:
+        X (ndarray): n x p training data
+        kernel, degree, gamma, coef0: kernel parameters as in sklearn's KernelRidge
+        X_key (str, optional): array_key(X) if known, X is not hashed again
+
+    Returns:
+        s (ndarray): eigenvalues in increasing order
+        V (ndarray): n x n eigenvectors
+    """
+    X_key = array_key(X) if X_key is None else X_key
+
+    def compute():
+        K = linear_kernel(X, X, Y_key=X_key)
+        return linalg.eigh(_transform_kernel(K, kernel, degree, gamma, coef0, X.shape[1]))
+    return _kernel_eighs.get_or_compute(f"{X_key}{kernel}{degree}{gamma}{coef0}", compute)
+
+
+def _inverse(s, alpha):
+    """1 / (s + alpha) of the eigenvalues s, 0 where s + alpha is numerically zero (as lstsq)"""
+    d = s + alpha
+    keep = d > d.max() * len(d) * np.finfo(d.dtype).eps
+    inv = np.zeros_like(d)
+    inv[keep] = 1.0 / d[keep]
+    return inv
+
+
+class KernelRidge(kernel_ridge.KernelRidge):
+    """sklearn's KernelRidge sharing the kernel and its eigendecomposition of a fold across the grid
+
+    The linear and polynomial kernels are computed from X @ Y.T, which only
+    depends on the fold (see linear_kernel), and the training kernel is
+    solved through its eigendecomposition (see kernel_eigh), which is
+    shared by all alphas of the fold. In a GridSearchCV over a pipeline
+    the preprocessing is still fitted on every inner fold, only the
+    kernel work is shared. Fits and predictions match sklearn's
+    KernelRidge within rounding; alpha 0 on a singular kernel gives the
+    least squares solution, as sklearn's fallback. Other kernels, array
+    alphas and sample weights use sklearn's fit.
+
+    The class keeps the name KernelRidge so julearn names its step
+    'kernelridge' as before.
+    """
+
+    def fit(self, X, y, sample_weight=None):
+        if (self.kernel not in ("linear", "polynomial", "poly") or sample_weight is not None
+                or np.ndim(self.alpha) > 0):
+            self.__dict__.pop('X_fit_key_', None)  # from an earlier fit
+            return super().fit(X, y, sample_weight=sample_weight)
+
+        if hasattr(X, 'columns'):  # checked by predict as in sklearn
+            self.feature_names_in_ = np.asarray(X.columns, dtype=object)
+        X, y = check_X_y(X, y, multi_output=True, y_numeric=True)
+        self.n_features_in_ = X.shape[1]
+        self.X_fit_key_ = array_key(X)  # predict looks up its kernels without hashing X_fit_ again
+        s, V = kernel_eigh(X, self.kernel, self.degree, self.gamma, self.coef0, X_key=self.X_fit_key_)
+        Vty = V.T @ y
+        inv = _inverse(s, self.alpha)
+        self.dual_coef_ = V @ (inv[:, None] * Vty if Vty.ndim == 2 else inv * Vty)
+        self.X_fit_ = X
+        return self
+
+    def _get_kernel(self, X, Y=None):
+        if self.kernel not in ("linear", "polynomial", "poly"):
+            return super()._get_kernel(X, Y)
+
+        Y_key = getattr(self, 'X_fit_key_', None) if Y is not None and Y is getattr(self, 'X_fit_', None) else None
+        X, Y = check_pairwise_arrays(X, Y)
+        K = linear_kernel(X, Y, Y_key=Y_key)
+        if self.kernel == "linear":
+            return K.copy()  # the solver adds alpha to the diagonal in place
+        return _transform_kernel(K, self.kernel, self.degree, self.gamma, self.coef0, X.shape[1])
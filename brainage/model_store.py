@@ -0,0 +1,121 @@
+import os
+import pickle
+import numpy as np
+from .cache_utils import atomic_open, array_key
+
+_INDEX_FILE = 'models.pkl'
+_ARRAY_DIR = 'arrays'
+
+
+class _StorePickler(pickle.Pickler):
+    """Pickler writing large arrays to .npy files of the store and pickling their names instead"""
+
+    def __init__(self, file, path, min_bytes):
+        super().__init__(file, protocol=4)
+        self.path = path
+        self.min_bytes = min_bytes
+        self.names = set()
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, np.ndarray) or obj.dtype.hasobject or obj.nbytes < self.min_bytes:
+            return None
+        name = array_key(obj) + '.npy'  # by content, copies of an array (deepcopied pipelines) share a file
+        if name not in self.names:
+            filename = os.path.join(self.path, _ARRAY_DIR, name)
+            if not os.path.isfile(filename):
+                with atomic_open(filename) as f:
+                    np.save(f, np.ascontiguousarray(obj))
+            self.names.add(name)
+        return name
+
+
+class _StoreUnpickler(pickle.Unpickler):
+    """Unpickler memory-mapping the arrays of the store read-only"""
+
+    def __init__(self, file, path):
+        super().__init__(file)
+        self.path = path
+
+    def persistent_load(self, name):
+        return np.load(os.path.join(self.path, _ARRAY_DIR, name), mmap_mode='r')
+
+
+class _NameUnpickler(_StoreUnpickler):
+    """Store unpickler collecting the names of the array files the index refers to"""
+
+    def __init__(self, file, path):
+        super().__init__(file, path)
+        self.names = set()
+
+    def persistent_load(self, name):
+        self.names.add(name)
+        return super().persistent_load(name)
+
+
+def save_model_store(models, path, min_bytes=2 ** 16):
+    """Save models (any picklable structure) as a store of memory-mappable arrays
+
+    Arrays of at least min_bytes (PCA components, GPR training data,
+    kernel expansions) are written to .npy files in path/arrays, named by
+    their content; everything else is pickled to path/models.pkl, which
+    refers to the array files. The index is replaced atomically and no
+    array file is removed, so readers see the old or the new models. Array
+    files only earlier saves used stay until prune_model_store removes them.
+
+    Args:
+        models: fitted pipelines, CompactModels or structures of them
+            (the content of a .models, .scores or .compact file)
+        path (str): directory of the store
+        min_bytes (int): smallest array stored in its own file
+    """
+    os.makedirs(os.path.join(path, _ARRAY_DIR), exist_ok=True)
+    with atomic_open(os.path.join(path, _INDEX_FILE)) as f:
+        pickler = _StorePickler(f, path, min_bytes)
+        pickler.dump(models)
+
+
+def prune_model_store(path):
+    """Remove the array files of a store its current index does not use
+
+    Readers that loaded an earlier index still map the files it referred
+    to, so only prune when no reader uses an index older than the last
+    save_model_store.
+
+    Args:
+        path (str): directory of the store
+
+    Returns:
+        removed (list of str): names of the removed array files
+    """
+    with open(os.path.join(path, _INDEX_FILE), 'rb') as f:
+        unpickler = _NameUnpickler(f, path)
+        unpickler.load()
+    removed = []
+    for name in sorted(os.listdir(os.path.join(path, _ARRAY_DIR))):
+        if name.endswith('.npy') and name not in unpickler.names:
+            os.remove(os.path.join(path, _ARRAY_DIR, name))
+            removed.append(name)
+    return removed
+
+
+def load_model_store(path):
+    """Load models saved by save_model_store, the large arrays memory-mapped read-only
+
+    Only the small index is read; the arrays are mapped, so the load time
+    hardly depends on their size, and processes loading the same store
+    share their pages through the OS page cache instead of holding a copy
+    each. The arrays are read-only.
+
+    Args:
+        path (str): directory of the store
+
+    Returns:
+        models: the saved structure
+    """
+    with open(os.path.join(path, _INDEX_FILE), 'rb') as f:
+        return _StoreUnpickler(f, path).load()
+
+
+def is_model_store(path):
+    """True if path is a directory written by save_model_store"""
+    return os.path.isfile(os.path.join(path, _INDEX_FILE))
@@ -0,0 +1,80 @@
+import os
+import pickle
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import StandardScaler
+from sklearn.feature_selection import VarianceThreshold
+from .gram_pca import GramPCA
+from .cache_utils import dump_pickle, fit_key
+
+CACHE_DIR_ENV = 'BRAINAGE_PREPROCESSING_CACHE'
+
+
+def set_preprocessing_cache(cache_dir):
+    """Enable the fitted transformer cache for this process and its workers
+
+    The directory is passed through an environment variable so that process
+    pools (cross validation n_jobs, parallel outer folds) see it as well.
+
+    Args:
+        cache_dir (str): directory of the cache, None disables it
+    """
+    if cache_dir is None:
+        os.environ.pop(CACHE_DIR_ENV, None)
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ[CACHE_DIR_ENV] = os.path.abspath(cache_dir)
+
+
+def preprocessing_cache_dir():
+    """Directory of the fitted transformer cache, None if it is disabled"""
+    return os.environ.get(CACHE_DIR_ENV)
+
+
+class CachedFitMixin:
+    """Keep fitted transformers on disk and reuse them for identical fits
+
+    Models trained on the same features and splits (all models of a
+    feature space, with and without PCA) fit the same VarianceThreshold,
+    z-scoring and PCA many times. With a cache directory set (see
+    set_preprocessing_cache) the fitted state is stored under a key of the
+    class, its parameters and the training data (so the split indices), and
+    an identical fit is loaded instead of computed. Without it the
+    transformers behave like their sklearn base classes.
+
+    fit_transform is always fit followed by transform, so a cached and a
+    fresh fit give the same output.
+    """
+
+    def fit(self, X, y=None):
+        cache_dir = preprocessing_cache_dir()
+        if cache_dir is None:
+            return super().fit(X, y)
+
+        cache_file = os.path.join(cache_dir, f"{type(self).__name__}.{fit_key(self, X)}.pkl")
+        if os.path.isfile(cache_file):
+            with open(cache_file, 'rb') as f:
+                self.__dict__.update(pickle.load(f))
+            return self
+
+        super().fit(X, y)
+        dump_pickle(self.__dict__, cache_file)
+        return self
+
+    def fit_transform(self, X, y=None, **fit_params):
+        return self.fit(X, y).transform(X)
+
+
+class CachedVarianceThreshold(CachedFitMixin, VarianceThreshold):
+    pass
+
+
+class CachedStandardScaler(CachedFitMixin, StandardScaler):
+    pass
+
+
+class CachedPCA(CachedFitMixin, PCA):
+    pass
+
+
+class CachedGramPCA(CachedFitMixin, GramPCA):
+    pass
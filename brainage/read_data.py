@@ -1,9 +1,24 @@
+import os
 import pickle
+import numpy as np
 import pandas as pd
 
+
+def load_features(features_file):
+    """Load a features file written by the calculate_features scripts
+
+    Reads the pickled dataframe, or if only `features_file + '.npy'` exists
+    (streamed with --memmap) the memory-mapped array with `f_` column names.
+    """
+    if not os.path.isfile(features_file) and os.path.isfile(features_file + '.npy'):
+        data = np.load(features_file + '.npy', mmap_mode='r')
+        return pd.DataFrame(data, copy=False).rename(columns=lambda X: 'f_' + str(X))
+    return pickle.load(open(features_file, 'rb'))
+
+
 def read_data_cross_site(data_file, train_status, confounds):
     
-    data_df = pickle.load(open(data_file, 'rb'))
+    data_df = load_features(data_file)
     X = [col for col in data_df if col.startswith('f_')]
     y = 'age'
     data_df['age'] = data_df['age'].round().astype(int)  # round off age and convert to integer
@@ -28,7 +43,7 @@ def read_data_cross_site(data_file, train_status, confounds):
     
     
 def read_data(features_file, demographics_file):
-    data_df = pickle.load(open(features_file, 'rb')) # read the data
+    data_df = load_features(features_file) # read the data
     demo = pd.read_csv(demographics_file)     # read demographics file
     data_df = pd.concat([demo[['site', 'subject', 'age', 'gender']], data_df], axis=1) # merge them
 
@@ -0,0 +1,308 @@
+import os
+import sys
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# relative cost of one training run per model on the same features, for scheduling only
+MODEL_COSTS = {'ridge': 1, 'lasso': 1, 'elasticnet': 1, 'glmnet': 2, 'kernel_ridge': 2, 'rvr_lin': 4, 'rf': 5,
+               'rvr_poly': 6, 'gauss': 8, 'xgb': 10}
+
+# approximate number of voxels of the 1.5 mm brainmask_12.8 resampled to 1 mm, scaled by 1 / resample_size**3
+_MASK_VOLUME = 1.5e6
+
+
+class Task:
+    """One command of the workflow with the files it reads and writes
+
+    Args:
+        name (str): unique name, also the name of the log files
+        command (list): script and arguments, run with the python of the runner
+        inputs (list): files the command reads (outputs of other tasks or given files)
+        outputs (list): files the command writes
+        cost (float): estimated run time in arbitrary units
+        n_jobs (int): CPUs the command uses
+    """
+
+    def __init__(self, name, command, inputs, outputs, cost=1.0, n_jobs=1):
+        self.name = name
+        self.command = command
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.cost = cost
+        self.n_jobs = n_jobs
+        self.dependencies = []  # set by workflow_graph
+
+    def __repr__(self):
+        return f'Task({self.name!r})'
+
+
+def _feature_spaces(grid):
+    """(feature name, number of features, pca) of every feature space of the grid"""
+    spaces = [(str(n), n, pca) for n in grid.get('parcels', []) for pca in grid.get('parcel_pca', [0])]
+    voxels = grid.get('voxels', {})
+    for fwhm in voxels.get('smooth_fwhm', []):
+        for size in voxels.get('resample_size', []):
+            spaces += [(f'S{fwhm}_R{size}', _MASK_VOLUME / size ** 3, pca) for pca in grid.get('pca', [0])]
+    return spaces
+
+
+def _extraction_tasks(data, grid, n_jobs):
+    """Parcelwise and voxelwise extraction of one dataset, all configurations from one read of every image"""
+    prefix = os.path.join(data['features_path'], data['name'])
+    tasks = []
+    parcels = grid.get('parcels', [])
+    if parcels:
+        masks = [grid['parcel_masks'].format(n=n) for n in parcels]
+        command = ['calculate_features_parcelwise.py', '--features_path', data['features_path'],
+                   '--subject_filepaths', data['subject_filepaths'], '--output_prefix', data['name'],
+                   '--mask_file', *masks, '--num_parcels', *map(str, parcels), '--n_jobs', str(n_jobs)]
+        tasks.append(Task(f"{data['name']}.extract_parcels", command, [data['subject_filepaths'], *masks],
+                          [f'{prefix}.{n}' for n in parcels], cost=sum(parcels) / 100, n_jobs=n_jobs))
+    voxels = grid.get('voxels', {})
+    configs = [(fwhm, size) for fwhm in voxels.get('smooth_fwhm', []) for size in voxels.get('resample_size', [])]
+    if configs:
+        command = ['calculate_features_voxelwise.py', '--features_path', data['features_path'],
+                   '--subject_filepaths', data['subject_filepaths'], '--output_prefix', data['name'],
+                   '--mask_file', grid['voxel_mask'],
+                   '--smooth_fwhm', *map(str, voxels['smooth_fwhm']),
+                   '--resample_size', *map(str, voxels['resample_size']), '--n_jobs', str(n_jobs)]
+        tasks.append(Task(f"{data['name']}.extract_voxels", command, [data['subject_filepaths'], grid['voxel_mask']],
+                          [f'{prefix}.S{fwhm}_R{size}' for fwhm, size in configs], cost=100 * len(configs),
+                          n_jobs=n_jobs))
+    return tasks
+
+
+def build_workflow(grid):
+    """Tasks of a declarative grid of feature spaces, models, PCA on/off and within- or cross-site training
+
+    The grid holds the same settings as the .submit files; relative paths
+    are relative to the codes directory the tasks run in:
+
+        mode: 'within' or 'cross'
+        data: name, subject_filepaths, demographics_file, features_path and
+            output_path of the training data
+        test_data (cross only, optional): name, subject_filepaths,
+            demographics_file and features_path of the data the cross-site
+            models are applied to
+        parcels: numbers of parcels, parcel_masks: their mask files with
+            '{n}' for the number, parcel_pca: PCA settings of the parcel
+            spaces (default [0])
+        voxels: smooth_fwhm and resample_size lists, voxel_mask: GM mask,
+            pca: PCA settings of the voxel spaces (default [0])
+        models: model names of the train scripts
+        confounds (cross only, optional), n_jobs: CPUs of extraction tasks,
+        train_jobs: CPUs of training tasks, pca_solver, model_costs:
+            overrides of MODEL_COSTS
+
+    within: extract features -> train every (feature space, PCA, model) ->
+    combine the CV predictions of all of them -> bias-correct the combined
+    predictions. cross: extract -> train -> bias correction parameters per
+    trained model, and (with test_data) extract the test features ->
+    combine the predictions of all models on the test data.
+
+    Args:
+        grid (dict): the grid
+
+    Returns:
+        tasks (list): Task objects, dependencies set
+    """
+    mode = grid.get('mode', 'within')
+    if mode not in ('within', 'cross'):
+        raise ValueError(f"mode must be 'within' or 'cross', got {mode!r}")
+    data = grid['data']
+    n_jobs, train_jobs = grid.get('n_jobs', 1), grid.get('train_jobs', 1)
+    costs = {**MODEL_COSTS, **grid.get('model_costs', {})}
+    features = os.path.join(data['features_path'], data['name'])
+    results = os.path.join(data['output_path'], data['name'])
+
+    tasks = _extraction_tasks(data, grid, n_jobs)
+    train_tasks = []
+    for feature_name, n_features, pca in _feature_spaces(grid):
+        result_prefix = f"{data['name']}.{feature_name}" + ('_pca' if pca else '')
+        for model in grid['models']:
+            outputs = [f'{results}.{feature_name}' + ('_pca' if pca else '') + f'.{model}.{kind}'
+                       for kind in (('models', 'scores', 'results') if mode == 'within' else ('models', 'scores'))]
+            command = [f'{mode}_site_train.py', '--demographics_file', data['demographics_file'],
+                       '--features_file', f'{features}.{feature_name}', '--output_path', data['output_path'],
+                       '--output_prefix', result_prefix, '--models', model, '--pca_status', str(pca),
+                       '--n_jobs', str(train_jobs)]
+            if 'pca_solver' in grid:
+                command += ['--pca_solver', grid['pca_solver']]
+            if mode == 'cross' and grid.get('confounds') is not None:
+                command += ['--confounds', grid['confounds']]
+            # PCA leaves at most as many components as samples
+            cost = costs.get(model, 1) * (min(n_features, 1000) if pca else n_features) / 100
+            train_tasks.append(Task(f'{result_prefix}.{model}', command,
+                                    [data['demographics_file'], f'{features}.{feature_name}'], outputs,
+                                    cost=cost, n_jobs=train_jobs))
+    tasks += train_tasks
+    model_files = [task.outputs[0] for task in train_tasks]
+
+    if mode == 'within':
+        combined = f'{results}.all_models_pred.csv'
+        command = ['within_site_combine_predictions.py', '--demographics_file', data['demographics_file'],
+                   '--features_path', f'{features}.', '--model_path', f'{results}.',
+                   '--output_prefix', 'all_models_pred']
+        tasks.append(Task(f"{data['name']}.combine", command, model_files, [combined], cost=len(model_files) / 10))
+        command = ['within_site_bias_correction.py', '--input_predictions_file', combined,
+                   '--BC_predictions_file', f'{results}.all_models_pred_BC.csv']
+        tasks.append(Task(f"{data['name']}.bias_correction", command, [combined],
+                          [f'{results}.all_models_pred_BC.csv'], cost=1))
+        return workflow_graph(tasks)
+
+    for train_task in train_tasks:
+        model_file = train_task.outputs[0][:-len('.models')]
+        command = ['cross_site_bias_correction.py', '--demographics_file', data['demographics_file'],
+                   '--features_file', train_task.inputs[1], '--model_file', model_file]
+        tasks.append(Task(f'{train_task.name}.bias_correction', command, [train_task.outputs[1]],
+                          [f'{model_file}.bias_params', f'{model_file}.predictions.csv'],
+                          cost=train_task.cost / 10))
+    test_data = grid.get('test_data')
+    if test_data is not None:
+        tasks += _extraction_tasks(test_data, grid, n_jobs)
+        test_features = os.path.join(test_data['features_path'], test_data['name'])
+        output_prefix = f"pred_{test_data['name']}_all"
+        command = ['cross_site_combine_predictions.py', '--demographics_file', test_data['demographics_file'],
+                   '--features_path', f'{test_features}.', '--model_path', f'{results}.',
+                   '--output_prefix', output_prefix]
+        test_files = sorted({f'{test_features}.{feature_name}' for feature_name, _, _ in _feature_spaces(grid)})
+        tasks.append(Task(f"{test_data['name']}.combine", command, model_files + test_files,
+                          [f'{results}.{output_prefix}.csv'], cost=len(model_files) / 10))
+    return workflow_graph(tasks)
+
+
+def workflow_graph(tasks):
+    """Set the dependencies of every task: the tasks writing its inputs
+
+    Args:
+        tasks (list): Task objects with unique names and outputs
+
+    Returns:
+        tasks (list): the same tasks
+    """
+    producers = {}
+    for task in tasks:
+        for output in task.outputs:
+            if output in producers:
+                raise ValueError(f'{output} is written by {producers[output].name} and {task.name}')
+            producers[output] = task
+    for task in tasks:
+        task.dependencies = list({producers[f].name: producers[f] for f in task.inputs if f in producers}.values())
+    return tasks
+
+
+def _priorities(tasks):
+    """Estimated cost of every task plus the longest chain of tasks waiting for it"""
+    dependents = {task.name: [] for task in tasks}
+    for task in tasks:
+        for dependency in task.dependencies:
+            dependents[dependency.name].append(task)
+    priorities = {}
+
+    def priority(task):
+        if task.name not in priorities:
+            priorities[task.name] = task.cost + max((priority(t) for t in dependents[task.name]), default=0)
+        return priorities[task.name]
+
+    for task in tasks:
+        priority(task)
+    return priorities
+
+
+def _mtime(path, cwd):
+    path = os.path.join(cwd, path)
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+
+def outdated_tasks(tasks, cwd='.'):
+    """Tasks that have to run: an output is missing, older than an input, or a dependency has to run
+
+    Args:
+        tasks (list): Task objects with dependencies set
+        cwd (str): directory relative paths refer to
+
+    Returns:
+        names (set): names of the tasks to run
+    """
+    outdated = {}
+
+    def is_outdated(task):
+        if task.name not in outdated:
+            output_times = [_mtime(f, cwd) for f in task.outputs]
+            input_times = [t for t in (_mtime(f, cwd) for f in task.inputs) if t is not None]
+            outdated[task.name] = (None in output_times or any(is_outdated(t) for t in task.dependencies)
+                                   or (bool(input_times) and max(input_times) > min(output_times)))
+        return outdated[task.name]
+
+    return {task.name for task in tasks if is_outdated(task)}
+
+
+def run_workflow(tasks, n_cpus=None, cwd='.', log_dir=None, python=None, dry_run=False):
+    """Run the outdated tasks on this machine, longest estimated path first
+
+    Ready tasks (all dependencies done) start in the order of their
+    estimated cost plus that of the longest chain of tasks waiting for them,
+    as long as their n_jobs fit into n_cpus (a task needing more than
+    n_cpus starts when nothing else runs). Every task is a subprocess, its
+    stdout and stderr go to log_dir/{name}.out and .err. A failed task
+    fails its dependents, the others still run.
+
+    Args:
+        tasks (list): Task objects with dependencies set (see build_workflow)
+        n_cpus (int, optional): CPUs to use, all of the machine if None
+        cwd (str): directory the scripts and relative paths are in
+        log_dir (str, optional): directory of the logs, cwd/../logs if None
+        python (str, optional): interpreter, the one running the workflow if None
+        dry_run (bool): only print the commands of the outdated tasks in start order
+
+    Returns:
+        status (dict): task name -> 'up to date', 'done', 'failed', 'skipped' or 'dry run'
+    """
+    n_cpus = os.cpu_count() if n_cpus is None else n_cpus
+    log_dir = os.path.join(cwd, '..', 'logs') if log_dir is None else log_dir
+    python = sys.executable if python is None else python
+    to_run = outdated_tasks(tasks, cwd)
+    priorities = _priorities(tasks)
+    status = {task.name: 'up to date' for task in tasks if task.name not in to_run}
+    pending = sorted((task for task in tasks if task.name in to_run), key=lambda t: -priorities[t.name])
+
+    def run(task):
+        with open(os.path.join(log_dir, f'{task.name}.out'), 'w') as out, \
+                open(os.path.join(log_dir, f'{task.name}.err'), 'w') as err:
+            return subprocess.run([python, *task.command], cwd=cwd, stdout=out, stderr=err).returncode
+
+    if not dry_run:
+        os.makedirs(log_dir, exist_ok=True)
+    running, used_cpus = {}, 0
+    with ThreadPoolExecutor(max_workers=max(n_cpus, 1)) as executor:
+        while pending or running:
+            progress = False
+            for task in list(pending):
+                if any(status.get(t.name) in ('failed', 'skipped') for t in task.dependencies):
+                    status[task.name], progress = 'skipped', True
+                    pending.remove(task)
+                    continue
+                ready = all(status.get(t.name) in ('up to date', 'done', 'dry run') for t in task.dependencies)
+                if ready and (used_cpus + task.n_jobs <= n_cpus or not running):
+                    pending.remove(task)
+                    progress = True
+                    if dry_run:
+                        status[task.name] = 'dry run'
+                        print(' '.join([python, *task.command]))
+                        continue
+                    print(f'starting {task.name}')
+                    running[executor.submit(run, task)] = task
+                    used_cpus += task.n_jobs
+            if not running:
+                if progress:
+                    continue
+                for task in pending:  # dependencies that can never finish (a cycle)
+                    status[task.name] = 'skipped'
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                used_cpus -= task.n_jobs
+                status[task.name] = 'done' if future.result() == 0 else 'failed'
+                print(f'{status[task.name]} {task.name}')
+    return status
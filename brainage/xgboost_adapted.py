@@ -1,11 +1,83 @@
+import os
+import xgboost
 from xgboost import XGBRegressor
 from sklearn.base import BaseEstimator
+from sklearn.metrics import r2_score
 from sklearn.model_selection import train_test_split
 import numpy as np
+from .checkpoint import checkpointed_fit
+from .cache_utils import ContentCache, array_key
+
+# (train, eval) DMatrix by the content of X, y and the split: the folds of a 5-fold search and the refit
+_split_dmatrices = ContentCache(max_size=6)
+
+
+def thread_budget(n_jobs=None):
+    """Threads of one xgboost fit: n_jobs if positive, this process' share of the CPUs otherwise
+
+    joblib's process workers get OMP_NUM_THREADS set to their share of
+    the CPUs (cpu_count // n_jobs), as do HTCondor jobs (request_cpus), so
+    fits inside a parallel cross-validation do not oversubscribe the
+    machine. Without it all CPUs are used.
+    """
+    if n_jobs is not None and n_jobs > 0:
+        return n_jobs
+    budget = os.environ.get('OMP_NUM_THREADS', '')
+    return int(budget) if budget.isdigit() and int(budget) > 0 else os.cpu_count()
+
+
+def _compute_split_dmatrices(X, y, test_size, random_state, nthread):
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=random_state)
+    # DMatrix(nthread=...) as XGBRegressor.fit, the split is the same as before
+    return (xgboost.DMatrix(X_train, label=y_train, missing=np.nan, nthread=nthread),
+            xgboost.DMatrix(X_test, label=y_test, missing=np.nan, nthread=nthread))
 
-class XGBoostAdapted(BaseEstimator):
 
-    def __init__(self, early_stopping_rounds=10, eval_metric=None, eval_set_percent=0.2, random_seed=None, n_jobs=1, max_depth=6, n_estimators=50, nthread=1, reg_alpha=0):
+def split_dmatrices(X, y, test_size, random_state, nthread=1):
+    """Train and eval DMatrix of train_test_split(X, y), reused for the same X, y and split within a process
+
+    xgboost keeps the quantized (hist) or sorted (exact) representation it
+    builds in the DMatrix, so every grid point after the first of a fold
+    reuses it (see ContentCache).
+
+    Args:
+        X (ndarray): n x p data
+        y (ndarray): n targets
+        test_size (float): fraction of the samples in the eval set
+        random_state (int): seed of the split
+        nthread (int): threads building the DMatrix
+
+    Returns:
+        dtrain, deval (xgboost.DMatrix): the train and eval split
+    """
+    X, y = np.ascontiguousarray(X), np.ascontiguousarray(y)
+    return _split_dmatrices.get_or_compute(array_key(X, y, prefix=f"{test_size}{random_state}"),
+                                           lambda: _compute_split_dmatrices(X, y, test_size, random_state, nthread))
+
+
+class XGBoostAdapted(BaseEstimator):
+    """XGBRegressor with early stopping on a held-out part of the training data
+
+    eval_set_percent of the training data is split off (with random_seed)
+    as the early stopping set. The split matrices of a fold are built once
+    and shared by all grid points of a search (see split_dmatrices), and
+    the booster is trained with xgboost.train with the parameters
+    XGBRegressor would pass, so the models are the same as XGBRegressor's
+    on the same split. tree_method='hist' trains on the quantized matrix,
+    which pays off with many samples; with a few hundred subjects the
+    exact method is usually faster.
+
+    Args:
+        n_jobs (int, optional): threads of a fit, None or -1 for this
+            process' share of the CPUs (see thread_budget)
+        nthread (int, optional): deprecated alias of n_jobs, used if given
+        tree_method (str, optional): xgboost tree method ('exact', 'approx',
+            'hist'), xgboost's default if None
+        see xgboost.XGBRegressor for the others
+    """
+
+    def __init__(self, early_stopping_rounds=10, eval_metric=None, eval_set_percent=0.2, random_seed=None, n_jobs=1,
+                 max_depth=6, n_estimators=50, nthread=None, reg_alpha=0, reg_lambda=1, tree_method=None):
         self.early_stopping_rounds = early_stopping_rounds
         self.eval_metric = eval_metric
         self.eval_set_percent = eval_set_percent
@@ -15,32 +87,30 @@ class XGBoostAdapted(BaseEstimator):
         self.n_estimators = n_estimators
         self.nthread = nthread
         self.reg_alpha = reg_alpha
+        self.reg_lambda = reg_lambda
+        self.tree_method = tree_method
 
-            
+    @checkpointed_fit
     def fit(self, X, y):
-        self._xgbregressor = XGBRegressor(n_jobs=self.n_jobs, max_depth=self.max_depth, n_estimators=self.n_estimators, nthread=self.nthread, reg_alpha=self.reg_alpha)
-
-        X_train, X_test, y_train, y_test = train_test_split(X.values, y.values, test_size=self.eval_set_percent, random_state=self.random_seed)
-
-        eval_set = [(X_test, y_test)]
-
-        self._xgbregressor.fit(X_train, y_train, early_stopping_rounds=self.early_stopping_rounds, eval_metric=self.eval_metric, eval_set=eval_set)
-        
+        n_threads = thread_budget(self.n_jobs if self.nthread is None else self.nthread)
+        dtrain, deval = split_dmatrices(X, y, self.eval_set_percent, self.random_seed, nthread=n_threads)
+        params = XGBRegressor(n_jobs=n_threads, max_depth=self.max_depth, n_estimators=self.n_estimators,
+                              reg_alpha=self.reg_alpha, reg_lambda=self.reg_lambda,
+                              tree_method=self.tree_method).get_xgb_params()
+        if self.eval_metric is not None:
+            params['eval_metric'] = self.eval_metric
+        self.booster_ = xgboost.train(params, dtrain, num_boost_round=self.n_estimators,
+                                      evals=[(deval, 'validation_0')],
+                                      early_stopping_rounds=self.early_stopping_rounds, verbose_eval=False)
+        self.best_iteration_ = getattr(self.booster_, 'best_iteration', None)
         return self
 
     def score(self, X, y, sample_weight=None):
-        return self._xgbregressor.score(X.values, y.values, sample_weight)
+        return r2_score(y, self.predict(X), sample_weight=sample_weight)
 
     def predict(self, X):
-        return self._xgbregressor.predict(X.values)
-
-
-
-
-        
-        
-
-
-
-
-
+        if not hasattr(self, 'booster_'):  # fitted before the booster was kept directly
+            return self._xgbregressor.predict(X.values)
+        # the best iteration with early stopping, as XGBRegressor.predict
+        iteration_range = (0, 0) if self.best_iteration_ is None else (0, self.best_iteration_ + 1)
+        return self.booster_.inplace_predict(np.asarray(X), iteration_range=iteration_range, missing=np.nan)
@@ -10,24 +10,25 @@ class ZScore(BaseEstimator, TransformerMixin):
         self.axis = axis
 
     def fit(self, X, y=None):
-        X = check_array(X)
-        self.mean_ = np.mean(X, axis=self.axis)
-        self.std_ = np.std(X, axis=self.axis)
+        X = check_array(X, dtype=[np.float64, np.float32])
+        # accumulate in float64, keep the statistics in the dtype of X (float32 stays float32)
+        self.mean_ = np.mean(X, axis=self.axis, dtype=np.float64).astype(X.dtype)
+        self.std_ = np.std(X, axis=self.axis, dtype=np.float64).astype(X.dtype)
         return self
 
     def transform(self, X):
-        X = check_array(X)
+        X = check_array(X, dtype=[np.float64, np.float32])
         mean = (
             self.mean_.reshape(-1, 1)
             if self.axis
             else self.mean_
-        )
+        ).astype(X.dtype, copy=False)
 
         std = (
             self.std_.reshape(-1, 1)
             if self.axis
             else self.std_
-        )
+        ).astype(X.dtype, copy=False)
         # print(f"{X.shape = }")
         # print(f"{mean.shape = }")
         # print(f"{std.shape = }")
@@ -44,6 +45,6 @@ class ZScoreSubwise(BaseEstimator, TransformerMixin):
         return self
 
     def transform(self, X):
-        X = check_array(X)
+        X = check_array(X, dtype=[np.float64, np.float32])
         return zscore(X, axis=self.axis)
 
@@ -0,0 +1,40 @@
+import time
+import argparse
+import numpy as np
+from sklearn.decomposition import PCA
+from brainage import GramPCA
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_samples", type=int, default=1000, help="number of subjects (training split size)")
+    parser.add_argument("--n_features", type=int, default=30000, help="number of features (about S0_R4 voxels)")
+    parser.add_argument("--dtype", type=str, default="float64", choices=["float64", "float32"])
+
+    # python3 benchmark_pca.py --n_samples 1000 --n_features 30000
+
+    args = parser.parse_args()
+    n_samples, n_features = args.n_samples, args.n_features
+    print('Data size:', n_samples, 'x', n_features, args.dtype)
+
+    rng = np.random.default_rng(seed=200)
+    X = rng.random((n_samples, n_features)).astype(args.dtype)
+    X_test = rng.random((100, n_features)).astype(args.dtype)
+
+    timings, projections = {}, {}
+    for name, pca in [('sklearn', PCA(n_components=None)),
+                      ('gram', GramPCA(n_components=None)),
+                      ('gram randomized (100 comp.)', GramPCA(n_components=100, svd_solver='randomized',
+                                                                random_state=200))]:
+        start = time.time()
+        pca.fit(X)
+        timings[name] = time.time() - start
+        projections[name] = pca.transform(X_test)
+        print(f'{name}: fit {timings[name]:.2f} s')
+
+    # components with a zero singular value (the last one) are arbitrary in sklearn
+    n_defined = min(n_samples - 1, n_features)
+    diff = np.abs(projections['sklearn'][:, :n_defined] - projections['gram'][:, :n_defined]).max()
+    print('max projection difference sklearn vs gram:', diff)
+    print(f"speedup gram: {timings['sklearn'] / timings['gram']:.1f}x, "
+          f"randomized: {timings['sklearn'] / timings['gram randomized (100 comp.)']:.1f}x")
@@ -0,0 +1,78 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator
+from sklearn.model_selection import GridSearchCV, KFold, train_test_split
+from xgboost import XGBRegressor
+from brainage import XGBoostAdapted
+
+
+class PreviousXGBoostAdapted(BaseEstimator):
+    """XGBoostAdapted before the DMatrix cache: one XGBRegressor with new matrices per fit (verbose off)"""
+
+    def __init__(self, early_stopping_rounds=10, eval_metric=None, eval_set_percent=0.2, random_seed=None, n_jobs=1,
+                 max_depth=6, n_estimators=50, nthread=1, reg_alpha=0):
+        self.early_stopping_rounds = early_stopping_rounds
+        self.eval_metric = eval_metric
+        self.eval_set_percent = eval_set_percent
+        self.random_seed = random_seed
+        self.n_jobs = n_jobs
+        self.max_depth = max_depth
+        self.n_estimators = n_estimators
+        self.nthread = nthread
+        self.reg_alpha = reg_alpha
+
+    def fit(self, X, y):
+        self._xgbregressor = XGBRegressor(n_jobs=self.n_jobs, max_depth=self.max_depth,
+                                          n_estimators=self.n_estimators, nthread=self.nthread,
+                                          reg_alpha=self.reg_alpha)
+        X_train, X_test, y_train, y_test = train_test_split(X.values, y.values, test_size=self.eval_set_percent,
+                                                            random_state=self.random_seed)
+        self._xgbregressor.fit(X_train, y_train, early_stopping_rounds=self.early_stopping_rounds,
+                               eval_metric=self.eval_metric, eval_set=[(X_test, y_test)], verbose=False)
+        return self
+
+    def predict(self, X):
+        return self._xgbregressor.predict(X.values)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_samples", type=int, default=500, help="number of subjects (training split size)")
+    parser.add_argument("--n_features", type=int, nargs='+', default=[1273, 30000],
+                        help="numbers of features (1273 parcels, about 30000 S0_R4 voxels)")
+    parser.add_argument("--n_threads", type=int, default=1, help="xgboost threads of the new implementation")
+    parser.add_argument("--max_depth", type=int, nargs='+', default=[6, 8, 10, 12], help="max_depth grid")
+    parser.add_argument("--reg_alpha", type=float, nargs='+', default=[0.001, 0.01, 0.05, 0.1, 0.2], help="reg_alpha grid")
+
+    # python3 benchmark_xgboost.py --n_samples 500 --n_features 1273 30000
+    # the within-site grid: max_depth 4 values x reg_alpha 5 values x 5 folds, n_estimators 100, plus the refit
+    # voxel scale on one CPU with a reduced grid:
+    # python3 benchmark_xgboost.py --n_samples 300 --n_features 30000 --max_depth 6 --reg_alpha 0.01 0.1
+
+    args = parser.parse_args()
+    param_grid = {'max_depth': args.max_depth, 'reg_alpha': args.reg_alpha}
+    cv = KFold(n_splits=5, shuffle=True, random_state=200)
+    rng = np.random.default_rng(seed=200)
+
+    for n_features in args.n_features:
+        X = pd.DataFrame(rng.random((args.n_samples, n_features)), columns=[f'f_{i}' for i in range(n_features)])
+        y = pd.Series(20 + 60 * X.iloc[:, :10].mean(axis=1) + rng.normal(size=args.n_samples))
+        print('Data size:', args.n_samples, 'x', n_features)
+
+        timings, predictions = {}, {}
+        for name, model in [('previous', PreviousXGBoostAdapted(n_jobs=1, nthread=1)),
+                            ('cached DMatrix', XGBoostAdapted(n_jobs=args.n_threads)),
+                            ('cached DMatrix + hist', XGBoostAdapted(n_jobs=args.n_threads, tree_method='hist'))]:
+            model.set_params(eval_metric='mae', n_estimators=100, random_seed=200)
+            start = time.time()
+            search = GridSearchCV(model, param_grid, cv=cv, scoring='neg_mean_absolute_error').fit(X, y)
+            timings[name] = time.time() - start
+            predictions[name] = search.predict(X)
+            print(f'{name}: {timings[name]:.1f} s, best {search.best_params_}')
+
+        diff = np.abs(predictions['previous'] - predictions['cached DMatrix']).max()
+        print('max prediction difference previous vs cached DMatrix:', diff)
+        print(f"speedup cached DMatrix: {timings['previous'] / timings['cached DMatrix']:.1f}x, "
+              f"+ hist: {timings['previous'] / timings['cached DMatrix + hist']:.1f}x\n")
@@ -1,6 +1,7 @@
 import os
 import pickle
 import argparse
+import numpy as np
 from pathlib import Path
 from brainage import calculate_parcelwise_features
 
@@ -11,10 +12,20 @@ if __name__ == '__main__':
     # parser.add_argument("--output_path", type=str, help="path to output_dir")  # eg'../results/ADNI'
     parser.add_argument("--subject_filepaths", type=str, help="path to csv or txt file with subject filepaths") # eg: '../data/ADNI/ADNI_paths_cat12.8.csv'
     parser.add_argument("--output_prefix", type=str, help="prefix added to features filename ans results (predictions) file name") # eg: 'ADNI'
-    parser.add_argument("--mask_file", type=str, help="path to mask nii file")
-    parser.add_argument("--num_parcels", type=str, help="Number of parcels")
+    parser.add_argument("--mask_file", type=str, nargs='+', help="path to mask nii file (one or more atlases)")
+    parser.add_argument("--num_parcels", type=str, nargs='+', help="Number of parcels (of every atlas)")
+    parser.add_argument("--n_jobs", type=int, default=1, help="Number of parallel jobs to run")
+    parser.add_argument("--dtype", type=str, default="float64", choices=["float64", "float32"],
+                        help="floating point type of the features (float32 halves memory and file size)")
+    parser.add_argument("--prefetch", type=int, default=0,
+                        help="number of subject images loaded ahead on a background thread (with n_jobs 1)")
+    parser.add_argument("--prefetch_max_mb", type=int, default=None, help="memory cap of the prefetched images (MB)")
+    parser.add_argument("--atlas_cache_dir", type=str, default=None,
+                        help="directory to keep atlases resampled to the subject geometries across runs")
 
     # python3 calculate_features_parcelwise.py --features_path ../data/ixi/ --subject_filepaths ../data/ixi/ixi_paths_cat12.8.csv --output_prefix ixi --mask_file ../masks/BSF_173.nii --num_parcels 173
+    # several atlases from one read of every image:
+    # python3 calculate_features_parcelwise.py --features_path ../data/ixi/ --subject_filepaths ../data/ixi/ixi_paths_cat12.8.csv --output_prefix ixi --mask_file ../masks/BSF_173.nii ../masks/BSF_473.nii --num_parcels 173 473
    
     # example inputs
     # features_path = Path('../data/ixi/')
@@ -29,19 +40,32 @@ if __name__ == '__main__':
     output_prefix = args.output_prefix
     mask_file = args.mask_file
     num_parcels = args.num_parcels
+    n_jobs = args.n_jobs
+    dtype = np.dtype(args.dtype)
+    prefetch = args.prefetch
+    prefetch_max_bytes = None if args.prefetch_max_mb is None else args.prefetch_max_mb * 2 ** 20
+    atlas_cache_dir = args.atlas_cache_dir
 
     print('Subjects filepaths: ', subject_filepaths)
     print('Directory to features path: ',  features_path)
     print('Results filename prefix: ', output_prefix)
     print('GM mask used: ', mask_file)
-    print('Number of parcels:', num_parcels, '/n')
+    print('Number of parcels:', num_parcels)
+    print('Features dtype:', dtype)
+    print('Prefetched images: ', prefetch)
+    print('Resampled atlas cache: ', atlas_cache_dir)
+    print('Num of parallel jobs initiated: ', n_jobs, '\n')
     
-    data_parcels = calculate_parcelwise_features(subject_filepaths, mask_file, num_parcels)
+    data_parcels_all = calculate_parcelwise_features(subject_filepaths, mask_file, num_parcels, n_jobs=n_jobs,
+                                                     dtype=dtype, prefetch=prefetch,
+                                                     prefetch_max_bytes=prefetch_max_bytes,
+                                                     atlas_cache_dir=atlas_cache_dir)
 
     features_path.mkdir(exist_ok=True, parents=True)
     
-    full_filename = str(output_prefix) + '.' + str(num_parcels)
-    filename = os.path.join(features_path, full_filename)
-    print('filename for features created: ', filename)
-    pickle.dump(data_parcels, open(filename, "wb"), protocol=4)
-    data_parcels.to_csv(filename + '.csv', index=False)
\ No newline at end of file
+    for num, data_parcels in data_parcels_all.items():
+        full_filename = str(output_prefix) + '.' + str(num)
+        filename = os.path.join(features_path, full_filename)
+        print('filename for features created: ', filename)
+        pickle.dump(data_parcels, open(filename, "wb"), protocol=4)
+        data_parcels.to_csv(filename + '.csv', index=False)
\ No newline at end of file
@@ -1,8 +1,9 @@
 import os
 import argparse
 import pickle
+import numpy as np
 from pathlib import Path
-from brainage import calculate_voxelwise_features
+from brainage import calculate_multi_voxelwise_features
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -12,10 +13,29 @@ if __name__ == '__main__':
     parser.add_argument("--output_prefix", type=str, help="prefix added to features filename ans results (predictions) file name") # eg: 'ADNI'
     parser.add_argument("--mask_file", type=str, help="path to GM mask nii file",
                         default='../masks/brainmask_12.8.nii')
-    parser.add_argument("--smooth_fwhm", type=int, help="smoothing FWHM", default=4)
-    parser.add_argument("--resample_size", type=int, help="resampling kernel size", default=4)
+    parser.add_argument("--smooth_fwhm", type=int, nargs='+', help="smoothing FWHM (one or more)", default=[4])
+    parser.add_argument("--resample_size", type=int, nargs='+', help="resampling kernel size (one or more)", default=[4])
+    parser.add_argument("--cascade_smoothing", type=int, default=1,
+                        help="0: smooth every FWHM from the original image, 1: derive larger FWHM from smaller ones")
+    parser.add_argument("--n_jobs", type=int, default=1, help="Number of parallel jobs to run")
+    parser.add_argument("--dtype", type=str, default="float64", choices=["float64", "float32"],
+                        help="floating point type of the smoothed images and the features (float32 halves memory "
+                             "and file size)")
+    parser.add_argument("--prefetch", type=int, default=0,
+                        help="number of subject images loaded ahead on a background thread (with n_jobs 1)")
+    parser.add_argument("--prefetch_max_mb", type=int, default=None, help="memory cap of the prefetched images (MB)")
+    parser.add_argument("--method", type=str, default="nilearn", choices=["nilearn", "operator"],
+                        help="nilearn: smooth and resample every image, operator: precompiled sparse extraction "
+                             "matrix per subject geometry applied to batches of subjects")
+    parser.add_argument("--operator_cache_dir", type=str, default=None,
+                        help="directory to keep the sparse extraction matrices across runs (operator method)")
+    parser.add_argument("--batch_size", type=int, default=32, help="subjects per sparse product (operator method)")
+    parser.add_argument("--memmap", type=int, default=0,
+                        help="0: save pickle and csv, 1: stream into a resumable {prefix}.S{fwhm}_R{size}.npy")
 
     # python3 calculate_features_voxelwise.py --features_path ../data/ixi/ --subject_filepaths ../data/ixi/ixi_paths_cat12.8.csv --output_prefix ixi --mask_file ../masks/brainmask_12.8.nii --smooth_fwhm 4 --resample_size 8
+    # all S x R combinations from one read of every image:
+    # python3 calculate_features_voxelwise.py --features_path ../data/ixi/ --subject_filepaths ../data/ixi/ixi_paths_cat12.8.csv --output_prefix ixi --mask_file ../masks/brainmask_12.8.nii --smooth_fwhm 0 4 8 --resample_size 4 8
     
     # example inputs
     # features_path = Path('../data/ixi/')
@@ -32,20 +52,51 @@ if __name__ == '__main__':
     mask_file = args.mask_file
     smooth_fwhm = args.smooth_fwhm
     resample_size = args.resample_size
+    cascade_smoothing = bool(args.cascade_smoothing)
+    n_jobs = args.n_jobs
+    dtype = np.dtype(args.dtype)
+    prefetch = args.prefetch
+    prefetch_max_bytes = None if args.prefetch_max_mb is None else args.prefetch_max_mb * 2 ** 20
+    memmap = bool(args.memmap)
+    method = args.method
+    operator_cache_dir = args.operator_cache_dir
+    batch_size = args.batch_size
 
     print('Subjects filepaths: ', subject_filepaths)
     print('Directory to features path: ',  features_path)
     print('Results filename prefix: ', output_prefix)
     print('GM mask used: ', mask_file)
     print('smooth_fwhm:', smooth_fwhm)
-    print('resample_size:', resample_size, '/n')
-
-    data_resampled = calculate_voxelwise_features(subject_filepaths, mask_file, smooth_fwhm=smooth_fwhm, resample_size=resample_size)
+    print('resample_size:', resample_size)
+    print('cascade_smoothing:', cascade_smoothing)
+    print('Features dtype:', dtype)
+    print('Extraction method:', method)
+    print('Stream into memmap:', memmap)
+    print('Prefetched images: ', prefetch)
+    print('Num of parallel jobs initiated: ', n_jobs, '\n')
 
+    configs = [(fwhm, size) for fwhm in smooth_fwhm for size in resample_size]  # all combinations
     features_path.mkdir(exist_ok=True, parents=True)
+    filenames = {}
+    for fwhm, size in configs:
+        full_filename = str(output_prefix) + '.S' + str(fwhm) + '_R' + str(size)
+        filenames[(fwhm, size)] = os.path.join(features_path, full_filename)
+
+    # with memmap the rows are written while extracting, a rerun resumes from the last finished subject
+    output_files = {config: filename + '.npy' for config, filename in filenames.items()} if memmap else None
+    data_resampled_all = calculate_multi_voxelwise_features(subject_filepaths, mask_file, configs,
+                                                            cascade_smoothing=cascade_smoothing, n_jobs=n_jobs,
+                                                            dtype=dtype, output_files=output_files, prefetch=prefetch,
+                                                            prefetch_max_bytes=prefetch_max_bytes, method=method,
+                                                            operator_cache_dir=operator_cache_dir,
+                                                            batch_size=batch_size)
+
+    for config, data_resampled in data_resampled_all.items():
+        filename = filenames[config]
+        if memmap:
+            print('filename for features created: ', output_files[config])
+        else:
+            print('filename for features created: ', filename)
+            pickle.dump(data_resampled, open(filename, "wb"), protocol=4)
+            data_resampled.to_csv(filename + '.csv', index=False)
 
-    full_filename = str(output_prefix) + '.S' + str(smooth_fwhm) + '_R' + str(resample_size)
-    filename = os.path.join(features_path, full_filename)
-    print('filename for features created: ', filename)
-    pickle.dump(data_resampled, open(filename, "wb"), protocol=4)
-    data_resampled.to_csv(filename + '.csv', index=False)
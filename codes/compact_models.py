@@ -0,0 +1,37 @@
+import pickle
+import argparse
+import numpy as np
+from brainage import read_data, compact_models, save_compact
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_file", type=str, help="saved .models or .scores file (with the CV models)")
+    parser.add_argument("--output_file", type=str, default=None, help="compact file (default: model_file + '.compact')")
+    parser.add_argument("--demographics_file", type=str, default=None,
+                        help="demographics of the training data, to check float32 storage on")
+    parser.add_argument("--features_file", type=str, default=None, help="features of the training data")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float64", "float32"],
+                        help="dtype of PCA components and kernel training data where the check allows it")
+    parser.add_argument("--atol", type=float, default=1e-2, help="largest accepted difference of predictions (years)")
+
+    # python3 compact_models.py --model_file ../results/ixi_camcan_enki_1000brains/4sites.S4_R4_pca.gauss.models \
+    #     --demographics_file ../data/ixi_camcan_enki_1000brains/ixi_camcan_enki_1000brains.subject_list_cat12.8.csv \
+    #     --features_file ../data/ixi_camcan_enki_1000brains/ixi_camcan_enki_1000brains.S4_R4
+
+    args = parser.parse_args()
+    model_file = args.model_file
+    output_file = model_file + '.compact' if args.output_file is None else args.output_file
+    dtype = np.dtype(args.dtype)
+
+    X = None
+    if args.features_file is not None:  # without data the matrices are kept in float64
+        data_df, X_columns, y = read_data(features_file=args.features_file, demographics_file=args.demographics_file)
+        X = data_df[X_columns]
+
+    print('model file: ', model_file)
+    print('compact file: ', output_file)
+    print('dtype: ', dtype if X is not None else np.dtype('float64'))
+
+    models = pickle.load(open(model_file, 'rb'))
+    save_compact(compact_models(models, X, dtype=dtype, atol=args.atol), output_file)
+    print('ALL DONE')
@@ -0,0 +1,61 @@
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+from sklearn.metrics import mean_absolute_error
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--features_file", type=str, help="Features file path (float64)")
+    parser.add_argument("--features_file_float32", type=str, default=None,
+                        help="Features extracted with --dtype float32, defaults to casting --features_file")
+    parser.add_argument("--demographics_file", type=str, default=None, help="Demographics file path with an age column")
+    parser.add_argument("--model_file", type=str, help="Trained model to be used to predict",
+                        default='../trained_models/4sites.S4_R4_pca.gauss.models')
+    parser.add_argument("--output_file", type=str, default=None, help="csv file to save the comparison")
+
+    # python3 compare_dtype_predictions.py --features_file ../data/ADNI/ADNI.S4_R4 --features_file_float32 ../data/ADNI_float32/ADNI.S4_R4 --demographics_file ../data/ADNI/ADNI.subject_list_cat12.8.csv --model_file ../trained_models/4sites.S4_R4_pca.gauss.models
+
+    args = parser.parse_args()
+    features_file = args.features_file
+    features_file_float32 = args.features_file_float32
+    demographics_file = args.demographics_file
+    model_file = args.model_file
+    output_file = args.output_file
+
+    print('Features file (float64): ', features_file)
+    print('Features file (float32): ', features_file_float32)
+    print('Demographics file: ', demographics_file)
+    print('Model used: ', model_file)
+
+    data_df = pickle.load(open(features_file, 'rb')).astype(np.float64)
+    if features_file_float32 is None:
+        data_df_32 = data_df.astype(np.float32)
+    else:
+        data_df_32 = pickle.load(open(features_file_float32, 'rb')).astype(np.float32)
+    X = [col for col in data_df if col.startswith('f_')]
+
+    age = None
+    if demographics_file is not None:
+        age = pd.read_csv(demographics_file)['age'].values
+
+    model = pickle.load(open(model_file, 'rb'))  # load model
+    comparison = []
+    for key, model_value in model.items():
+        y_pred_64 = model_value.predict(data_df[X]).ravel()
+        y_pred_32 = model_value.predict(data_df_32[X]).ravel()
+        abs_diff = np.abs(y_pred_64 - y_pred_32)
+
+        row = {'model': key, 'max_abs_diff': abs_diff.max(), 'mean_abs_diff': abs_diff.mean()}
+        if age is not None:
+            row['mae_float64'] = mean_absolute_error(age, y_pred_64)
+            row['mae_float32'] = mean_absolute_error(age, y_pred_32)
+            row['mae_delta'] = row['mae_float32'] - row['mae_float64']
+        comparison.append(row)
+
+    comparison = pd.DataFrame(comparison)
+    print('\nfloat32 vs float64 predictions\n', comparison)
+
+    if output_file is not None:
+        comparison.to_csv(output_file, index=False)
@@ -4,6 +4,7 @@ import os.path
 import numpy as np
 import pandas as pd
 from sklearn.metrics import mean_absolute_error, mean_squared_error
+from brainage import load_features
 
 def model_pred(test_df, X, y, model_file, workflow_name):
 
@@ -37,7 +38,7 @@ def model_pred(test_df, X, y, model_file, workflow_name):
 
 def read_data(features_file, demographics_file):
     demo_df = pd.read_csv(open(demographics_file, 'rb'))
-    data_df = pickle.load(open(features_file, 'rb'))
+    data_df = load_features(features_file)
     data_df = pd.concat([demo_df, data_df], axis=1)
     data_df = data_df.drop(columns='file_path_cat12.8')
     data_df.rename(columns=lambda X: str(X), inplace=True)  # convert numbers to strings as column names
@@ -83,7 +84,7 @@ if __name__ == '__main__':
             features_file = features_path + data_list[idx]  # get test features
             model_file = model_path + data_item + '.' + model_item + '.models' # get models
 
-            if os.path.exists(model_file) and os.path.exists(features_file): # if test data and trained model exists
+            if os.path.exists(model_file) and (os.path.exists(features_file) or os.path.exists(features_file + '.npy')): # if test data and trained model exists
                 print('\n')
                 print('test data', features_file)
                 print('demographic file: ', demographics_file)
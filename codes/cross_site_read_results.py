@@ -2,6 +2,7 @@ import pickle
 import os.path
 import argparse
 import pandas as pd
+from brainage import get_step, glmnet_model
 
 # all possible inputs
 ## cross site (3 sites)
@@ -144,7 +145,7 @@ if __name__ == '__main__':
                     print(key)
 
                     if key == 'gauss':
-                        model = res['gauss']['gauss']
+                        model = get_step(res['gauss'], 'gaussianprocessregressor', 'gauss')
                         # print(model.get_params())
                         print(model.kernel_.get_params())
 
@@ -164,12 +165,12 @@ if __name__ == '__main__':
                         # print(model.get_params())
 
                     elif key == 'rf':
-                        model = res['rf']['rf']
+                        model = get_step(res['rf'], 'randomforestregressor', 'rf')
                         print(model)
                         # print(model.get_params())
 
                     else:
-                        model = res[key]['elasticnet']
+                        model = glmnet_model(res[key])
                         # print(model.get_params())
                         print(model.lambda_best_)
 
@@ -1,16 +1,18 @@
 import time
 import pickle
+import shutil
 import argparse
 import pandas as pd
 from pathlib import Path
 
-from brainage import read_data, XGBoostAdapted
+from brainage import read_data, XGBoostAdapted, KernelRidge, clear_kernel_caches, GaussianProcessRegressor
+from brainage import set_preprocessing_cache, CachedVarianceThreshold, CachedStandardScaler, CachedPCA
+from brainage import GramPCA, CachedGramPCA
+from brainage import ElasticNetMix, mix_scores, with_predict_alpha
+from brainage import RandomForestRegressor, RVR, ElasticNet, set_checkpoint_dir
 
 import xgboost as xgb
-from skrvm import RVR
-from glmnet import ElasticNet
 import sklearn.gaussian_process as gp
-from sklearn.kernel_ridge import KernelRidge
 from sklearn.decomposition import PCA
 from sklearn.feature_selection import VarianceThreshold
 from sklearn.model_selection import RepeatedStratifiedKFold
@@ -21,6 +23,9 @@ from julearn.transformers import register_transformer
 
 start_time = time.time()
 
+# glmnet mixing value of the models fit together by the glmnet model
+glmnet_alphas = {'ridge': 0, 'lasso': 1, 'elasticnet': 0.5}
+
 def none_or_str(value):
     if value == 'None':
         return None
@@ -33,11 +38,30 @@ if __name__ == '__main__':
     parser.add_argument("--output_path", type=str, help="Path to output directory")
     parser.add_argument("--output_prefix", type=str, help="Output prefix (used {dataname}.{featurename}")
     parser.add_argument("--models", type=str, nargs='?', const=1, default="ridge",
-                       help="models to use (comma seperated no space): ridge,rf,rvr_linear")
+                       help="models to use (comma seperated no space): ridge,rf,rvr_linear, "
+                             "glmnet fits ridge, lasso and elasticnet together")
     parser.add_argument("--pca_status", type=int, default=0,
                        help="0: no pca, 1: yes pca")
+    parser.add_argument("--pca_solver", type=str, default="sklearn", choices=["sklearn", "gram"],
+                        help="sklearn: PCA, gram: GramPCA (faster for many more features than subjects)")
     parser.add_argument("--confounds", type=none_or_str, help="confounds", default=None)
     parser.add_argument("--n_jobs", type=int, default=1, help="Number of parallel jobs to run")
+    parser.add_argument("--xgb_tree_method", type=str, default="auto", choices=["auto", "exact", "hist"],
+                        help="xgboost tree method, hist trains on binned features and is much faster on voxels")
+    parser.add_argument("--xgb_n_jobs", type=int, default=1,
+                        help="threads of every xgb fit, -1: the CPU share of the process (OMP_NUM_THREADS)")
+    parser.add_argument("--restart_jobs", type=int, default=1,
+                        help="Number of threads running the gauss optimizer restarts")
+    parser.add_argument("--gauss_n_iter_no_change", type=int, default=None,
+                        help="stop the gauss optimizer restarts after this many without improvement (default: all)")
+    parser.add_argument("--gauss_theta_tol", type=float, default=None,
+                        help="stop gauss restarts within this distance of an optimum found before (default: off)")
+    parser.add_argument("--preprocess_cache", type=str, default=None,
+                        help="directory to share fitted variancethreshold/zscore/pca across models and runs")
+    parser.add_argument("--checkpoint", type=int, default=0,
+                        help="0: no checkpoints, 1: keep finished fits in output_path/checkpoints and skip them when "
+                             "the same command is run again (for preemptible jobs). The outputs are the same except "
+                             "fit_time/score_time in the .scores, which time the reload of the finished fits")
 
     configure_logging(level='INFO')
 
@@ -50,7 +74,21 @@ if __name__ == '__main__':
     model_required = [x.strip() for x in args.models.split(',')]  # converts string into list
     confounds = args.confounds
     pca_status = bool(args.pca_status)
+    pca_solver = args.pca_solver
     n_jobs = args.n_jobs
+    restart_jobs = args.restart_jobs
+    gauss_n_iter_no_change = args.gauss_n_iter_no_change
+    gauss_theta_tol = args.gauss_theta_tol
+    xgb_tree_method = args.xgb_tree_method
+    xgb_n_jobs = args.xgb_n_jobs
+    preprocess_cache = args.preprocess_cache
+    set_preprocessing_cache(preprocess_cache)
+    checkpoint = bool(args.checkpoint)
+    # one directory per prefix, PCA setting and models: the jobs of a submit file share the prefix and run at the same
+    # time, the first to finish must not remove the checkpoints of the others
+    pca_name = f'{pca_solver}_pca' if pca_status else 'no_pca'
+    checkpoint_path = output_path / 'checkpoints' / f"{output_prefix}.{pca_name}.{'-'.join(model_required)}"
+    set_checkpoint_dir(checkpoint_path if checkpoint else None)  # before any process pool is started
     output_path.mkdir(exist_ok=True, parents=True) # check and create output directory
 
     # initialize random seed and create test indices
@@ -64,16 +102,29 @@ if __name__ == '__main__':
     print('Ouput prefix: ', output_prefix)
     print('Model:', model_required, type(model_required))
     print('PCA status : ', pca_status)
+    print('PCA solver : ', pca_solver)
     print('Random seed : ', rand_seed)
     print('Num of splits for kfolds : ', n_splits, '\n')
     print('confounds:', confounds, type(confounds))
     print('Num of parallel jobs initiated: ', n_jobs, '\n')
+    print('Num of gauss restart threads: ', restart_jobs)
+    print('gauss early stopping: ', gauss_n_iter_no_change, 'theta tol: ', gauss_theta_tol)
+    print('xgboost tree method: ', xgb_tree_method)
+    print('xgboost threads: ', xgb_n_jobs)
+    print('Preprocessing cache: ', preprocess_cache)
+    print('Checkpoints: ', checkpoint_path if checkpoint else None)
 
     # read the features, demographics and define X and y
     data_df, X, y = read_data(features_file=features_file, demographics_file=demographics_file)
 
     # register VarianceThreshold as a transformer
-    register_transformer('variancethreshold', VarianceThreshold, returned_features='unknown', apply_to='all_features')
+    # with --preprocess_cache the fitted variancethreshold/zscore/pca are shared on disk
+    if preprocess_cache is None:
+        register_transformer('variancethreshold', VarianceThreshold, returned_features='unknown', apply_to='all_features')
+    else:
+        register_transformer('variancethreshold', CachedVarianceThreshold, returned_features='unknown',
+                             apply_to='all_features')
+        register_transformer('cachedzscore', CachedStandardScaler, returned_features='same', apply_to='continuous')
     var_threshold = 1e-5
 
     # Initialize variables, set random seed, create classes for age
@@ -83,24 +134,33 @@ if __name__ == '__main__':
     data_df['bins'] = qc.codes # add bin/classes as a column in train df
 
     # Define all models and model parameters
+    rf = RandomForestRegressor()
     rvr_linear = RVR()
     rvr_poly = RVR()
-    kernel_ridge = KernelRidge()  # kernelridge
+    kernel_ridge = KernelRidge()  # kernelridge, kernel and its eigendecomposition shared by the grid points of a fold
+    gauss = GaussianProcessRegressor()  # restarts on threads (--restart_jobs), early stopping opt-in
     lasso = ElasticNet(alpha=1, standardize=False)
     elasticnet = ElasticNet(alpha=0.5, standardize=False)
     ridge = ElasticNet(alpha=0, standardize=False)
     xgb = XGBoostAdapted(early_stopping_rounds=10, eval_metric='mae', eval_set_percent=0.2)
-    pca = PCA(n_components=None)  # max as many components as sample size
+    glmnet = ElasticNetMix(alphas=list(glmnet_alphas.values()))  # ridge, lasso and elasticnet in one pass
+    # max as many components as sample size
+    if pca_solver == 'gram':
+        pca = GramPCA(n_components=None) if preprocess_cache is None else CachedGramPCA(n_components=None)
+    else:
+        pca = PCA(n_components=None) if preprocess_cache is None else CachedPCA(n_components=None)
 
-    model_names = ['ridge', 'rf', 'rvr_lin', 'kernel_ridge', 'gauss', 'lasso', 'elasticnet', 'rvr_poly', 'xgb']
-    model_list = [ridge, 'rf', rvr_linear, kernel_ridge, 'gauss', lasso, elasticnet, rvr_poly, xgb]
+    model_names = ['ridge', 'rf', 'rvr_lin', 'kernel_ridge', 'gauss', 'lasso', 'elasticnet', 'rvr_poly', 'xgb',
+                   'glmnet']
+    model_list = [ridge, rf, rvr_linear, kernel_ridge, gauss, lasso, elasticnet, rvr_poly, xgb, glmnet]
 
     model_para_list = [{'variancethreshold__threshold': var_threshold, 'elasticnet__random_state': rand_seed,
                         'elasticnet__n_jobs': n_jobs},
 
-                       {'variancethreshold__threshold': var_threshold, 'rf__n_estimators': 500, 'rf__criterion': 'mse',
-                        'rf__max_features': 0.33, 'rf__min_samples_leaf': 5, 'rf__n_jobs':n_jobs,
-                        'rf__random_state': rand_seed},
+                       {'variancethreshold__threshold': var_threshold, 'randomforestregressor__n_estimators': 500,
+                        'randomforestregressor__criterion': 'mse', 'randomforestregressor__max_features': 0.33,
+                        'randomforestregressor__min_samples_leaf': 5, 'randomforestregressor__n_jobs': n_jobs,
+                        'randomforestregressor__random_state': rand_seed},
 
                        {'variancethreshold__threshold': var_threshold, 'rvr__kernel': 'linear',
                         'rvr__random_state': rand_seed},
@@ -111,8 +171,12 @@ if __name__ == '__main__':
                         'search_params': {'n_jobs': n_jobs}},
 
                        {'variancethreshold__threshold': var_threshold,
-                        'gauss__kernel': gp.kernels.RBF(10.0, (1e-7, 10e7)), 'gauss__n_restarts_optimizer': 100,
-                        'gauss__normalize_y': True, 'gauss__random_state': rand_seed},
+                        'gaussianprocessregressor__kernel': gp.kernels.RBF(10.0, (1e-7, 10e7)),
+                        'gaussianprocessregressor__n_restarts_optimizer': 100,
+                        'gaussianprocessregressor__normalize_y': True, 'gaussianprocessregressor__random_state': rand_seed,
+                        'gaussianprocessregressor__n_jobs': restart_jobs,
+                        'gaussianprocessregressor__n_iter_no_change': gauss_n_iter_no_change,
+                        'gaussianprocessregressor__theta_tol': gauss_theta_tol},
 
                        {'variancethreshold__threshold': var_threshold, 'elasticnet__random_state': rand_seed,
                         'elasticnet__n_jobs': n_jobs},
@@ -123,23 +187,28 @@ if __name__ == '__main__':
                        {'variancethreshold__threshold': var_threshold, 'rvr__kernel': 'poly', 'rvr__degree': 1,
                         'rvr__random_state': rand_seed},
 
-                        {'variancethreshold__threshold': var_threshold, 'xgboostadapted__n_jobs': 1,
+                        {'variancethreshold__threshold': var_threshold, 'xgboostadapted__n_jobs': xgb_n_jobs,
                          'xgboostadapted__max_depth': [1, 2, 3, 6, 8], 'xgboostadapted__n_estimators': 100,
                          'xgboostadapted__reg_alpha': [0.0001, 0.01, 0.1, 1, 10],
                          'xgboostadapted__reg_lambda': [0.0001, 0.01, 0.1, 1, 10, 20],
-                         'xgboostadapted__random_seed': rand_seed, 'search_params': {'n_jobs': n_jobs}}]
+                         'xgboostadapted__random_seed': rand_seed, 'xgboostadapted__tree_method': xgb_tree_method,
+                         'search_params': {'n_jobs': n_jobs}},
+
+                       {'variancethreshold__threshold': var_threshold, 'elasticnetmix__random_state': rand_seed,
+                        'elasticnetmix__n_jobs': n_jobs}]
 
     # Define processing for X (features)
+    zscore = 'zscore' if preprocess_cache is None else 'cachedzscore'
     if confounds is None:
         if pca_status:
-            preprocess_X = ['variancethreshold', 'zscore', pca]
+            preprocess_X = ['variancethreshold', zscore, pca]
         else:
-            preprocess_X = ['variancethreshold', 'zscore']
+            preprocess_X = ['variancethreshold', zscore]
     else:
         if pca_status:
-            preprocess_X = ['variancethreshold', 'zscore', 'remove_confound', pca]
+            preprocess_X = ['variancethreshold', zscore, 'remove_confound', pca]
         else:
-            preprocess_X = ['variancethreshold', 'zscore', 'remove_confound']
+            preprocess_X = ['variancethreshold', zscore, 'remove_confound']
     print('Preprocessing includes:', preprocess_X)
      
     # Get the model, its parameters, pca status and train
@@ -152,28 +221,42 @@ if __name__ == '__main__':
         # initialize dictionaries to save scores and models here to save every model separately
         scores_cv, models = {}, {}
         
-        cv = RepeatedStratifiedKFold(n_splits=n_splits, n_repeats=n_repeats, random_state=rand_seed).split(data_df, data_df.bins)
+        # a list, the glmnet mode scores the folds again for every mixing value
+        cv = list(RepeatedStratifiedKFold(n_splits=n_splits, n_repeats=n_repeats,
+                                          random_state=rand_seed).split(data_df, data_df.bins))
 
         scores, model = run_cross_validation(X=X, y=y, data=data_df, preprocess_X=preprocess_X, confounds=confounds,
                                              problem_type='regression', model=model_list[i], cv=cv,
                                      return_estimator='all', model_params=model_para_list[i], seed=rand_seed,
                                              scoring=
                                      ['neg_mean_absolute_error', 'neg_mean_squared_error','r2'], n_jobs=n_jobs) # adapted run_cross_validation to give n_jobs
-
-        scores_cv[model_names[i]] = scores
-
-        if model_names[i] == 'kernel_ridge' or model_names[i] == 'xgb':
-            models[model_names[i]] = model.best_estimator_
-            print('best model', model.best_estimator_)
-            print('best para', model.best_params_)
-        else:
-            models[model_names[i]] = model
+        clear_kernel_caches()  # the kernel_ridge searches are done
+
+        if model_names[i] == 'glmnet':  # ridge, lasso and elasticnet from one fit, saved under their own names
+            X_predict = X if confounds is None else X + [confounds]
+            alpha_scores = mix_scores(scores, cv, data_df, X_predict, y, return_estimator=True)
+            for name, alpha in glmnet_alphas.items():
+                scores_cv[name] = {name: alpha_scores[alpha]}
+                models[name] = {name: with_predict_alpha(model, alpha)}
             print('best model', model)
-
-        print('Output file name')
-        print(output_path / f'{output_prefix}.{model_names[i]}.models')
-        pickle.dump(models, open(output_path / f'{output_prefix}.{model_names[i]}.models', "wb"))
-        pickle.dump(scores_cv, open(output_path / f'{output_prefix}.{model_names[i]}.scores', "wb"))
+        else:
+            scores_cv[model_names[i]] = {model_names[i]: scores}
+            if model_names[i] == 'kernel_ridge' or model_names[i] == 'xgb':
+                models[model_names[i]] = {model_names[i]: model.best_estimator_}
+                print('best model', model.best_estimator_)
+                print('best para', model.best_params_)
+            else:
+                models[model_names[i]] = {model_names[i]: model}
+                print('best model', model)
+
+        for name in models:
+            print('Output file name')
+            print(output_path / f'{output_prefix}.{name}.models')
+            pickle.dump(models[name], open(output_path / f'{output_prefix}.{name}.models', "wb"))
+            pickle.dump(scores_cv[name], open(output_path / f'{output_prefix}.{name}.scores', "wb"))
+
+    if checkpoint:  # all outputs are written, a new run starts from scratch
+        shutil.rmtree(checkpoint_path)
 
     print('ALL DONE')
     print("--- %s seconds ---" % (time.time() - start_time))
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
 #from read_data_mask_resampled import *
-from brainage import calculate_voxelwise_features
+from brainage import calculate_voxelwise_features, ExtractionPlan, load_compact
+from brainage import load_model_store, is_model_store
 from pathlib import Path
 import pandas as pd
+import numpy as np
 import argparse
 import pickle
 import os
@@ -14,18 +16,22 @@ def model_pred(test_df, model_file, feature_space_str):
     """This functions predicts age
     Args:
         test_df (dataframe): test data
-        model_file (pickle file): trained model file
+        model_file (pickle file): trained model file (.models, its compact_models.py .compact or a
+            store_models.py .store directory)
         feature_space_str (string): feature space name
 
     Returns:
         dataframe: predictions from the model
     """    
 
-    model = pickle.load(open(model_file, 'rb')) # load model
+    if is_model_store(model_file):  # large arrays memory-mapped, shared by concurrent predictions
+        model = load_model_store(model_file)
+    elif model_file.endswith('.compact'):  # predict-only models, see compact_models.py
+        model = load_compact(model_file)
+    else:
+        model = pickle.load(open(model_file, 'rb')) # load model
     pred = pd.DataFrame()
     for key, model_value in model.items():
-        X = data_df.columns.tolist()
-        pre_X, pre_X2 = model_value.preprocess(test_df[X], test_df[X])  # preprocessed data
         y_pred = model_value.predict(test_df).ravel()
         print(y_pred.shape)
         pred[feature_space_str + '+' + key] = y_pred
@@ -42,8 +48,16 @@ if __name__ == "__main__":
                         default='../masks/brainmask_12.8.nii')
     parser.add_argument("--smooth_fwhm", type=int, help="smoothing FWHM", default=4)
     parser.add_argument("--resample_size", type=int, help="resampling kernel size", default=4)
-    parser.add_argument("--model_file", type=str, help="Trained model to be used to predict",
+    parser.add_argument("--model_file", type=str, help="Trained model to be used to predict (.models, .compact or .store)",
                         default='../trained_models/4sites.S4_R4_pca.gauss.models')
+    parser.add_argument("--dtype", type=str, default="float64", choices=["float64", "float32"],
+                        help="floating point type of the features used for prediction")
+    parser.add_argument("--feature_cache", type=str, default=None,
+                        help="directory of a per subject feature cache, only new or changed subjects are extracted")
+    parser.add_argument("--method", type=str, default="nilearn", choices=["nilearn", "operator"],
+                        help="feature extraction: nilearn smooth + resample, or a precompiled sparse operator")
+    parser.add_argument("--operator_cache_dir", type=str, default=None,
+                        help="directory to keep the sparse extraction matrices across runs (operator method)")
     # For testing
     # python3 predict_age.py --features_path ../data/ADNI --subject_filepaths ../data/ADNI/ADNI_paths_cat12.8.csv --output_path ../results/ADNI --output_prefix ADNI --mask_file ../masks/brainmask_12.8.nii  --smooth_fwhm 4 --resample_size 4 --model_file ../trained_models/4sites.S4_R4_pca.gauss.models
 
@@ -56,6 +70,10 @@ if __name__ == "__main__":
     resample_size = args.resample_size
     mask_file = args.mask_file
     model_file = args.model_file
+    dtype = np.dtype(args.dtype)
+    feature_cache = args.feature_cache
+    method = args.method
+    operator_cache_dir = args.operator_cache_dir
 
     print('\nBrain-age trained model used: ', model_file)
     print('Subjects filepaths (test data): ', subject_filepaths)
@@ -63,6 +81,9 @@ if __name__ == "__main__":
     print('Results directory: ', output_path)
     print('Results filename prefix: ', output_prefix)
     print('GM mask used: ', mask_file)
+    print('Features dtype: ', dtype)
+    print('Feature cache: ', feature_cache)
+    print('Extraction method: ', method)
 
     # get feature space name from the model file entered and
     # create feature space name using the input values (smoothing, resampling)
@@ -94,14 +115,17 @@ if __name__ == "__main__":
     features_fullfile = os.path.join(features_path, features_filename)
     print('\nfilename for features created: ', features_fullfile)
 
-    if os.path.isfile(features_fullfile): # check if features file exists
+    if os.path.isfile(features_fullfile) and feature_cache is None: # check if features file exists
         print('\n----File exists')
-        data_df = pickle.load(open(features_fullfile, 'rb'))
+        data_df = pickle.load(open(features_fullfile, 'rb')).astype(dtype)
         print('Features loaded')
     else:
         print('\n-----Extracting features')
-        # create features
-        data_df = calculate_voxelwise_features(subject_filepaths, mask_file, smooth_fwhm=smooth_fwhm, resample_size=resample_size)
+        # create features, the mask is loaded and resampled once for all subjects
+        plan = ExtractionPlan(mask_file, smooth_fwhm=smooth_fwhm, resample_size=resample_size, dtype=dtype)
+        data_df = calculate_voxelwise_features(subject_filepaths, mask_file, smooth_fwhm=smooth_fwhm,
+                                               resample_size=resample_size, plan=plan, cache_dir=feature_cache,
+                                               method=method, operator_cache_dir=operator_cache_dir)
         # save features
         pickle.dump(data_df, open(features_fullfile, "wb"), protocol=4)
         data_df.to_csv(features_fullfile + '.csv', index=False)
@@ -0,0 +1,38 @@
+import json
+import argparse
+from pathlib import Path
+from brainage import build_workflow, run_workflow
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--grid", type=str, help="json file with the grid of the workflow (see brainage.build_workflow)")
+    parser.add_argument("--n_cpus", type=int, default=None, help="CPUs to use (default: all)")
+    parser.add_argument("--log_dir", type=str, default=None, help="directory of the task logs (default: ../logs)")
+    parser.add_argument("--dry_run", type=int, default=0, help="1: only print the commands that would run")
+
+    # python3 run_workflow.py --grid within_site_ixi.grid.json --n_cpus 10
+    # print what is outdated without running it:
+    # python3 run_workflow.py --grid within_site_ixi.grid.json --dry_run 1
+
+    args = parser.parse_args()
+    with open(args.grid) as f:
+        grid = json.load(f)
+
+    codes_dir = Path(__file__).resolve().parent  # relative paths of the grid are relative to codes/, as in .submit files
+    tasks = build_workflow(grid)
+    print('Grid: ', args.grid)
+    print('Number of tasks: ', len(tasks))
+    print('CPUs: ', args.n_cpus, '\n')
+
+    status = run_workflow(tasks, n_cpus=args.n_cpus, cwd=str(codes_dir), log_dir=args.log_dir,
+                          dry_run=bool(args.dry_run))
+
+    for state in ['up to date', 'done', 'dry run', 'failed', 'skipped']:
+        names = [name for name, value in status.items() if value == state]
+        if names:
+            print(f'{state}: {len(names)}')
+    failed = [name for name, value in status.items() if value == 'failed']
+    if failed:
+        print('failed tasks: ', failed)
+        raise SystemExit(1)
+    print('ALL DONE')
@@ -0,0 +1,28 @@
+import pickle
+import argparse
+from brainage import save_model_store, prune_model_store
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_file", type=str, help="saved .models, .scores or .compact file")
+    parser.add_argument("--output_path", type=str, default=None,
+                        help="directory of the store (default: model_file + '.store')")
+    parser.add_argument("--min_kb", type=int, default=64, help="arrays from this size (KB) on are memory-mapped")
+    parser.add_argument("--prune", type=int, default=0,
+                        help="1: remove array files earlier saves to the store used (not while predictions read it)")
+
+    # python3 store_models.py --model_file ../trained_models/4sites.S4_R4_pca.gauss.models
+    # python3 predict_age.py ... --model_file ../trained_models/4sites.S4_R4_pca.gauss.models.store
+
+    args = parser.parse_args()
+    model_file = args.model_file
+    output_path = model_file + '.store' if args.output_path is None else args.output_path
+
+    print('model file: ', model_file)
+    print('store: ', output_path)
+
+    models = pickle.load(open(model_file, 'rb'))
+    save_model_store(models, output_path, min_bytes=args.min_kb * 2 ** 10)
+    if args.prune:
+        print('removed array files: ', len(prune_model_store(output_path)))
+    print('ALL DONE')
@@ -3,6 +3,7 @@ import os.path
 import argparse
 import pandas as pd
 import numpy as np
+from brainage import get_step, glmnet_model
 
 # all possible inputs
 ## within site
@@ -178,7 +179,7 @@ if __name__ == '__main__':
                             print(res[key1]['linreg']['linreg'].intercept_, res[key1]['linreg']['linreg'].coef_)
 
                         elif key2 == 'gauss':
-                            model = res[key1]['gauss']['gauss']
+                            model = get_step(res[key1]['gauss'], 'gaussianprocessregressor', 'gauss')
                             # print(model.get_params())
                             print(model.kernel_.get_params())
 
@@ -195,7 +196,7 @@ if __name__ == '__main__':
                             print(model)
 
                         elif key2 == 'rf':
-                            model = res[key1]['rf']['rf']
+                            model = get_step(res[key1]['rf'], 'randomforestregressor', 'rf')
                             print(model)
 
                         elif key2 == 'xgb':
@@ -203,7 +204,7 @@ if __name__ == '__main__':
                             print(model)
 
                         else:  # for lasso, ridge, elasticnet
-                            model = res[key1][key2]['elasticnet']
+                            model = glmnet_model(res[key1][key2])
                             print(model.lambda_best_)
 
             else:
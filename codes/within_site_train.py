@@ -1,18 +1,23 @@
+import os
 import time
 import math
 import pickle
+import shutil
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 from pathlib import Path
 
-from brainage import stratified_splits, read_data, XGBoostAdapted, performance_metric
+from brainage import stratified_splits, read_data, XGBoostAdapted, performance_metric, KernelRidge, clear_kernel_caches
+from brainage import GaussianProcessRegressor, ElasticNetMix, mix_scores, with_predict_alpha
+from brainage import RandomForestRegressor, RVR, ElasticNet, set_checkpoint_dir, checkpoint_dir, load_or_run
+from brainage.cache_utils import array_key
+from brainage import set_preprocessing_cache, preprocessing_cache_dir
+from brainage import CachedVarianceThreshold, CachedStandardScaler, CachedPCA, GramPCA, CachedGramPCA
 
 import xgboost as xgb
-from skrvm import RVR
-from glmnet import ElasticNet
 import sklearn.gaussian_process as gp
-from sklearn.kernel_ridge import KernelRidge
 from sklearn.decomposition import PCA
 from sklearn.feature_selection import VarianceThreshold
 from sklearn.model_selection import RepeatedStratifiedKFold
@@ -23,6 +28,123 @@ from julearn.transformers import register_transformer
 
 start_time = time.time()
 
+# glmnet mixing value of the models fit together by the glmnet model
+glmnet_alphas = {'ridge': 0, 'lasso': 1, 'elasticnet': 0.5}
+
+
+def register_transformers():
+    # register VarianceThreshold as a transformer (again in every worker process)
+    # with --preprocess_cache the fitted variancethreshold/zscore/pca are shared on disk
+    if preprocessing_cache_dir() is None:
+        register_transformer('variancethreshold', VarianceThreshold, returned_features='unknown', apply_to='all_features')
+    else:
+        register_transformer('variancethreshold', CachedVarianceThreshold, returned_features='unknown',
+                             apply_to='all_features')
+        register_transformer('cachedzscore', CachedStandardScaler, returned_features='same', apply_to='continuous')
+
+
+def init_worker(n_threads):
+    # the thread share of every outer fold worker, used by the xgb fits with --xgb_n_jobs -1 (see thread_budget)
+    os.environ['OMP_NUM_THREADS'] = str(n_threads)
+    register_transformers()
+
+
+def train_outer_fold(repeat_key, test_idx, data_df, X, y, model_name, model, model_params, preprocess_X,
+                     num_splits, n_repeats, rand_seed):
+    """Train and test one outer fold, the seeds only depend on the fold so folds can run in any process
+
+    Returns scores, final models and test results as dicts keyed by output model name (ridge, lasso and
+    elasticnet for the glmnet model, model_name otherwise)
+    """
+    all_idx = np.array(range(0, len(data_df)))
+    print('\n \n--Repeat', repeat_key)
+    train_idx = np.delete(all_idx, test_idx)  # get train indices
+    train_df, test_df = data_df.loc[train_idx,:], data_df.loc[test_idx,:]  # get test and train dataframes
+    train_df, test_df = train_df.reset_index(drop=True), test_df.reset_index(drop=True)
+    print('train size:', train_df.shape, 'test size:', test_df.shape)
+    qc = pd.cut(train_df[y].tolist(), bins=5)  # create bins for only train set using age, use this for stratification
+    # print('age_bins', qc.categories, 'age_codes', qc.codes)
+
+    # a list, the glmnet mode scores the inner folds again for every mixing value
+    cv = list(RepeatedStratifiedKFold(n_splits=num_splits, n_repeats=n_repeats,
+                                      random_state=rand_seed).split(train_df, qc.codes))
+    return_estimator = 'all' if model_name == 'glmnet' else 'final'
+
+    scores, model = run_cross_validation(X=X, y=y, data=train_df, preprocess_X=preprocess_X,
+                                         problem_type='regression', model=model, cv=cv,
+                                 return_estimator=return_estimator, model_params=model_params, seed=rand_seed,
+                                         scoring=
+                                 ['neg_mean_absolute_error', 'neg_mean_squared_error','r2'])
+
+    if model_name == 'glmnet':  # ridge, lasso and elasticnet from one fit, saved under their own names
+        alpha_scores = mix_scores(scores, cv, train_df, X, y)
+        fold_scores = {name: alpha_scores[alpha] for name, alpha in glmnet_alphas.items()}
+        final_models = {name: with_predict_alpha(model, alpha) for name, alpha in glmnet_alphas.items()}
+        predictors = final_models
+        print('best model', model)
+    elif model_name == 'kernel_ridge' or model_name == 'xgb':
+        fold_scores = {model_name: scores}
+        final_models = {model_name: model.best_estimator_}
+        predictors = {model_name: model}
+        print('best model', model.best_estimator_)
+        print('best para', model.best_params_)
+    else:
+        fold_scores, final_models, predictors = {model_name: scores}, {model_name: model}, {model_name: model}
+        print('best model', model)
+
+    # Predict on test split
+    results = {}
+    for name, predictor in predictors.items():
+        y_true = test_df[y]
+        y_pred = predictor.predict(test_df[X]).ravel()
+        y_delta = y_true - y_pred
+        print(name, y_true.shape, y_pred.shape)
+
+        mae, mse, corr = performance_metric(y_true, y_pred)
+        print('MAE:', mae, 'MSE:', mse, 'CoRR', corr)
+        results[name] = {'predictions': y_pred, 'true': y_true, 'test_idx': test_idx,
+                         'delta': y_delta, 'mae': mae, 'mse': mse, 'corr': corr}
+    clear_kernel_caches()  # the kernel_ridge search of this fold is done
+    return fold_scores, final_models, results
+
+
+def fold_checkpoint_names(test_indices, fold_args):
+    """Checkpoint file name of every outer fold
+
+    The names hold a hash of the features and targets, the model, its parameters, the preprocessing (PCA and its
+    solver), the CV settings and the test indices, so a run with other features or settings writing to the same
+    checkpoint directory does not load these folds. The data is only hashed when checkpoints are enabled.
+    """
+    if checkpoint_dir() is None:
+        return {repeat_key: None for repeat_key in test_indices}
+    data_df, X, y, model_name = fold_args[:4]
+    run_key = array_key(data_df[X].to_numpy(), data_df[y].to_numpy(), prefix=repr(fold_args[1:]))
+    return {repeat_key: f'{model_name}.fold_{repeat_key}.{array_key(test_idx, prefix=run_key)}.pkl'
+            for repeat_key, test_idx in test_indices.items()}
+
+
+def run_outer_folds(test_indices, fold_args, n_jobs=1):
+    """Yield (repeat_key, train_outer_fold results) in fold order, folds run on a process pool if n_jobs != 1
+
+    With checkpoints enabled (set_checkpoint_dir) every finished fold is stored, and a rerun loads it instead of
+    training it again.
+    """
+    names = fold_checkpoint_names(test_indices, fold_args)
+    if n_jobs == 1:
+        for repeat_key, test_idx in test_indices.items():
+            yield repeat_key, load_or_run(names[repeat_key], train_outer_fold, repeat_key, test_idx, *fold_args)
+        return
+
+    n_workers = len(test_indices) if n_jobs < 0 else min(n_jobs, len(test_indices))
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker,
+                             initargs=(max(os.cpu_count() // n_workers, 1),)) as executor:
+        futures = {repeat_key: executor.submit(load_or_run, names[repeat_key], train_outer_fold,
+                                               repeat_key, test_idx, *fold_args)
+                   for repeat_key, test_idx in test_indices.items()}
+        for repeat_key, future in futures.items():
+            yield repeat_key, future.result()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--demographics_file", type=str, help="Demographics file path")
@@ -30,20 +152,59 @@ if __name__ == '__main__':
     parser.add_argument("--output_path", type=str, help="Path to output directory")
     parser.add_argument("--output_prefix", type=str, help="Output prefix (used {dataname}.{featurename}")
     parser.add_argument("--models", type=str, nargs='?', const=1, default="ridge",
-                       help="models to use (comma seperated no space): ridge,rf,rvr_linear")
+                       help="models to use (comma seperated no space): ridge,rf,rvr_linear, "
+                             "glmnet fits ridge, lasso and elasticnet together")
     parser.add_argument("--pca_status", type=int, default=0,
                        help="0: no pca, 1: yes pca")
+    parser.add_argument("--pca_solver", type=str, default="sklearn", choices=["sklearn", "gram"],
+                        help="sklearn: PCA, gram: GramPCA (faster for many more features than subjects)")
+    parser.add_argument("--n_jobs", type=int, default=1,
+                        help="Number of outer folds to run in parallel, -1 for all of them")
+    parser.add_argument("--xgb_tree_method", type=str, default="auto", choices=["auto", "exact", "hist"],
+                        help="xgboost tree method, hist trains on binned features and is much faster on voxels")
+    parser.add_argument("--xgb_n_jobs", type=int, default=1,
+                        help="threads of every xgb fit, -1: the CPU share of the process (OMP_NUM_THREADS)")
+    parser.add_argument("--restart_jobs", type=int, default=1,
+                        help="Number of threads running the gauss optimizer restarts")
+    parser.add_argument("--gauss_n_iter_no_change", type=int, default=None,
+                        help="stop the gauss optimizer restarts after this many without improvement (default: all)")
+    parser.add_argument("--gauss_theta_tol", type=float, default=None,
+                        help="stop gauss restarts within this distance of an optimum found before (default: off)")
+    parser.add_argument("--preprocess_cache", type=str, default=None,
+                        help="directory to share fitted variancethreshold/zscore/pca across models and runs")
+    parser.add_argument("--checkpoint", type=int, default=0,
+                        help="0: no checkpoints, 1: keep finished folds and fits in output_path/checkpoints and skip "
+                             "them when the same command is run again (for preemptible jobs). The outputs are the "
+                             "same except fit_time/score_time in the .scores of the fold that was interrupted, "
+                             "which time the reload of its finished fits")
 
     configure_logging(level='INFO')
 
     # Parse the arguments
     args = parser.parse_args()
+    if args.n_jobs == 0:
+        parser.error("--n_jobs must be a positive number of folds or -1")
     demographics_file = args.demographics_file
     features_file = args.features_file
     output_path = Path(args.output_path)
     output_prefix = args.output_prefix
     model_required = [x.strip() for x in args.models.split(',')]  # converts string into list
     pca_status = bool(args.pca_status)
+    pca_solver = args.pca_solver
+    n_jobs = args.n_jobs
+    restart_jobs = args.restart_jobs
+    gauss_n_iter_no_change = args.gauss_n_iter_no_change
+    gauss_theta_tol = args.gauss_theta_tol
+    xgb_tree_method = args.xgb_tree_method
+    xgb_n_jobs = args.xgb_n_jobs
+    preprocess_cache = args.preprocess_cache
+    set_preprocessing_cache(preprocess_cache)
+    checkpoint = bool(args.checkpoint)
+    # one directory per prefix, PCA setting and models: the jobs of a submit file share the prefix and run at the same
+    # time, the first to finish must not remove the checkpoints of the others
+    pca_name = f'{pca_solver}_pca' if pca_status else 'no_pca'
+    checkpoint_path = output_path / 'checkpoints' / f"{output_prefix}.{pca_name}.{'-'.join(model_required)}"
+    set_checkpoint_dir(checkpoint_path if checkpoint else None)  # before any process pool is started
     output_path.mkdir(exist_ok=True, parents=True) # check and create output directory
 
     # initialize random seed and create test indices
@@ -57,14 +218,22 @@ if __name__ == '__main__':
     print('Ouput prefix: ', output_prefix)
     print('Model : ', model_required)
     print('PCA status : ', pca_status)
+    print('PCA solver : ', pca_solver)
     print('Random seed : ', rand_seed)
     print('Num of splits for kfolds : ', num_splits, '\n')
+    print('Num of parallel jobs initiated: ', n_jobs, '\n')
+    print('Num of gauss restart threads: ', restart_jobs)
+    print('gauss early stopping: ', gauss_n_iter_no_change, 'theta tol: ', gauss_theta_tol)
+    print('xgboost tree method: ', xgb_tree_method)
+    print('xgboost threads: ', xgb_n_jobs)
+    print('Preprocessing cache: ', preprocess_cache)
+    print('Checkpoints: ', checkpoint_path if checkpoint else None)
 
     # read the features, demographics and define X and y
     data_df, X, y = read_data(features_file=features_file, demographics_file=demographics_file)
 
     # register VarianceThreshold as a transformer
-    register_transformer('variancethreshold', VarianceThreshold, returned_features='unknown', apply_to='all_features')
+    register_transformers()
     var_threshold = 1e-5
 
     # Create stratified splits for outer CV
@@ -73,22 +242,31 @@ if __name__ == '__main__':
                                      shuffle=False, random_state=None)  # creates dictionary of test indices
     
     # Define all models and model parameters
+    rf = RandomForestRegressor()
     rvr_linear = RVR()
     rvr_poly = RVR()
-    kernel_ridge = KernelRidge()
+    kernel_ridge = KernelRidge()  # kernel and its eigendecomposition shared by the grid points of an inner fold
+    gauss = GaussianProcessRegressor()  # restarts on threads (--restart_jobs), early stopping opt-in
     lasso = ElasticNet(alpha=1, standardize=False)
     elasticnet = ElasticNet(alpha=0.5, standardize=False)
     ridge = ElasticNet(alpha=0, standardize=False)
     xgb = XGBoostAdapted(early_stopping_rounds=10, eval_metric='mae', eval_set_percent=0.2)
-    pca = PCA(n_components=None)  # max as many components as sample size
+    glmnet = ElasticNetMix(alphas=list(glmnet_alphas.values()))  # ridge, lasso and elasticnet in one pass
+    # max as many components as sample size
+    if pca_solver == 'gram':
+        pca = GramPCA(n_components=None) if preprocess_cache is None else CachedGramPCA(n_components=None)
+    else:
+        pca = PCA(n_components=None) if preprocess_cache is None else CachedPCA(n_components=None)
     
-    model_names = ['ridge', 'rf', 'rvr_lin', 'kernel_ridge', 'gauss', 'lasso', 'elasticnet', 'rvr_poly', 'xgb']
-    model_list = [ridge, 'rf', rvr_linear, kernel_ridge, 'gauss', lasso, elasticnet, rvr_poly, xgb]
+    model_names = ['ridge', 'rf', 'rvr_lin', 'kernel_ridge', 'gauss', 'lasso', 'elasticnet', 'rvr_poly', 'xgb',
+                   'glmnet']
+    model_list = [ridge, rf, rvr_linear, kernel_ridge, gauss, lasso, elasticnet, rvr_poly, xgb, glmnet]
     model_para_list = [{'variancethreshold__threshold': var_threshold, 'elasticnet__random_state': rand_seed},
 
-                       {'variancethreshold__threshold': var_threshold, 'rf__n_estimators': 500, 'rf__criterion': 'mse',
-                        'rf__max_features': 0.33, 'rf__min_samples_leaf': 5,
-                        'rf__random_state': rand_seed},
+                       {'variancethreshold__threshold': var_threshold, 'randomforestregressor__n_estimators': 500,
+                        'randomforestregressor__criterion': 'mse', 'randomforestregressor__max_features': 0.33,
+                        'randomforestregressor__min_samples_leaf': 5,
+                        'randomforestregressor__random_state': rand_seed},
 
                        {'variancethreshold__threshold': var_threshold, 'rvr__kernel': 'linear',
                         'rvr__random_state': rand_seed},
@@ -98,8 +276,12 @@ if __name__ == '__main__':
                         'kernelridge__kernel': 'polynomial', 'kernelridge__degree': [1, 2], 'cv': 5},
 
                        {'variancethreshold__threshold': var_threshold,
-                        'gauss__kernel': gp.kernels.RBF(10.0, (1e-7, 10e7)), 'gauss__n_restarts_optimizer': 100,
-                        'gauss__normalize_y': True, 'gauss__random_state': rand_seed},
+                        'gaussianprocessregressor__kernel': gp.kernels.RBF(10.0, (1e-7, 10e7)),
+                        'gaussianprocessregressor__n_restarts_optimizer': 100,
+                        'gaussianprocessregressor__normalize_y': True, 'gaussianprocessregressor__random_state': rand_seed,
+                        'gaussianprocessregressor__n_jobs': restart_jobs,
+                        'gaussianprocessregressor__n_iter_no_change': gauss_n_iter_no_change,
+                        'gaussianprocessregressor__theta_tol': gauss_theta_tol},
 
                        {'variancethreshold__threshold': var_threshold, 'elasticnet__random_state': rand_seed},
 
@@ -108,16 +290,20 @@ if __name__ == '__main__':
                        {'variancethreshold__threshold': var_threshold, 'rvr__kernel': 'poly', 'rvr__degree': 1,
                         'rvr__random_state': rand_seed},
 
-                       {'variancethreshold__threshold': var_threshold, 'xgboostadapted__n_jobs': 1,
+                       {'variancethreshold__threshold': var_threshold, 'xgboostadapted__n_jobs': xgb_n_jobs,
                         'xgboostadapted__max_depth': [6, 8, 10, 12], 'xgboostadapted__n_estimators': 100,
                         'xgboostadapted__reg_alpha': [0.001, 0.01, 0.05, 0.1, 0.2],
-                        'xgboostadapted__random_seed': rand_seed, 'cv': 5}]  # 'search_params':{'n_jobs': 5}
+                        'xgboostadapted__random_seed': rand_seed, 'xgboostadapted__tree_method': xgb_tree_method,
+                        'cv': 5},  # 'search_params':{'n_jobs': 5}
+
+                       {'variancethreshold__threshold': var_threshold, 'elasticnetmix__random_state': rand_seed}]
     
     # Define processing for X (features)
+    zscore = 'zscore' if preprocess_cache is None else 'cachedzscore'
     if pca_status:
-        preprocess_X = ['variancethreshold', 'zscore', pca]
+        preprocess_X = ['variancethreshold', zscore, pca]
     else:
-        preprocess_X = ['variancethreshold', 'zscore']
+        preprocess_X = ['variancethreshold', zscore]
     print('Preprocessing includes:', preprocess_X)
     
     # Get the model, its parameters, pca status and train
@@ -127,56 +313,31 @@ if __name__ == '__main__':
         assert model_required[ind] == model_names[i]  # sanity check
         print('model picked from the list', model_names[i], model_list[i], '\n')
 
+        # the glmnet model writes the ridge, lasso and elasticnet files
+        output_names = list(glmnet_alphas) if model_names[i] == 'glmnet' else [model_names[i]]
+
         # initialize dictionaries to save scores, models and results here to save every model separately
-        scores_cv = {k: {} for k in test_indices.keys()}
-        models = {k: {} for k in test_indices.keys()}
-        results = {k: {} for k in test_indices.keys()}
-        
-        for repeat_key in test_indices.keys():
-            all_idx = np.array(range(0, len(data_df)))
-            print('\n \n--Repeat', repeat_key)
-            test_idx = test_indices[repeat_key]  # get test indices
-            train_idx = np.delete(all_idx, test_idx)  # get train indices
-            train_df, test_df = data_df.loc[train_idx,:], data_df.loc[test_idx,:]  # get test and train dataframes
-            train_df, test_df = train_df.reset_index(drop=True), test_df.reset_index(drop=True)
-            print('train size:', train_df.shape, 'test size:', test_df.shape)
-            qc = pd.cut(train_df[y].tolist(), bins=5)  # create bins for only train set using age, use this for stratification
-            # print('age_bins', qc.categories, 'age_codes', qc.codes)
-
-            cv = RepeatedStratifiedKFold(n_splits=num_splits, n_repeats=n_repeats, random_state=rand_seed).split(train_df, qc.codes)
-
-            scores, model = run_cross_validation(X=X, y=y, data=train_df, preprocess_X=preprocess_X,
-                                                 problem_type='regression', model=model_list[i], cv=cv,
-                                         return_estimator='final', model_params=model_para_list[i], seed=rand_seed,
-                                                 scoring=
-                                         ['neg_mean_absolute_error', 'neg_mean_squared_error','r2'])
-
-            scores_cv[repeat_key][model_names[i]] = scores
-
-            if model_names[i] == 'kernel_ridge' or model_names[i] == 'xgb':
-                models[repeat_key][model_names[i]] = model.best_estimator_
-                print('best model', model.best_estimator_)
-                print('best para', model.best_params_)
-            else:
-                models[repeat_key][model_names[i]] = model
-                print('best model', model)
-
-            # Predict on test split
-            y_true = test_df[y]
-            y_pred = model.predict(test_df[X]).ravel()
-            y_delta = y_true - y_pred
-            print(y_true.shape, y_pred.shape)
-            
-            mae, mse, corr = performance_metric(y_true, y_pred)
-            print('MAE:', mae, 'MSE:', mse, 'CoRR', corr)
-            results[repeat_key][model_names[i]] = {'predictions': y_pred, 'true': y_true, 'test_idx': test_idx,
-                                                   'delta': y_delta, 'mae': mae, 'mse': mse, 'corr': corr}
-
-            print('Output file name')
-            print(output_path / f'{output_prefix}.{model_names[i]}.models')
-            pickle.dump(results, open(output_path / f'{output_prefix}.{model_names[i]}.results', "wb"))
-            pickle.dump(scores_cv, open(output_path / f'{output_prefix}.{model_names[i]}.scores', "wb"))
-            pickle.dump(models, open(output_path / f'{output_prefix}.{model_names[i]}.models', "wb"))
+        scores_cv = {name: {k: {} for k in test_indices.keys()} for name in output_names}
+        models = {name: {k: {} for k in test_indices.keys()} for name in output_names}
+        results = {name: {k: {} for k in test_indices.keys()} for name in output_names}
+
+        # outer folds run in order (n_jobs=1) or concurrently, results are collected in fold order
+        fold_args = (data_df, X, y, model_names[i], model_list[i], model_para_list[i], preprocess_X,
+                     num_splits, n_repeats, rand_seed)
+        for repeat_key, (scores, model, result) in run_outer_folds(test_indices, fold_args, n_jobs):
+            for name in output_names:
+                scores_cv[name][repeat_key][name] = scores[name]
+                models[name][repeat_key][name] = model[name]
+                results[name][repeat_key][name] = result[name]
+
+                print('Output file name')
+                print(output_path / f'{output_prefix}.{name}.models')
+                pickle.dump(results[name], open(output_path / f'{output_prefix}.{name}.results', "wb"))
+                pickle.dump(scores_cv[name], open(output_path / f'{output_prefix}.{name}.scores', "wb"))
+                pickle.dump(models[name], open(output_path / f'{output_prefix}.{name}.models', "wb"))
+
+    if checkpoint:  # all outputs are written, a new run starts from scratch
+        shutil.rmtree(checkpoint_path)
 
     print('ALL DONE')
     print("--- %s seconds ---" % (time.time() - start_time))
@@ -0,0 +1,28 @@
+from brainage.cache_utils import atomic_open, array_key, fit_key, ContentCache
+from sklearn.preprocessing import StandardScaler
+import numpy as np
+import pytest
+
+
+def test_atomic_open(tmp_path):
+    filename = str(tmp_path / 'data.txt')
+    with atomic_open(filename, 'w') as f:
+        f.write('old')
+    with pytest.raises(RuntimeError):
+        with atomic_open(filename, 'w') as f:
+            f.write('partial')
+            raise RuntimeError('preempted')
+    assert open(filename).read() == 'old'
+    assert [p.name for p in tmp_path.iterdir()] == ['data.txt']  # the temporary file is removed
+
+
+def test_keys_and_content_cache():
+    X = np.arange(12.0).reshape(4, 3)
+    assert array_key(X) == array_key(X.copy()) != array_key(X.astype(np.float32))
+    assert fit_key(StandardScaler(), X) != fit_key(StandardScaler(with_mean=False), X)
+
+    cache, n_computed = ContentCache(max_size=2), []
+    for data in [X, X + 1, X, X + 2, X + 1]:
+        cache.get_or_compute(array_key(data), lambda: n_computed.append(1) or data.sum())
+    # X + 1 was evicted by X + 2 after X was used again
+    assert len(n_computed) == 4 and len(cache) == 2
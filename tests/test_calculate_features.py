@@ -0,0 +1,253 @@
+from brainage import calculate_voxelwise_features, calculate_parcelwise_features
+from brainage import calculate_multi_voxelwise_features, load_features
+from nilearn import image
+from brainage import calculate_features
+from brainage.calculate_features import prefetch_images
+from concurrent.futures import Future
+import json
+import nibabel as nib
+import pandas as pd
+import numpy as np
+
+
+def _affine(voxel_size, offset):
+    affine = np.diag([voxel_size, voxel_size, voxel_size, 1.0])
+    affine[:3, 3] = offset
+    return affine
+
+
+def _make_cohort(tmp_path, num_parcels=6):
+    rng = np.random.default_rng(seed=7)
+    mask_file = str(tmp_path / 'mask.nii')
+    nib.save(nib.Nifti1Image(rng.random((20, 24, 18)).astype(np.float32), _affine(1.5, [-15, -18, -13])), mask_file)
+
+    atlas = rng.integers(0, num_parcels + 1, size=(20, 24, 18)).astype(np.float32)
+    atlas[..., :2] = num_parcels  # parcel without any GM after zeroing below
+    atlas_file = str(tmp_path / 'atlas.nii')
+    nib.save(nib.Nifti1Image(atlas, _affine(1.5, [-15, -18, -13])), atlas_file)
+
+    sub_files = []
+    for idx in range(5):
+        data = rng.random((20, 24, 18)).astype(np.float32)
+        data[data < 0.2] = 0
+        data[..., :2] = 0
+        affine = _affine(1.5, [-15, -18, -13]) if idx % 2 else _affine(1.5, [-14.5, -18, -13.2])
+        sub_file = str(tmp_path / f'sub-{idx}.nii')
+        nib.save(nib.Nifti1Image(data, affine), sub_file)
+        sub_files.append(sub_file)
+    sub_files.insert(2, str(tmp_path / 'missing.nii'))  # skipped
+
+    phenotype_file = str(tmp_path / 'paths.csv')
+    pd.DataFrame(sub_files).to_csv(phenotype_file, header=False, index=False)
+    return phenotype_file, mask_file, atlas_file, num_parcels
+
+
+def test_voxelwise_n_jobs(tmp_path):
+    phenotype_file, mask_file, _, _ = _make_cohort(tmp_path)
+    serial = calculate_voxelwise_features(phenotype_file, mask_file, 4, 4)
+    parallel = calculate_voxelwise_features(phenotype_file, mask_file, 4, 4, n_jobs=2)
+
+    assert serial.shape[0] == 5
+    pd.testing.assert_frame_equal(serial, parallel)
+
+
+def test_parcelwise_n_jobs(tmp_path):
+    phenotype_file, _, atlas_file, num_parcels = _make_cohort(tmp_path)
+    serial = calculate_parcelwise_features(phenotype_file, atlas_file, num_parcels)
+    parallel = calculate_parcelwise_features(phenotype_file, atlas_file, num_parcels, n_jobs=2)
+
+    assert serial.shape == (5, num_parcels)
+    pd.testing.assert_frame_equal(serial, parallel)
+
+
+def _reference_parcels(sub_file, atlas_file, num_parcels):
+    # the per parcel loop used before AtlasPlan
+    sub_img, mask_img = nib.load(sub_file), nib.load(atlas_file)
+    sub_data = sub_img.get_fdata()
+    sub_data[sub_data == 0] = np.nan
+    if not np.array_equal(sub_img.affine, mask_img.affine):
+        mask_img = image.resample_to_img(mask_img, sub_img, interpolation='linear')
+    sub_data_parcels = []
+    for num in range(1, num_parcels + 1):
+        sub_mat = sub_data[np.where(mask_img.get_fdata() == num)]
+        sub_data_parcels.append(0 if np.all(np.isnan(sub_mat)) else np.nanmean(sub_mat))
+    return sub_data_parcels
+
+
+def test_parcelwise_matches_loop(tmp_path):
+    phenotype_file, _, atlas_file, num_parcels = _make_cohort(tmp_path)
+    sub_files = [f for f in pd.read_csv(phenotype_file, header=None)[0] if not f.endswith('missing.nii')]
+    expected = pd.DataFrame([_reference_parcels(sub_file, atlas_file, num_parcels) for sub_file in sub_files])
+    expected.rename(columns=lambda X: 'f_' + str(X), inplace=True)
+
+    parcels = calculate_parcelwise_features(phenotype_file, atlas_file, num_parcels)
+    pd.testing.assert_frame_equal(parcels, expected, check_exact=True)
+
+
+def test_multi_atlas_parcelwise(tmp_path):
+    phenotype_file, _, atlas_file, num_parcels = _make_cohort(tmp_path)
+    coarse = nib.load(atlas_file)
+    coarse_file = str(tmp_path / 'atlas_coarse.nii')
+    nib.save(nib.Nifti1Image(np.ceil(coarse.get_fdata() / 2).astype(np.float32), coarse.affine), coarse_file)
+
+    data_parcels = calculate_parcelwise_features(phenotype_file, [atlas_file, coarse_file], [num_parcels, 3], n_jobs=2)
+    assert list(data_parcels) == [num_parcels, 3]
+    pd.testing.assert_frame_equal(data_parcels[num_parcels],
+                                  calculate_parcelwise_features(phenotype_file, atlas_file, num_parcels))
+    pd.testing.assert_frame_equal(data_parcels[3], calculate_parcelwise_features(phenotype_file, coarse_file, 3))
+
+
+def test_atlas_cache(tmp_path, monkeypatch):
+    phenotype_file, _, atlas_file, num_parcels = _make_cohort(tmp_path)
+    cache_dir = str(tmp_path / 'atlases')
+    expected = calculate_parcelwise_features(phenotype_file, atlas_file, num_parcels, atlas_cache_dir=cache_dir)
+    assert len(list((tmp_path / 'atlases').iterdir())) == 1  # one geometry differs from the atlas
+
+    def no_resampling(*args, **kwargs):
+        raise AssertionError("atlas resampled again")
+    monkeypatch.setattr(image, 'resample_to_img', no_resampling)
+    cached = calculate_parcelwise_features(phenotype_file, atlas_file, num_parcels, atlas_cache_dir=cache_dir)
+    pd.testing.assert_frame_equal(cached, expected, check_exact=True)
+
+
+class _SerialExecutor:
+    """ThreadPoolExecutor stand-in loading on submit, to count the images in flight"""
+    submitted = []
+
+    def __init__(self, max_workers):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def submit(self, func, sub_file):
+        self.submitted.append(sub_file)
+        future = Future()
+        future.set_result(func(sub_file))
+        return future
+
+
+def test_prefetch_max_bytes(tmp_path, monkeypatch):
+    phenotype_file, _, _, _ = _make_cohort(tmp_path)
+    sub_files = pd.read_csv(phenotype_file, header=None)[0].tolist()
+    sub_files.remove(str(tmp_path / 'missing.nii'))
+    img_bytes = nib.load(sub_files[0]).get_fdata(dtype=np.float32).nbytes
+    monkeypatch.setattr(calculate_features, 'ThreadPoolExecutor', _SerialExecutor)
+
+    # images submitted when the k-th is yielded, for a cap of none, a tiny one and two images
+    for max_bytes, expected in [(None, [3, 4, 5, 5, 5]), (1, [1, 2, 3, 4, 5]), (2 * img_bytes, [1, 3, 4, 5, 5])]:
+        _SerialExecutor.submitted = []
+        for k, _ in enumerate(prefetch_images(sub_files, depth=3, max_bytes=max_bytes)):
+            assert len(_SerialExecutor.submitted) == expected[k]
+
+
+def test_prefetch(tmp_path):
+    phenotype_file, mask_file, atlas_file, num_parcels = _make_cohort(tmp_path)
+    sub_files = pd.read_csv(phenotype_file, header=None)[0].tolist()
+    sub_files.remove(str(tmp_path / 'missing.nii'))
+    for max_bytes in [None, 1]:  # one image is prefetched under a tiny cap
+        sub_imgs = list(prefetch_images(sub_files, depth=3, max_bytes=max_bytes, n_threads=2))
+        for sub_file, sub_img in zip(sub_files, sub_imgs):
+            np.testing.assert_array_equal(sub_img.get_fdata(), nib.load(sub_file).get_fdata())
+        assert len(sub_imgs) == len(sub_files)
+
+    expected = calculate_voxelwise_features(phenotype_file, mask_file, 4, 4)
+    pd.testing.assert_frame_equal(calculate_voxelwise_features(phenotype_file, mask_file, 4, 4, prefetch=2), expected)
+    pd.testing.assert_frame_equal(
+        calculate_voxelwise_features(phenotype_file, mask_file, 4, 4, method="operator", batch_size=2, prefetch=2),
+        calculate_voxelwise_features(phenotype_file, mask_file, 4, 4, method="operator", batch_size=2))
+    pd.testing.assert_frame_equal(
+        calculate_parcelwise_features(phenotype_file, atlas_file, num_parcels, prefetch=2, prefetch_max_bytes=2 ** 20),
+        calculate_parcelwise_features(phenotype_file, atlas_file, num_parcels))
+
+
+def test_multi_voxelwise(tmp_path):
+    phenotype_file, mask_file, _, _ = _make_cohort(tmp_path)
+    configs = [(0, 4), (4, 4), (8, 4), (4, 8)]
+    exact = calculate_multi_voxelwise_features(phenotype_file, mask_file, configs, cascade_smoothing=False)
+    cascaded = calculate_multi_voxelwise_features(phenotype_file, mask_file, configs, n_jobs=2)
+
+    assert list(exact) == configs
+    for smooth_fwhm, resample_size in configs:
+        single = calculate_voxelwise_features(phenotype_file, mask_file, smooth_fwhm, resample_size)
+        pd.testing.assert_frame_equal(exact[(smooth_fwhm, resample_size)], single)
+        np.testing.assert_allclose(cascaded[(smooth_fwhm, resample_size)], single, rtol=0, atol=1e-4)
+
+    operator = calculate_multi_voxelwise_features(phenotype_file, mask_file, configs, method="operator", batch_size=2)
+    for config in configs:
+        np.testing.assert_allclose(operator[config], exact[config], rtol=1e-5, atol=1e-6)
+
+
+def test_float32_features(tmp_path):
+    phenotype_file, mask_file, atlas_file, num_parcels = _make_cohort(tmp_path)
+    voxels_64 = calculate_voxelwise_features(phenotype_file, mask_file, 4, 4)
+    voxels_32 = calculate_voxelwise_features(phenotype_file, mask_file, 4, 4, dtype=np.float32)
+    parcels_64 = calculate_parcelwise_features(phenotype_file, atlas_file, num_parcels)
+    parcels_32 = calculate_parcelwise_features(phenotype_file, atlas_file, num_parcels, dtype=np.float32)
+
+    assert (voxels_32.dtypes == np.float32).all() and (parcels_32.dtypes == np.float32).all()
+    np.testing.assert_allclose(voxels_32, voxels_64, rtol=1e-6)
+    np.testing.assert_allclose(parcels_32, parcels_64, rtol=1e-5)
+
+
+def test_crop_img_dtype(tmp_path):
+    # float64 images are smoothed in float32 with dtype float32
+    img = nib.Nifti1Image(np.random.default_rng(seed=3).random((10, 12, 9)), _affine(1.5, [-7, -9, -6]))
+    slices = (slice(1, 8), slice(2, 11), slice(0, 9))
+    assert calculate_features.crop_img(img, slices, np.float32).get_data_dtype() == np.float32
+    assert calculate_features.crop_img(img, slices, np.float64).get_data_dtype() == np.float64
+    cropped = calculate_features.crop_img(img, slices)
+    np.testing.assert_array_equal(cropped.get_fdata(), img.get_fdata()[slices])
+    assert image.smooth_img(calculate_features.crop_img(img, slices, np.float32), 4).get_data_dtype() == np.float32
+
+
+def test_feature_cache(tmp_path):
+    phenotype_file, mask_file, _, _ = _make_cohort(tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+    expected = calculate_voxelwise_features(phenotype_file, mask_file, 4, 4)
+    cached = calculate_voxelwise_features(phenotype_file, mask_file, 4, 4, cache_dir=cache_dir)
+    pd.testing.assert_frame_equal(cached, expected)
+
+    # change one subject, only that one is extracted again
+    sub_files = pd.read_csv(phenotype_file, header=None)[0].tolist()
+    changed = nib.load(sub_files[0])
+    nib.save(nib.Nifti1Image(changed.get_fdata(dtype=np.float32) * 2, changed.affine), sub_files[0])
+    updated = calculate_voxelwise_features(phenotype_file, mask_file, 4, 4, cache_dir=cache_dir)
+
+    np.testing.assert_allclose(updated.iloc[0], expected.iloc[0] * 2, rtol=1e-6)
+    pd.testing.assert_frame_equal(updated.iloc[1:], expected.iloc[1:])
+    assert len(list(next((tmp_path / 'cache').iterdir()).iterdir())) == 6
+
+    configs = [(0, 4), (4, 8)]
+    multi = calculate_multi_voxelwise_features(phenotype_file, mask_file, configs, cache_dir=cache_dir)
+    multi_cached = calculate_multi_voxelwise_features(phenotype_file, mask_file, configs, cache_dir=cache_dir)
+    for config in configs:
+        pd.testing.assert_frame_equal(multi[config], multi_cached[config])
+
+
+def test_memmap_output_resume(tmp_path):
+    phenotype_file, mask_file, _, _ = _make_cohort(tmp_path)
+    output_file = str(tmp_path / 'features.S4_R4.npy')
+    expected = calculate_voxelwise_features(phenotype_file, mask_file, 4, 4)
+    streamed = calculate_voxelwise_features(phenotype_file, mask_file, 4, 4, output_file=output_file)
+    pd.testing.assert_frame_equal(streamed, expected)
+    np.testing.assert_array_equal(load_features(output_file[:-4]), expected)
+
+    # preempted after two subjects: the rest is extracted on the rerun
+    progress = json.load(open(output_file + '.progress.json'))
+    progress['n_done'] = 2
+    json.dump(progress, open(output_file + '.progress.json', 'w'))
+    data = np.load(output_file, mmap_mode='r+')
+    data[2:] = 0
+    data.flush()
+    del data
+    resumed = calculate_voxelwise_features(phenotype_file, mask_file, 4, 4, output_file=output_file)
+    pd.testing.assert_frame_equal(resumed, expected)
+
+    output_files = {(4, 4): output_file, (0, 8): str(tmp_path / 'features.S0_R8.npy')}
+    multi = calculate_multi_voxelwise_features(phenotype_file, mask_file, list(output_files),
+                                               output_files=output_files)
+    pd.testing.assert_frame_equal(multi[(4, 4)], expected)
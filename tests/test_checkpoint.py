@@ -0,0 +1,48 @@
+from brainage import checkpointed_fit, load_or_run
+from brainage.checkpoint import CHECKPOINT_DIR_ENV
+from sklearn.linear_model import Ridge
+import numpy as np
+import pytest
+
+
+class _CountingRidge(Ridge):
+    n_fits = 0
+
+    @checkpointed_fit
+    def fit(self, X, y, sample_weight=None):
+        type(self).n_fits += 1
+        return super().fit(X, y, sample_weight=sample_weight)
+
+
+def test_checkpointed_fit(tmp_path, monkeypatch):
+    rng = np.random.default_rng(seed=4)
+    X, y = rng.normal(size=(30, 5)), rng.normal(size=30)
+    expected = Ridge(alpha=2.0).fit(X, y).predict(X)
+
+    monkeypatch.delenv(CHECKPOINT_DIR_ENV, raising=False)
+    np.testing.assert_array_equal(_CountingRidge(alpha=2.0).fit(X, y).predict(X), expected)
+    assert _CountingRidge.n_fits == 1
+
+    monkeypatch.setenv(CHECKPOINT_DIR_ENV, str(tmp_path))
+    _CountingRidge(alpha=2.0).fit(X, y)
+    assert _CountingRidge.n_fits == 2 and len(list(tmp_path.iterdir())) == 1
+
+    # the same fit is loaded, other parameters, rows or targets are new fits
+    np.testing.assert_array_equal(_CountingRidge(alpha=2.0).fit(X, y).predict(X), expected)
+    assert _CountingRidge.n_fits == 2
+    _CountingRidge(alpha=1.0).fit(X, y)
+    _CountingRidge(alpha=2.0).fit(X[:20], y[:20])
+    _CountingRidge(alpha=2.0).fit(X, -y)
+    assert _CountingRidge.n_fits == 5
+
+
+def test_load_or_run(tmp_path, monkeypatch):
+    monkeypatch.setenv(CHECKPOINT_DIR_ENV, str(tmp_path))
+    assert load_or_run('fold_0.pkl', dict, a=1) == {'a': 1}
+
+    def preempted():
+        raise AssertionError("run again")
+    assert load_or_run('fold_0.pkl', preempted) == {'a': 1}
+    with pytest.raises(AssertionError):
+        load_or_run('fold_1.pkl', preempted)
+    assert sorted(f.name for f in tmp_path.iterdir()) == ['fold_0.pkl']
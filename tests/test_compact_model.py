@@ -0,0 +1,72 @@
+from brainage import (GaussianProcessRegressor, KernelRidge, RandomForestRegressor, CompactModel, export_compact,
+                      compact_models, save_compact, load_compact)
+from sklearn.decomposition import PCA
+from sklearn.feature_selection import VarianceThreshold
+from sklearn.gaussian_process.kernels import RBF
+from sklearn.linear_model import Ridge
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+import numpy as np
+import pandas as pd
+import pickle
+import pytest
+
+
+def _make_data(n_samples=60, n_features=40, seed=5):
+    rng = np.random.default_rng(seed=seed)
+    X = rng.normal(size=(n_samples, n_features))
+    X[:, 0] = 1.0  # removed by the variance threshold
+    y = 50 + 5 * X[:, 1:4].sum(axis=1) + rng.normal(size=n_samples)
+    return pd.DataFrame(X, columns=[f'f{i}' for i in range(n_features)]), y
+
+
+@pytest.mark.parametrize('model', [Ridge(alpha=1.0),
+                                   KernelRidge(alpha=0.1, kernel='polynomial', degree=2),
+                                   GaussianProcessRegressor(RBF(10.0), alpha=1e-2, normalize_y=True),
+                                   RandomForestRegressor(n_estimators=10, min_samples_leaf=5, random_state=1)])
+@pytest.mark.parametrize('pca', [False, True])
+def test_export_compact(model, pca):
+    X, y = _make_data()
+    steps = [VarianceThreshold(1e-5), StandardScaler()] + ([PCA()] if pca else [])
+    pipeline = make_pipeline(*steps, model).fit(X, y)
+    X_new, _ = _make_data(n_samples=20, seed=6)
+
+    compact = export_compact(pipeline)
+    # columns are picked by name, the matrices are float64 without data to check float32 on
+    np.testing.assert_allclose(compact.predict(X_new[X_new.columns[::-1]]), pipeline.predict(X_new), atol=1e-8)
+    assert all(value.dtype == np.float64 for step in compact.state['steps'] for value in step.values()
+               if isinstance(value, np.ndarray) and value.dtype.kind == 'f')
+
+    compact = export_compact(pipeline, X_new, dtype=np.float32, atol=1e-2)
+    np.testing.assert_allclose(compact.predict(X_new), pipeline.predict(X_new), atol=1e-2)
+    assert len(pickle.dumps(compact)) < len(pickle.dumps(pipeline))
+
+
+def test_export_compact_state():
+    X, y = _make_data()
+    pipeline = make_pipeline(VarianceThreshold(1e-5), StandardScaler(), PCA(),
+                             GaussianProcessRegressor(RBF(10.0), alpha=1e-2, normalize_y=True)).fit(X, y)
+    compact = export_compact(pipeline, X, dtype=np.float32)
+    select, scale, pca = compact.state['steps']
+    np.testing.assert_array_equal(select['index'], np.arange(1, 40))
+    assert pca['components'].dtype == np.float32 and compact.state['model']['X'].dtype == np.float32
+    assert scale['mean'].dtype == np.float64 and compact.state['model']['alpha'].dtype == np.float64
+
+    # linear and degree 1 polynomial kernels are folded into coefficients
+    kernel_ridge = make_pipeline(StandardScaler(), KernelRidge(alpha=1.0, kernel='polynomial', degree=1)).fit(X, y)
+    model = export_compact(kernel_ridge).state['model']
+    assert model['kind'] == 'linear' and model['coef'].shape == (40,)
+
+
+def test_compact_models(tmp_path):
+    X, y = _make_data()
+    pipeline = make_pipeline(StandardScaler(), Ridge()).fit(X, y)
+    models = {'repeat_0': {'ridge': pipeline}}
+    scores = pd.DataFrame({'test_r2': [0.5, 0.6], 'estimator': [pipeline, pipeline]})
+
+    save_compact(compact_models({'models': models, 'scores': scores}, X), tmp_path / 'ridge.compact')
+    loaded = load_compact(tmp_path / 'ridge.compact')
+    assert isinstance(loaded['models']['repeat_0']['ridge'], CompactModel)
+    np.testing.assert_allclose(loaded['models']['repeat_0']['ridge'].predict(X), pipeline.predict(X))
+    assert list(loaded['scores']['test_r2']) == [0.5, 0.6]
+    assert all(isinstance(model, CompactModel) for model in loaded['scores']['estimator'])
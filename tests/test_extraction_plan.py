@@ -0,0 +1,106 @@
+from brainage import ExtractionPlan, ExtractionOperator, binarize_3d
+from nilearn import image
+import nibabel as nib
+import nibabel.processing as npr
+import numpy as np
+
+
+def _affine(voxel_size, offset):
+    affine = np.diag([voxel_size, voxel_size, voxel_size, 1.0])
+    affine[:3, 3] = offset
+    return affine
+
+
+def _make_mask(tmp_path):
+    rng = np.random.default_rng(seed=5)
+    mask = rng.random((24, 28, 22))
+    mask_file = str(tmp_path / 'mask.nii')
+    nib.save(nib.Nifti1Image(mask.astype(np.float32), _affine(1.5, [-18, -21, -16])), mask_file)
+    return mask_file
+
+
+def _make_subject(shape, affine, seed):
+    data = np.random.default_rng(seed=seed).random(shape).astype(np.float32)
+    return nib.Nifti1Image(data, affine)
+
+
+def _reference_features(sub_img, mask_file, smooth_fwhm, resample_size):
+    # the per subject path used before the extraction plan
+    mask_img = nib.load(mask_file)
+    sub_img = image.smooth_img(sub_img, smooth_fwhm)
+    mask_img_rs = npr.resample_to_output(mask_img, [resample_size] * len(mask_img.shape), order=1)
+    sub_img_rs = image.resample_to_img(sub_img, mask_img_rs, interpolation="linear")
+    mask_rs = binarize_3d(mask_img_rs, 0.5).get_fdata().astype(bool)
+    return sub_img_rs.get_fdata()[mask_rs]
+
+
+def test_extraction_plan_matches_nilearn(tmp_path):
+    mask_file = _make_mask(tmp_path)
+    plan = ExtractionPlan(mask_file, smooth_fwhm=4, resample_size=4)
+
+    sub_imgs = [
+        _make_subject((24, 28, 22), _affine(1.5, [-18, -21, -16]), seed=1),
+        _make_subject((36, 42, 33), _affine(1.0, [-18.5, -21, -16.2]), seed=2),
+        _make_subject((24, 28, 22), _affine(1.5, [-18, -21, -16]), seed=3),
+    ]
+    for sub_img in sub_imgs:
+        expected = _reference_features(sub_img, mask_file, 4, 4)
+        np.testing.assert_allclose(plan.extract(sub_img), expected, rtol=1e-6, atol=1e-7)
+
+    assert len(plan._coordinates) == 2  # one setup per input geometry
+
+
+def test_extraction_plan_target_grid(tmp_path):
+    mask_file = _make_mask(tmp_path)
+    plan = ExtractionPlan(mask_file, smooth_fwhm=0, resample_size=4)
+    sub_img = _make_subject(plan.target_shape, plan.target_affine, seed=4)
+
+    assert plan.coordinates(sub_img) is None
+    np.testing.assert_array_equal(
+        plan.extract(sub_img), sub_img.get_fdata().ravel()[plan.mask_indices]
+    )
+
+
+def test_extraction_operator(tmp_path):
+    mask_file = _make_mask(tmp_path)
+    sub_imgs = [
+        _make_subject((24, 28, 22), _affine(1.5, [-18, -21, -16]), seed=1),
+        _make_subject((36, 42, 33), _affine(1.0, [-18.5, -21, -16.2]), seed=2),
+        _make_subject((24, 28, 22), _affine(1.5, [-18, -21, -16]), seed=3),
+    ]
+    for smooth_fwhm in [0, 4, 8]:
+        plan = ExtractionPlan(mask_file, smooth_fwhm=smooth_fwhm, resample_size=4)
+        operator = ExtractionOperator(plan, cache_dir=str(tmp_path / 'operators'))
+        expected = np.array([plan.extract(sub_img) for sub_img in sub_imgs])
+        np.testing.assert_allclose(operator.extract(sub_imgs), expected, rtol=1e-5, atol=1e-6)
+
+        target_img = _make_subject(plan.target_shape, plan.target_affine, seed=4)
+        np.testing.assert_allclose(operator.extract([target_img]), [plan.extract(target_img)], rtol=1e-5, atol=1e-6)
+
+    # matrices are reused from the disk cache
+    cached = ExtractionOperator(plan, cache_dir=str(tmp_path / 'operators'))
+    assert (cached.matrix(sub_imgs[1]) != operator.matrix(sub_imgs[1])).nnz == 0
+    assert len(list((tmp_path / 'operators').iterdir())) == 9
+
+
+def test_extraction_plan_crop(tmp_path):
+    mask_file = _make_mask(tmp_path)
+    sub_files = []
+    for idx, (shape, affine) in enumerate([((36, 42, 33), _affine(1.0, [-18.5, -21, -16.2])),
+                                           ((60, 70, 55), _affine(1.0, [-30, -35, -27]))]):
+        for ext in ['.nii', '.nii.gz']:
+            sub_files.append(str(tmp_path / f'sub{idx}{ext}'))
+            nib.save(_make_subject(shape, affine, seed=idx), sub_files[-1])
+
+    for smooth_fwhm in [0, 4, 8]:
+        plan = ExtractionPlan(mask_file, smooth_fwhm=smooth_fwhm, resample_size=4)
+        full_plan = ExtractionPlan(mask_file, smooth_fwhm=smooth_fwhm, resample_size=4, crop=False)
+        for sub_file in sub_files:
+            np.testing.assert_array_equal(plan.extract(nib.load(sub_file)), full_plan.extract(nib.load(sub_file)))
+
+        target_img = _make_subject(plan.target_shape, plan.target_affine, seed=4)
+        np.testing.assert_array_equal(plan.extract(target_img), full_plan.extract(target_img))
+
+    # the larger image is only read around the mask
+    box = plan.bounding_box(nib.load(sub_files[-1]))
+    assert np.all(box[0] > 0) and np.all(box[1] < np.array([59, 69, 54]))
@@ -0,0 +1,54 @@
+from brainage import GaussianProcessRegressor
+import sklearn.gaussian_process as gp
+import numpy as np
+
+
+def _make_data(n_samples=80, n_features=20, seed=5):
+    rng = np.random.default_rng(seed=seed)
+    X = rng.normal(size=(n_samples, n_features))
+    y = 50 + 5 * X[:, :3].sum(axis=1) + rng.normal(size=n_samples)
+    return X, y
+
+
+def test_gaussian_process_matches_sklearn():
+    X, y = _make_data()
+    params = {'kernel': gp.kernels.RBF(10.0, (1e-7, 10e7)), 'n_restarts_optimizer': 10, 'normalize_y': True,
+              'random_state': 200}
+    expected = gp.GaussianProcessRegressor(**params).fit(X, y)
+    for n_jobs in [1, 3]:
+        model = GaussianProcessRegressor(**params, n_jobs=n_jobs, restart_batch_size=4).fit(X, y)
+        np.testing.assert_allclose(model.kernel_.theta, expected.kernel_.theta, rtol=1e-6)
+        np.testing.assert_allclose(model.log_marginal_likelihood_value_, expected.log_marginal_likelihood_value_,
+                                   rtol=1e-8)
+        np.testing.assert_allclose(model.predict(X), expected.predict(X), rtol=1e-6)
+
+
+def test_gaussian_process_early_termination():
+    X, y = _make_data()
+    params = {'kernel': gp.kernels.RBF(10.0, (1e-7, 10e7)), 'n_restarts_optimizer': 40, 'normalize_y': True,
+              'random_state': 200, 'restart_batch_size': 4, 'n_iter_no_change': 8, 'theta_tol': 1e-3}
+    expected = gp.GaussianProcessRegressor(**{k: params[k] for k in ['kernel', 'n_restarts_optimizer',
+                                                                        'normalize_y', 'random_state']}).fit(X, y)
+    model = GaussianProcessRegressor(**params).fit(X, y)
+
+    assert model.n_restarts_run_ < 40
+    np.testing.assert_allclose(model.kernel_.theta, expected.kernel_.theta, rtol=1e-4)
+    # reproducible whatever the number of threads
+    parallel = GaussianProcessRegressor(**params, n_jobs=4).fit(X, y)
+    assert parallel.n_restarts_run_ == model.n_restarts_run_
+    np.testing.assert_array_equal(parallel.predict(X), model.predict(X))
+
+
+def test_gaussian_process_squared_distances():
+    X, y = _make_data()
+    model = GaussianProcessRegressor(gp.kernels.RBF(10.0, (1e-7, 10e7)), normalize_y=True).fit(X, y)
+    expected = gp.GaussianProcessRegressor(gp.kernels.RBF(10.0, (1e-7, 10e7)), normalize_y=True).fit(X, y)
+    assert not hasattr(model, '_sq_dists') or model._sq_dists is None
+    np.testing.assert_allclose(model.kernel_.theta, expected.kernel_.theta, rtol=1e-6)
+
+    model._sq_dists = model._squared_distances()
+    for theta in [np.log([0.5]), np.log([3.0]), np.log([40.0])]:
+        lml, grad = model.log_marginal_likelihood(theta, eval_gradient=True)
+        expected_lml, expected_grad = expected.log_marginal_likelihood(theta, eval_gradient=True)
+        np.testing.assert_allclose(lml, expected_lml, rtol=1e-10)
+        np.testing.assert_allclose(grad, expected_grad, rtol=1e-8)
@@ -0,0 +1,60 @@
+from brainage import ElasticNetMix, mix_scores, with_predict_alpha, get_step, glmnet_model
+from glmnet import ElasticNet
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.model_selection import KFold
+import numpy as np
+import pandas as pd
+
+
+def _make_data(n_samples=80, n_features=15, seed=3):
+    rng = np.random.default_rng(seed=seed)
+    X = rng.normal(size=(n_samples, n_features))
+    y = 50 + 5 * X[:, :3].sum(axis=1) + rng.normal(size=n_samples)
+    return X, y
+
+
+def test_elastic_net_mix_matches_separate_fits():
+    X, y = _make_data()
+    mix = ElasticNetMix(alphas=[0, 1, 0.5], random_state=200).fit(X, y)
+    for alpha in [0, 1, 0.5]:
+        expected = ElasticNet(alpha=alpha, standardize=False, random_state=200).fit(X, y)
+        mix.predict_alpha = alpha
+        np.testing.assert_allclose(mix.predict(X), expected.predict(X))
+
+
+def test_mix_scores():
+    X, y = _make_data()
+    data = pd.DataFrame(X, columns=[f'f{i}' for i in range(X.shape[1])])
+    data['age'] = y
+    columns = list(data.columns[:-1])
+    cv = list(KFold(n_splits=3, shuffle=True, random_state=0).split(data))
+    estimators = [make_pipeline(StandardScaler(), ElasticNetMix(random_state=200)).fit(data[columns].iloc[train],
+                                                                                       data['age'].iloc[train])
+                  for train, _ in cv]
+    scores = pd.DataFrame({'fit_time': [1.0, 2.0, 3.0], 'test_r2': [0.0, 0.0, 0.0], 'estimator': estimators})
+
+    mixed = mix_scores(scores, cv, data, columns, 'age', return_estimator=True)
+    assert list(mixed) == [0, 1, 0.5]
+    for alpha, alpha_scores in mixed.items():
+        np.testing.assert_array_equal(alpha_scores['fit_time'], scores['fit_time'])
+        for fold, (_, test) in enumerate(cv):
+            model = with_predict_alpha(estimators[fold], alpha)
+            y_pred = model.predict(data[columns].iloc[test])
+            mae = np.abs(data['age'].iloc[test] - y_pred).mean()
+            np.testing.assert_allclose(alpha_scores['test_neg_mean_absolute_error'][fold], -mae)
+            assert alpha_scores['estimator'][fold]['elasticnetmix'].predict_alpha == alpha
+    assert estimators[0]['elasticnetmix'].predict_alpha is None  # the fold estimators are not modified
+
+
+def test_glmnet_model_of_saved_pipelines():
+    X, y = _make_data()
+    mix = make_pipeline(StandardScaler(), ElasticNetMix(alphas=[0, 1, 0.5], random_state=200)).fit(X, y)
+    single = make_pipeline(StandardScaler(), ElasticNet(alpha=1, standardize=False, random_state=200)).fit(X, y)
+    # the lasso of the glmnet model and of the elasticnet model
+    lasso = glmnet_model(with_predict_alpha(mix, 1))
+    assert lasso is not glmnet_model(with_predict_alpha(mix, 0)) and lasso.alpha == 1
+    X_scaled = single[0].transform(X)
+    np.testing.assert_allclose(lasso.predict(X_scaled), glmnet_model(single).predict(X_scaled))
+    # step names of models saved before a rename
+    assert get_step(single, 'randomforestregressor', 'elasticnet') is single['elasticnet']
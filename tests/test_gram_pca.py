@@ -0,0 +1,40 @@
+from brainage import GramPCA
+from sklearn.decomposition import PCA
+import numpy as np
+import pytest
+
+
+def _make_data(n_samples, n_features, seed=11):
+    rng = np.random.default_rng(seed=seed)
+    X = rng.normal(size=(n_samples, n_features)) + rng.normal(size=(n_samples, 4)) @ rng.normal(size=(4, n_features))
+    return X, rng.normal(size=(10, n_features))
+
+
+@pytest.mark.parametrize("n_samples, n_features", [(40, 500), (60, 20)])
+def test_gram_pca_matches_sklearn(n_samples, n_features):
+    X, X_test = _make_data(n_samples, n_features)
+    expected = PCA(n_components=None).fit(X)
+    pca = GramPCA(n_components=None).fit(X)
+
+    n_defined = min(n_samples - 1, n_features)  # components with a non zero singular value
+    assert pca.n_components_ == expected.n_components_
+    # scikit-learn > 1.0 flips signs on the loadings instead of the scores, compare up to sign
+    scores, expected_scores = pca.transform(X)[:, :n_defined], expected.transform(X)[:, :n_defined]
+    signs = np.sign(np.sum(scores * expected_scores, axis=0))
+    np.testing.assert_allclose(pca.transform(X_test)[:, :n_defined] * signs,
+                               expected.transform(X_test)[:, :n_defined], atol=1e-9)
+    # the sign convention of the pinned scikit-learn 1.0.2: largest absolute score of every component positive
+    assert np.all(scores[np.argmax(np.abs(scores), axis=0), np.arange(n_defined)] > 0)
+    np.testing.assert_allclose(pca.explained_variance_ratio_[:n_defined],
+                               expected.explained_variance_ratio_[:n_defined], atol=1e-12)
+    assert GramPCA(n_components=0.5).fit(X).n_components_ == PCA(n_components=0.5).fit(X).n_components_
+
+
+def test_gram_pca_randomized():
+    X, X_test = _make_data(40, 500)
+    expected = GramPCA(n_components=4).fit(X)
+    pca = GramPCA(n_components=4, svd_solver='randomized', random_state=0).fit(X)
+    np.testing.assert_allclose(pca.transform(X_test), expected.transform(X_test), rtol=1e-6, atol=1e-6)
+
+    with pytest.raises(ValueError):
+        GramPCA(svd_solver='randomized').fit(X)
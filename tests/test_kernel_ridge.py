@@ -0,0 +1,81 @@
+from brainage import KernelRidge
+from brainage import kernel_ridge
+from brainage.cache_utils import ContentCache
+from sklearn.kernel_ridge import KernelRidge as SklearnKernelRidge
+from sklearn.decomposition import PCA
+from sklearn.feature_selection import VarianceThreshold
+from sklearn.model_selection import GridSearchCV, KFold
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+import numpy as np
+
+
+class _CountingCache(ContentCache):
+    n_computed = 0
+
+    def __setitem__(self, key, value):
+        self.n_computed += 1
+        super().__setitem__(key, value)
+
+
+def _make_data(n_samples=60, n_features=30, seed=2):
+    rng = np.random.default_rng(seed=seed)
+    X = rng.normal(size=(n_samples, n_features))
+    y = X[:, :3].sum(axis=1) + 0.1 * rng.normal(size=n_samples)
+    return X, y
+
+
+def test_kernel_ridge_matches_sklearn():
+    X, y = _make_data()
+    for params in [{'kernel': 'polynomial', 'degree': 2, 'alpha': 0.1}, {'kernel': 'linear', 'alpha': 1.0},
+                   {'kernel': 'polynomial', 'degree': 1, 'alpha': 0.0}, {'kernel': 'rbf', 'alpha': 0.5}]:
+        expected = SklearnKernelRidge(**params).fit(X[:40], y[:40]).predict(X[40:])
+        # alpha 0 on the singular degree 1 kernel: sklearn's solve is only accurate to its conditioning
+        rtol = 1e-3 if params['alpha'] == 0 else 1e-7
+        np.testing.assert_allclose(KernelRidge(**params).fit(X[:40], y[:40]).predict(X[40:]), expected, rtol=rtol)
+
+
+def test_kernel_ridge_grid_search(monkeypatch):
+    X, y = _make_data()
+    param_grid = {'alpha': [0.0, 0.001, 0.01, 0.1, 0.5, 1.0, 10.0, 100.0, 1000.0], 'degree': [1, 2],
+                  'kernel': ['polynomial']}
+    cv = KFold(n_splits=5, shuffle=True, random_state=200)
+    expected = GridSearchCV(SklearnKernelRidge(), param_grid, cv=cv, scoring='neg_mean_absolute_error').fit(X, y)
+
+    # as large as the module caches: one search on 5 folds and 2 degrees is reused with these sizes
+    kernels = _CountingCache(max_size=kernel_ridge._linear_kernels.max_size)
+    eighs = _CountingCache(max_size=kernel_ridge._kernel_eighs.max_size)
+    monkeypatch.setattr(kernel_ridge, '_linear_kernels', kernels)
+    monkeypatch.setattr(kernel_ridge, '_kernel_eighs', eighs)
+    search = GridSearchCV(KernelRidge(), param_grid, cv=cv, scoring='neg_mean_absolute_error').fit(X, y)
+
+    assert search.best_params_ == expected.best_params_
+    nonzero = np.asarray(search.cv_results_['param_alpha'], dtype=float) > 0  # alpha 0: singular degree 1 kernel
+    np.testing.assert_allclose(search.cv_results_['mean_test_score'][nonzero],
+                               expected.cv_results_['mean_test_score'][nonzero], rtol=1e-9)
+    np.testing.assert_allclose(search.cv_results_['mean_test_score'], expected.cv_results_['mean_test_score'],
+                               rtol=1e-3)
+    # one train and one validation kernel per fold, plus the refit on all data
+    assert kernels.n_computed == 5 * 2 + 1
+    # one decomposition per fold and degree, shared by the alphas, plus the refit
+    assert eighs.n_computed == 5 * 2 + 1
+
+    kernel_ridge.clear_kernel_caches()  # the monkeypatched caches
+    assert len(kernels) == 0 and len(eighs) == 0
+
+
+def test_kernel_ridge_grid_search_with_preprocessing():
+    # the pipeline of the training scripts: variancethreshold, zscore and pca are fitted on every inner fold
+    X, y = _make_data(n_samples=80, n_features=120)
+    X[:, 0] = 1.0  # removed by the variance threshold
+    param_grid = {'kernelridge__alpha': [0.0, 0.001, 0.01, 0.1, 0.5, 1.0, 10.0, 100.0, 1000.0],
+                  'kernelridge__degree': [1, 2], 'kernelridge__kernel': ['polynomial']}
+    cv = KFold(n_splits=5, shuffle=True, random_state=200)
+    searches = [GridSearchCV(make_pipeline(VarianceThreshold(1e-5), StandardScaler(), PCA(), model), param_grid,
+                             cv=cv, scoring='neg_mean_absolute_error').fit(X, y)
+                for model in [SklearnKernelRidge(), KernelRidge()]]
+
+    assert searches[1].best_params_ == searches[0].best_params_
+    np.testing.assert_allclose(searches[1].cv_results_['mean_test_score'],
+                               searches[0].cv_results_['mean_test_score'], rtol=1e-7)
+    np.testing.assert_allclose(searches[1].predict(X[:10]), searches[0].predict(X[:10]), rtol=1e-7)
@@ -0,0 +1,50 @@
+from brainage import (GaussianProcessRegressor, RandomForestRegressor, export_compact, save_model_store,
+                      load_model_store, is_model_store, prune_model_store)
+from sklearn.decomposition import PCA
+from sklearn.gaussian_process.kernels import RBF
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+import copy
+import os
+import numpy as np
+
+
+def _make_data(n_samples=60, n_features=300, seed=7):
+    rng = np.random.default_rng(seed=seed)
+    X = rng.normal(size=(n_samples, n_features))
+    y = 50 + 5 * X[:, :3].sum(axis=1) + rng.normal(size=n_samples)
+    return X, y
+
+
+def test_model_store(tmp_path):
+    X, y = _make_data()
+    gauss = make_pipeline(StandardScaler(), PCA(),
+                          GaussianProcessRegressor(RBF(10.0), alpha=1e-2, normalize_y=True)).fit(X, y)
+    rf = make_pipeline(StandardScaler(), RandomForestRegressor(n_estimators=5, random_state=1)).fit(X, y)
+    models = {'repeat_0': {'gauss': gauss, 'gauss_copy': copy.deepcopy(gauss), 'rf': rf,
+                           'compact': export_compact(gauss)}}
+
+    path = tmp_path / 'gauss.models.store'
+    assert not is_model_store(path)
+    save_model_store(models, path, min_bytes=1024)
+    assert is_model_store(path)
+    loaded = load_model_store(path)['repeat_0']
+    for name in ['gauss', 'gauss_copy', 'rf', 'compact']:
+        np.testing.assert_array_equal(loaded[name].predict(X), models['repeat_0'][name].predict(X))
+
+    # the large arrays are mapped read-only, the copy shares the files of the original
+    pca = loaded['gauss'][1]
+    assert isinstance(pca.components_, np.memmap) and not pca.components_.flags.writeable
+    assert pca.components_.filename == loaded['gauss_copy'][1].components_.filename
+    assert not isinstance(loaded['gauss'][2].alpha_, np.memmap)  # 60 values, pickled in the index
+
+    # saving other models in place keeps the files of the earlier index for its readers
+    save_model_store({'rf': rf}, path, min_bytes=1024)
+    np.testing.assert_array_equal(loaded['gauss'].predict(X), gauss.predict(X))
+    np.testing.assert_array_equal(load_model_store(path)['rf'].predict(X), rf.predict(X))
+
+    # pruning removes them and keeps the files the current index uses
+    assert os.path.basename(pca.components_.filename) in prune_model_store(path)
+    assert not os.path.exists(pca.components_.filename)
+    assert prune_model_store(path) == []
+    np.testing.assert_array_equal(load_model_store(path)['rf'].predict(X), rf.predict(X))
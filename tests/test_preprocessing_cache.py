@@ -0,0 +1,38 @@
+from brainage import CachedVarianceThreshold, CachedStandardScaler, CachedPCA
+from brainage.preprocessing_cache import CACHE_DIR_ENV
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import StandardScaler
+from sklearn.feature_selection import VarianceThreshold
+import pandas as pd
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("cached_cls, cls, params", [
+    (CachedVarianceThreshold, VarianceThreshold, {'threshold': 1e-5}),
+    (CachedStandardScaler, StandardScaler, {}),
+    (CachedPCA, PCA, {'n_components': None}),
+])
+def test_cached_transformers(tmp_path, monkeypatch, cached_cls, cls, params):
+    rng = np.random.default_rng(seed=3)
+    X = pd.DataFrame(rng.normal(size=(40, 12))).rename(columns=lambda c: 'f_' + str(c))
+    X['f_0'] = 1.0  # constant feature removed by the variance threshold
+    expected = cls(**params).fit(X).transform(X)
+
+    # without a cache directory nothing is written
+    monkeypatch.delenv(CACHE_DIR_ENV, raising=False)
+    np.testing.assert_array_equal(cached_cls(**params).fit_transform(X), expected)
+
+    monkeypatch.setenv(CACHE_DIR_ENV, str(tmp_path))
+    np.testing.assert_array_equal(cached_cls(**params).fit_transform(X), expected)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # an identical fit is loaded from the cache
+    def no_fit(self, X, y=None):
+        raise AssertionError("fitted again")
+    monkeypatch.setattr(cls, 'fit', no_fit)
+    np.testing.assert_array_equal(cached_cls(**params).fit(X).transform(X), expected)
+
+    # other rows (another split) are a new entry
+    with pytest.raises(AssertionError):
+        cached_cls(**params).fit(X.iloc[:30])
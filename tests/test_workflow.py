@@ -0,0 +1,61 @@
+from brainage import Task, build_workflow, workflow_graph, outdated_tasks, run_workflow
+import os
+import sys
+import time
+
+
+def _grid(mode='within'):
+    data = {'name': 'ixi', 'subject_filepaths': '../data/ixi/ixi_paths_cat12.8.csv',
+            'demographics_file': '../data/ixi/ixi.subject_list_cat12.8.csv', 'features_path': '../data/ixi/',
+            'output_path': '../results/ixi'}
+    return {'mode': mode, 'data': data, 'parcels': [173, 473], 'parcel_masks': '../masks/BSF_{n}.nii',
+            'voxels': {'smooth_fwhm': [0, 4], 'resample_size': [4, 8]}, 'voxel_mask': '../masks/brainmask_12.8.nii',
+            'pca': [0, 1], 'models': ['ridge', 'gauss']}
+
+
+def test_build_workflow():
+    tasks = {task.name: task for task in build_workflow(_grid())}
+    # 2 parcel + 2 x 4 voxel spaces, 2 models each, extraction, combine, bias correction
+    assert len(tasks) == 10 * 2 + 2 + 2
+    train = tasks['ixi.S4_R8_pca.gauss']
+    assert [t.name for t in train.dependencies] == ['ixi.extract_voxels']
+    assert '../results/ixi/ixi.S4_R8_pca.gauss.models' in train.outputs
+    assert train.cost > tasks['ixi.S4_R8_pca.ridge'].cost
+    assert len(tasks['ixi.combine'].dependencies) == 20
+    assert [t.name for t in tasks['ixi.bias_correction'].dependencies] == ['ixi.combine']
+
+    grid = _grid('cross')
+    grid['test_data'] = {'name': '1000brains', 'subject_filepaths': '../data/1000brains/paths.csv',
+                         'demographics_file': '../data/1000brains/demo.csv', 'features_path': '../data/1000brains/'}
+    tasks = {task.name: task for task in build_workflow(grid)}
+    assert {t.name for t in tasks['1000brains.combine'].dependencies} >= {'1000brains.extract_parcels',
+                                                                          '1000brains.extract_voxels',
+                                                                          'ixi.173.ridge'}
+    assert [t.name for t in tasks['ixi.173.ridge.bias_correction'].dependencies] == ['ixi.173.ridge']
+
+
+def _copy_task(name, source, target, cost=1.0):
+    command = ['-c', f'import shutil; shutil.copy({source!r}, {target!r})']
+    return Task(name, command, [source], [target], cost=cost)
+
+
+def test_run_workflow(tmp_path, capsys):
+    (tmp_path / 'a').write_text('a')
+    tasks = workflow_graph([_copy_task('c', 'b', 'c'), _copy_task('b', 'a', 'b'),
+                            _copy_task('d', 'a', 'd', cost=0.5), _copy_task('e', 'missing', 'e')])
+    assert [t.name for t in tasks[0].dependencies] == ['b']
+    status = run_workflow(tasks, n_cpus=1, cwd=str(tmp_path), log_dir=str(tmp_path / 'logs'), dry_run=True)
+    # the chain b -> c first, then e before the cheaper d
+    assert [line.split()[-1].strip("')") for line in capsys.readouterr().out.splitlines()] == ['b', 'c', 'e', 'd']
+    assert set(status.values()) == {'dry run'}
+
+    status = run_workflow(tasks, n_cpus=2, cwd=str(tmp_path), log_dir=str(tmp_path / 'logs'),
+                          python=sys.executable)
+    assert status == {'b': 'done', 'c': 'done', 'd': 'done', 'e': 'failed'}
+    assert (tmp_path / 'c').read_text() == 'a'
+    assert outdated_tasks(tasks, str(tmp_path)) == {'e'}
+
+    # a newer input makes the task and its dependents outdated
+    later = time.time() + 10
+    os.utime(tmp_path / 'a', (later, later))
+    assert outdated_tasks(tasks, str(tmp_path)) == {'b', 'c', 'd', 'e'}
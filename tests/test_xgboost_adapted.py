@@ -0,0 +1,58 @@
+from brainage import XGBoostAdapted
+from brainage import xgboost_adapted
+from brainage import thread_budget
+from brainage.cache_utils import ContentCache
+from sklearn.model_selection import GridSearchCV, KFold, train_test_split
+from xgboost import XGBRegressor
+import numpy as np
+import pandas as pd
+import pytest
+
+
+class _CountingCache(ContentCache):
+    n_computed = 0
+
+    def __setitem__(self, key, value):
+        self.n_computed += 1
+        super().__setitem__(key, value)
+
+
+def _make_data(n_samples=150, n_features=20, seed=8):
+    rng = np.random.default_rng(seed=seed)
+    X = pd.DataFrame(rng.normal(size=(n_samples, n_features)), columns=[f'f{i}' for i in range(n_features)])
+    y = pd.Series(50 + 5 * X.iloc[:, :3].sum(axis=1) + rng.normal(size=n_samples))
+    return X, y
+
+
+@pytest.mark.parametrize('tree_method', [None, 'hist'])
+def test_xgboost_adapted_matches_xgb_regressor(tree_method):
+    X, y = _make_data()
+    model = XGBoostAdapted(early_stopping_rounds=10, eval_metric='mae', eval_set_percent=0.2, random_seed=200,
+                           n_jobs=1, max_depth=4, n_estimators=100, reg_alpha=0.01, tree_method=tree_method)
+    model.fit(X, y)
+
+    X_train, X_test, y_train, y_test = train_test_split(X.values, y.values, test_size=0.2, random_state=200)
+    expected = XGBRegressor(n_jobs=1, max_depth=4, n_estimators=100, reg_alpha=0.01, tree_method=tree_method,
+                            early_stopping_rounds=10, eval_metric='mae')
+    expected.fit(X_train, y_train, eval_set=[(X_test, y_test)], verbose=False)
+    assert model.best_iteration_ == expected.best_iteration
+    np.testing.assert_array_equal(model.predict(X), expected.predict(X.values))
+
+
+def test_split_dmatrices_shared_by_grid(monkeypatch):
+    X, y = _make_data()
+    cache = _CountingCache(max_size=6)
+    monkeypatch.setattr(xgboost_adapted, '_split_dmatrices', cache)
+    param_grid = {'max_depth': [2, 4], 'reg_alpha': [0.01, 0.1, 1.0]}
+    cv = KFold(n_splits=5, shuffle=True, random_state=200)
+    GridSearchCV(XGBoostAdapted(eval_metric='mae', random_seed=200, n_jobs=1, n_estimators=20), param_grid,
+                 cv=cv).fit(X, y)
+    # one pair of matrices per fold plus the refit on all data
+    assert cache.n_computed == 5 + 1
+
+
+def test_thread_budget(monkeypatch):
+    monkeypatch.setenv('OMP_NUM_THREADS', '3')
+    assert thread_budget(None) == 3 and thread_budget(-1) == 3 and thread_budget(2) == 2
+    monkeypatch.delenv('OMP_NUM_THREADS')
+    assert thread_budget(None) >= 1